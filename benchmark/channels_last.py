@@ -0,0 +1,64 @@
+"""
+Throughput of the NCHW and the channels_last (NHWC) memory formats per resolution
+
+python -m benchmark.channels_last --device cpu --sizes 540x960 1080x1920 --model RIFE_IFNet_v426_heavy.pkl
+"""
+
+import argparse
+import time
+from typing import Any
+
+import torch
+
+from ccvfi import AutoModel, ConfigType
+
+
+def bench(model: Any, inp: torch.Tensor, timesteps: Any, repeat: int) -> float:
+    def run() -> None:
+        if inp.shape[1] == 2:
+            model.inference(inp, timestep=timesteps, scale=1.0)
+        else:
+            model.inference(inp, [-0.5], [], [0.5], False, False, 1.0, None)
+
+    run()
+    if inp.is_cuda:
+        torch.cuda.synchronize(inp.device)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    if inp.is_cuda:
+        torch.cuda.synchronize(inp.device)
+    return repeat / (time.perf_counter() - t0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=ConfigType.RIFE_IFNet_v426_heavy.value, help="RIFE or DRBA config name")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--sizes", nargs="+", default=["540x960", "1080x1920", "2160x3840"], help="HxW")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device(args.device) if args.device is not None else None
+    models = {
+        fmt: AutoModel.from_pretrained(
+            pretrained_model_name=args.model, device=device, fp16=args.fp16, channels_last=fmt == "channels_last"
+        )
+        for fmt in ["nchw", "channels_last"]
+    }
+    model = models["nchw"]
+    dtype = torch.float16 if model.fp16 else torch.float32
+    n = model.config.in_frame_count
+
+    print(f"{'size':>10} {'nchw fps':>9} {'nhwc fps':>9} {'speedup':>8}")
+    for size in args.sizes:
+        h, w = (int(v) for v in size.split("x"))
+        inp = torch.rand((1, n, 3, h, w), device=model.device, dtype=dtype)
+        fps = {fmt: bench(m, inp, 0.5, args.repeat) for fmt, m in models.items()}
+        speedup = fps["channels_last"] / fps["nchw"]
+        print(f"{size:>10} {fps['nchw']:>9.2f} {fps['channels_last']:>9.2f} {speedup:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+CPU throughput and SSIM of the float32 and the int8 IFBlock conv stacks on the bundled assets
+
+The int8 model is calibrated on the three assets. The SSIM is measured against the float32 output and against the
+reference frame of the tests (assets/test_out.jpg for RIFE, assets/test_out_1.jpg for DRBA), at the reference
+resolution.
+
+python -m benchmark.int8 --sizes 540x960 1080x1920 --threads 8
+"""
+
+import argparse
+import time
+
+import cv2
+import torch
+import torch.nn.functional as F
+
+from benchmark.refine import ASSETS_PATH, load
+from ccvfi import AutoModel, ConfigType
+from ccvfi.util.misc import ssim_matlab
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=ConfigType.RIFE_IFNet_v426_heavy.value, help="RIFE or DRBA config name")
+    parser.add_argument("--sizes", nargs="+", default=["540x960", "1080x1920"], help="HxW the assets are resized to")
+    parser.add_argument("--threads", type=int, default=None, help="torch cpu threads")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    models = {
+        mode: AutoModel.from_pretrained(pretrained_model_name=args.model, device=device, fp16=False)
+        for mode in ["fp32", "int8"]
+    }
+    frames = [cv2.imread(str(ASSETS_PATH / f"test_i{i}.png"), cv2.IMREAD_COLOR) for i in range(3)]
+    models["int8"].quantize_int8(frames)
+    n = models["fp32"].config.in_frame_count
+    ref = load("test_out.jpg" if n == 2 else "test_out_1.jpg", device)
+
+    def run(model: torch.nn.Module, inp: torch.Tensor) -> torch.Tensor:
+        if n == 2:
+            return model.inference(inp, timestep=0.5, scale=1.0)
+        return model.inference(inp, [-0.5], [], [0.5], False, False, 1.0, None)[0][:, 0]
+
+    print(f"{'size':>10} {'fp32 fps':>9} {'int8 fps':>9} {'speedup':>8} {'ssim/fp32':>9} {'ssim/ref':>9}")
+    for size in args.sizes:
+        h, w = (int(v) for v in size.split("x"))
+        inp = torch.stack([load(f"test_i{i}.png", device, [h, w]) for i in range(n)], dim=1)
+        fps, out = {}, {}
+        for mode, model in models.items():
+            out[mode] = run(model, inp)
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                run(model, inp)
+            fps[mode] = args.repeat / (time.perf_counter() - t0)
+
+        small = F.interpolate(out["int8"], size=ref.shape[2:], mode="bilinear", align_corners=False)
+        print(
+            f"{size:>10} {fps['fp32']:>9.2f} {fps['int8']:>9.2f} {fps['int8'] / fps['fp32']:>7.2f}x"
+            f" {ssim_matlab(out['int8'], out['fp32']).item():>9.4f} {ssim_matlab(small, ref).item():>9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
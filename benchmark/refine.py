@@ -0,0 +1,91 @@
+"""
+Throughput and SSIM of the IFNet refinement presets on the bundled assets
+
+The SSIM is measured against the output of the quality preset and against the reference frame of the tests
+(assets/test_out.jpg), at the reference resolution.
+
+python -m benchmark.refine --size 2160x3840 --batch 4 --flow-tol 0 0.05
+"""
+
+import argparse
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ccvfi import AutoModel, ConfigType
+from ccvfi.model import RIFEModel
+from ccvfi.model.vfi_base_model import REFINE_PRESETS
+from ccvfi.util.misc import ssim_matlab
+
+ASSETS_PATH = Path(__file__).resolve().parent.parent / "assets"
+
+
+def load(name: str, device: torch.device, size: Optional[List[int]] = None) -> torch.Tensor:
+    img = cv2.imread(str(ASSETS_PATH / name), cv2.IMREAD_COLOR)
+    if size is not None:
+        img = cv2.resize(img, (size[1], size[0]), interpolation=cv2.INTER_CUBIC)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return torch.from_numpy(np.ascontiguousarray(img)).to(device).permute(2, 0, 1).unsqueeze(0).float() / 255.0
+
+
+def sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--fp16", action="store_true")
+    parser.add_argument("--size", default="2160x3840", help="HxW the assets are upscaled to")
+    parser.add_argument("--batch", type=int, default=1, help="timesteps per inference call")
+    parser.add_argument("--flow-tol", type=float, nargs="+", default=[0.0], help="0 disables the early exit")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    size = [int(v) for v in args.size.split("x")]
+    model: RIFEModel = AutoModel.from_pretrained(
+        pretrained_model_name=ConfigType.RIFE_IFNet_v426_heavy,
+        device=torch.device(args.device) if args.device is not None else None,
+        fp16=args.fp16,
+    )
+    device = model.device
+    dtype = torch.float16 if args.fp16 else torch.float32
+
+    inp = torch.stack([load("test_i0.png", device, size), load("test_i1.png", device, size)], dim=1).to(dtype)
+    inp = inp.repeat(args.batch, 1, 1, 1, 1)
+    ref = load("test_out.jpg", device)
+
+    def run() -> torch.Tensor:
+        return model.inference(inp, timestep=0.5, scale=1.0)
+
+    baseline = None
+    print(f"{'preset':>9} {'flow_tol':>8} {'fps':>8} {'ssim/quality':>12} {'ssim/ref':>9}")
+    for preset in REFINE_PRESETS:
+        for tol in args.flow_tol:
+            model.refine_scales, model.flow_tol = REFINE_PRESETS[preset], tol if tol > 0 else None
+            out = run()
+            sync(device)
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                run()
+            sync(device)
+            fps = args.repeat * args.batch / (time.perf_counter() - t0)
+
+            out = out[:1].float()
+            if baseline is None:
+                baseline = out
+            small = F.interpolate(out, size=ref.shape[2:], mode="bilinear", align_corners=False)
+            print(
+                f"{preset:>9} {tol:>8} {fps:>8.2f} {ssim_matlab(out, baseline).item():>12.4f}"
+                f" {ssim_matlab(small, ref).item():>9.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of the torch forward-splatting engine (softsplat_torch) against the previous one
+
+python -m benchmark.softsplat --device cpu --size 540x960 --batch 1 4
+"""
+
+import argparse
+import time
+from typing import Callable
+
+import torch
+
+from ccvfi.arch.arch_utils.softsplat_torch import softsplat
+from tests.test_softsplat import legacy_softsplat
+
+
+def bench(fn: Callable, *args, repeat: int = 10) -> float:
+    fn(*args)
+    if args[0].is_cuda:
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    if args[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--size", default="540x960", help="HxW of the splatted maps")
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 4], help="batch sizes, e.g. the timesteps")
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    h, w = (int(v) for v in args.size.split("x"))
+    device = torch.device(args.device)
+    print(f"{'mode':>6} {'batch':>5} {'legacy ms':>10} {'fused ms':>10} {'speedup':>8}")
+    for mode in ["sum", "avg"]:
+        for n in args.batch:
+            tenIn = torch.rand((n, args.channels, h, w), device=device)
+            tenFlow = torch.randn((n, 2, h, w), device=device) * 8
+            legacy = bench(legacy_softsplat, tenIn, tenFlow, None, mode, repeat=args.repeat)
+            fused = bench(softsplat, tenIn, tenFlow, None, mode, repeat=args.repeat)
+            print(f"{mode:>6} {n:>5} {legacy:>10.2f} {fused:>10.2f} {legacy / fused:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
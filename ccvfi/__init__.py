@@ -3,3 +3,4 @@ from ccvfi.type import BaseConfig, ConfigType, BaseModelInterface, ArchType, Mod
 from ccvfi.model import MODEL_REGISTRY, VFIBaseModel  # noqa
 from ccvfi.arch import ARCH_REGISTRY  # noqa
 from ccvfi.config import CONFIG_REGISTRY  # noqa
+from ccvfi.scdet import SCDET_REGISTRY, SceneIndex  # noqa
@@ -0,0 +1,99 @@
+# type: ignore
+import torch
+import torch.nn as nn
+
+
+class FoldedResConv(nn.Module):
+    """
+    ResConv with its beta folded into the conv weights, relu(conv(x) + x) instead of relu(conv(x) * beta + x)
+
+    :param conv: The conv of the ResConv, its weights are scaled in place
+    :param beta: The (1, C, 1, 1) beta of the ResConv
+    :param relu: The activation of the ResConv
+    """
+
+    def __init__(self, conv, beta, relu):
+        super(FoldedResConv, self).__init__()
+        scale = beta.detach().float().view(-1)
+        conv.weight.data.copy_((conv.weight.detach().float() * scale.view(-1, 1, 1, 1)).to(conv.weight.dtype))
+        if conv.bias is not None:
+            conv.bias.data.copy_((conv.bias.detach().float() * scale).to(conv.bias.dtype))
+        self.conv = conv
+        self.relu = relu
+
+    def forward(self, x):
+        return self.relu(self.conv(x) + x)
+
+
+class ShuffleConvTranspose2d(nn.Module):
+    """
+    ConvTranspose2d(k, s, p) followed by PixelShuffle(r), fused into one ConvTranspose2d(k * r, s * r, p * r)
+
+    The output pixel (r * Y + a, r * X + b) of the channel q is the pixel (Y, X) of the channel r * r * q + r * a + b
+    before the shuffle, so W'[c, q, r * k + a, r * l + b] = W[c, r * r * q + r * a + b, k, l]. The bias differs per
+    sub-pixel (a, b), it is added as a periodic pattern.
+
+    :param conv: The ConvTranspose2d
+    :param upscale: The upscale factor of the PixelShuffle
+    """
+
+    def __init__(self, conv, upscale):
+        super(ShuffleConvTranspose2d, self).__init__()
+        if conv.groups != 1 or conv.dilation != (1, 1) or conv.output_padding != (0, 0):
+            raise ValueError("Only ConvTranspose2d without groups, dilation and output padding can be fused")
+
+        r = upscale
+        cin, cout, kh, kw = conv.weight.shape
+        cout //= r * r
+        weight = conv.weight.detach().view(cin, cout, r, r, kh, kw).permute(0, 1, 4, 2, 5, 3)
+        self.conv = nn.ConvTranspose2d(
+            cin,
+            cout,
+            (kh * r, kw * r),
+            (conv.stride[0] * r, conv.stride[1] * r),
+            (conv.padding[0] * r, conv.padding[1] * r),
+            bias=False,
+        ).to(device=conv.weight.device, dtype=conv.weight.dtype)
+        self.conv.weight.data.copy_(weight.reshape(cin, cout, kh * r, kw * r))
+        self.r = r
+        bias = conv.bias.detach() if conv.bias is not None else conv.weight.new_zeros(cout * r * r)
+        self.register_buffer("bias", bias.view(1, cout, 1, r, 1, r).clone())
+
+    def forward(self, x):
+        y = self.conv(x)
+        n, c, h, w = y.shape
+        if torch.jit.is_tracing():
+            # no in-place update of a view in an exported graph
+            return (y.view(n, c, h // self.r, self.r, w // self.r, self.r) + self.bias).view(n, c, h, w)
+        y.view(n, c, h // self.r, self.r, w // self.r, self.r).add_(self.bias)
+        return y
+
+
+@torch.no_grad()
+def optimize_for_inference(module):
+    """
+    Fold and fuse the inference-only equivalents into a loaded module, in place
+
+    - ResConv (a conv, a beta and a relu): beta is folded into the conv weights
+    - nn.Sequential(ConvTranspose2d, PixelShuffle): fused into one ConvTranspose2d, see ShuffleConvTranspose2d
+
+    The fused module has another state dict, load the weights before optimizing.
+
+    :param module: The module, e.g. IFNet or DRBA
+    :return: The module
+    """
+    for name, child in module.named_children():
+        if (
+            isinstance(child, nn.Sequential)
+            and len(child) == 2
+            and isinstance(child[0], nn.ConvTranspose2d)
+            and isinstance(child[1], nn.PixelShuffle)
+        ):
+            setattr(module, name, ShuffleConvTranspose2d(child[0], child[1].upscale_factor))
+        elif isinstance(getattr(child, "conv", None), nn.Conv2d) and isinstance(
+            getattr(child, "beta", None), torch.Tensor
+        ):
+            setattr(module, name, FoldedResConv(child.conv, child.beta, child.relu))
+        else:
+            optimize_for_inference(child)
+    return module
@@ -0,0 +1,69 @@
+# type: ignore
+import torch
+import torch.nn as nn
+
+from ccvfi.arch.arch_utils.fuse import optimize_for_inference
+
+
+def get_flow_blocks(module):
+    """
+    :param module: The module, e.g. IFNet or DRBA
+    :return: The IFBlocks of the module, the modules with a conv0, a convblock and a lastconv
+    """
+    return [m for m in module.modules() if all(hasattr(m, n) for n in ("conv0", "convblock", "lastconv"))]
+
+
+def get_engine():
+    """
+    :return: The quantized engine of this cpu, x86 / fbgemm on x86, qnnpack on arm
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise ValueError("No quantized engine is supported on this platform")
+
+
+@torch.no_grad()
+def prepare_int8(module, engine=None):
+    """
+    Replace the conv stack (conv0 + convblock) of each IFBlock with an observed FX graph, in place
+
+    The ResConv betas are folded first, so that a ResConv is a quantized conv + add + leaky relu. The stack is
+    quantized at its input and dequantized at its output, the lastconv, the warps and the blend stay in float.
+    Run the module on calibration inputs, then call convert_int8.
+
+    :param module: The float32 module on cpu, e.g. IFNet or DRBA
+    :param engine: The quantized engine. If None, see get_engine
+    :return: The module
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    engine = engine or get_engine()
+    torch.backends.quantized.engine = engine
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+
+    optimize_for_inference(module)
+    for block in get_flow_blocks(module):
+        # conv0 is nn.Sequential(conv(in_planes, c // 2, 3, 2, 1), ...), conv is nn.Sequential(Conv2d, LeakyReLU)
+        in_planes = block.conv0[0][0].in_channels
+        stack = nn.Sequential(block.conv0, block.convblock).eval()
+        block.conv0 = prepare_fx(stack, qconfig_mapping, (torch.randn(1, in_planes, 32, 32),))
+        block.convblock = nn.Identity()
+    return module
+
+
+@torch.no_grad()
+def convert_int8(module):
+    """
+    Convert the observed conv stacks of prepare_int8 to int8, in place
+
+    :param module: The calibrated module
+    :return: The module
+    """
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    for block in get_flow_blocks(module):
+        block.conv0 = convert_fx(block.conv0)
+    return module
@@ -6,10 +6,12 @@
 
 import torch
 
+from ccvfi.util.cache import LRUCache
+
 ##########################################################
 
-grid_cache = {}
-batch_cache = {}
+# (N, H, W, device, dtype) -> pixel grid and batch offsets, bounded so that many resolutions do not leak memory
+grid_cache = LRUCache(maxsize=8)
 torch.set_float32_matmul_precision("medium")
 torch.set_grad_enabled(False)
 
@@ -29,38 +31,113 @@ def softsplat(tenIn: torch.Tensor, tenFlow: torch.Tensor, tenMetric: torch.Tenso
     if mode_main in ["linear", "soft"]:
         assert tenMetric is not None
 
-    mode_to_operation = {
-        "avg": lambda: torch.cat(
-            [
-                tenIn,
-                tenIn.new_ones([tenIn.shape[0], 1, tenIn.shape[2], tenIn.shape[3]]),
-            ],
-            1,
-        ),
-        "linear": lambda: torch.cat([tenIn * tenMetric, tenMetric], 1),
-        "soft": lambda: torch.cat([tenIn * tenMetric.exp(), tenMetric.exp()], 1),
+    # the per-pixel weight splatted with the input and accumulated into the normalization channel,
+    # avg splats a weight of one without materializing a ones channel
+    mode_to_weight = {
+        "avg": lambda: None,
+        "linear": lambda: tenMetric,
+        "soft": lambda: tenMetric.exp(),
     }
 
-    if mode_main in mode_to_operation:
-        tenIn = mode_to_operation[mode_main]()
+    if mode_main == "sum":
+        return splat(tenIn, tenFlow)
+
+    tenOut, tenNormalize = splat(tenIn, tenFlow, mode_to_weight[mode_main](), normalize=True)
 
-    tenOut = softsplat_func.apply(tenIn, tenFlow)
+    normalize_modes = {
+        None: lambda x: x + 0.0000001,
+        "addeps": lambda x: x + 0.0000001,
+        "zeroeps": lambda x: torch.where(x == 0.0, torch.tensor(1.0, device=x.device), x),
+        "clipeps": lambda x: x.clip(0.0000001, None),
+    }
 
-    if mode_main in ["avg", "linear", "soft"]:
-        tenNormalize = tenOut[:, -1:, :, :]
+    if mode_sub in normalize_modes:
+        tenNormalize = normalize_modes[mode_sub](tenNormalize)
 
-        normalize_modes = {
-            None: lambda x: x + 0.0000001,
-            "addeps": lambda x: x + 0.0000001,
-            "zeroeps": lambda x: torch.where(x == 0.0, torch.tensor(1.0, device=x.device), x),
-            "clipeps": lambda x: x.clip(0.0000001, None),
-        }
+    return tenOut / tenNormalize
 
-        if mode_sub in normalize_modes:
-            tenNormalize = normalize_modes[mode_sub](tenNormalize)
 
-        tenOut = tenOut[:, :-1, :, :] / tenNormalize
+def _get_grid(N: int, H: int, W: int, device: torch.device, dtype: torch.dtype):
+    key = (N, H, W, device, dtype)
+    grid = grid_cache.get(key)
+    if grid is None:
+        gridY, gridX = torch.meshgrid(
+            torch.arange(H, device=device, dtype=dtype),
+            torch.arange(W, device=device, dtype=dtype),
+            indexing="ij",
+        )
+        # the first linear index of every sample in the flattened (N * H * W) output
+        offset = (torch.arange(N, device=device, dtype=torch.long) * (H * W)).view(N, 1, 1)
+        grid = (gridX.view(1, H, W), gridY.view(1, H, W), offset)
+        grid_cache.put(key, grid)
+    return grid
 
+
+@torch.inference_mode()
+def splat(tenIn: torch.Tensor, tenFlow: torch.Tensor, tenWeight: torch.Tensor = None, normalize: bool = False):
+    """
+    Bilinear forward splatting of all the four corners in one fused scatter
+
+    The corners outside the frame and the pixels with a non-finite flow are scattered as zeros into the index 0
+    instead of being masked out, so the shapes are static and no device sync happens.
+
+    :param tenIn: Input tensor of shape [N, C, H, W]
+    :param tenFlow: Flow tensor of shape [N, 2, H, W]
+    :param tenWeight: Optional per-pixel weight of shape [N, 1, H, W], multiplied into the splatted input
+    :param normalize: Also return the splatted weights [N, 1, H, W] (of one if tenWeight is None)
+    :return: Output tensor of shape [N, C, H, W], and the splatted weights if normalize
+    """
+    N, C, H, W = tenIn.shape
+    dtype = tenIn.dtype
+    gridX, gridY, offset = _get_grid(N, H, W, tenIn.device, dtype)
+
+    fltX = gridX + tenFlow[:, 0]
+    fltY = gridY + tenFlow[:, 1]
+    finite = torch.isfinite(fltX) & torch.isfinite(fltY)
+    # park the non-finite pixels outside the frame, all their corners are invalid
+    fltX = torch.where(finite, fltX, torch.full_like(fltX, -2))
+    fltY = torch.where(finite, fltY, torch.full_like(fltY, -2))
+
+    floorX = torch.floor(fltX)
+    floorY = torch.floor(fltY)
+    intX = floorX.long()
+    intY = floorY.long()
+    # the fractional offsets, the weights of the NW, NE, SW and SE corners follow from them
+    fracX = fltX - floorX
+    fracY = fltY - floorY
+
+    cornerX = torch.stack((intX, intX + 1, intX, intX + 1))  # [4, N, H, W]
+    cornerY = torch.stack((intY, intY, intY + 1, intY + 1))
+    weight = torch.stack(
+        (
+            (1 - fracX) * (1 - fracY),
+            fracX * (1 - fracY),
+            (1 - fracX) * fracY,
+            fracX * fracY,
+        )
+    )
+    valid = (cornerX >= 0) & (cornerX < W) & (cornerY >= 0) & (cornerY < H)
+    index = torch.where(valid, offset + cornerY * W + cornerX, torch.zeros_like(cornerX))
+
+    # the metric is applied once, through the corner weights of both the data and the normalization channels
+    if tenWeight is not None:
+        weight = weight * tenWeight[:, 0]
+
+    # [N, C, H, W] -> [N, H, W, C], with the weight of one in the normalization channel
+    channels = C + 1 if normalize else C
+    vals = tenIn.new_empty((4, N, H, W, channels))
+    vals[..., :C] = tenIn.permute(0, 2, 3, 1).unsqueeze(0) * weight.unsqueeze(-1)
+    if normalize:
+        vals[..., C] = weight
+    # zeroed after the products, a non-finite input or metric (inf * 0) of an invalid corner never reaches the index 0
+    vals = torch.where(valid.unsqueeze(-1), vals, vals.new_zeros(()))
+
+    tenOut = tenIn.new_zeros((N * H * W, channels))
+    tenOut.index_add_(0, index.reshape(-1), vals.reshape(-1, channels))
+    tenOut = tenOut.view(N, H, W, channels).permute(0, 3, 1, 2)
+
+    if normalize:
+        return tenOut[:, :C], tenOut[:, C:]
     return tenOut
 
 
@@ -78,106 +155,4 @@ class softsplat_func(torch.autograd.Function):
         Returns:
             torch.Tensor: Output tensor of shape [N, C, H, W]
         """
-        N, C, H, W = tenIn.size()
-        device = tenIn.device
-        origdtype = tenIn.dtype
-
-        # Initialize output tensor
-        tenOut = torch.zeros_like(tenIn)
-
-        key = (H, W, device, origdtype)
-        if key not in grid_cache:
-            # Create meshgrid of pixel coordinates
-            gridY, gridX = torch.meshgrid(
-                torch.arange(H, device=device, dtype=origdtype),
-                torch.arange(W, device=device, dtype=origdtype),
-                indexing="ij",
-            )  # [H, W]
-            # Cache the grids
-            grid_cache[key] = (
-                gridY.unsqueeze(0).unsqueeze(0).expand(N, 1, H, W),
-                gridX.unsqueeze(0).unsqueeze(0).expand(N, 1, H, W),
-            )
-
-        if key not in batch_cache:
-            batch_cache[key] = torch.arange(N, device=device).view(N, 1, 1).expand(N, H, W).reshape(-1)
-
-        gridY, gridX = grid_cache[key]
-        batch_indices = batch_cache[key]
-
-        # Compute fltX and fltY
-        fltX = gridX + tenFlow[:, 0:1, :, :]
-        fltY = gridY + tenFlow[:, 1:2, :, :]
-
-        # Flatten variables
-        fltX_flat = fltX.reshape(-1)
-        fltY_flat = fltY.reshape(-1)
-        tenIn_flat = tenIn.permute(0, 2, 3, 1).reshape(-1, C)
-
-        # Finite mask
-        finite_mask = torch.isfinite(fltX_flat) & torch.isfinite(fltY_flat)
-        if not finite_mask.any():
-            return tenOut
-
-        fltX_flat = fltX_flat[finite_mask]
-        fltY_flat = fltY_flat[finite_mask]
-        tenIn_flat = tenIn_flat[finite_mask]
-        batch_indices = batch_indices[finite_mask]
-
-        # Compute integer positions
-        intNW_X = torch.floor(fltX_flat).to(dtype=torch.int32)
-        intNW_Y = torch.floor(fltY_flat).to(dtype=torch.int32)
-        intNE_X = intNW_X + 1
-        intNE_Y = intNW_Y
-        intSW_X = intNW_X
-        intSW_Y = intNW_Y + 1
-        intSE_X = intNW_X + 1
-        intSE_Y = intNW_Y + 1
-
-        # Compute weights
-        fltNW = (intSE_X - fltX_flat) * (intSE_Y - fltY_flat)
-        fltNE = (fltX_flat - intSW_X) * (intSW_Y - fltY_flat)
-        fltSW = (intNE_X - fltX_flat) * (fltY_flat - intNE_Y)
-        fltSE = (fltX_flat - intNW_X) * (fltY_flat - intNW_Y)
-
-        # Prepare output tensor flat
-        tenOut_flat = tenOut.permute(0, 2, 3, 1).reshape(-1, C)
-
-        # Define positions and weights
-        positions = [
-            (intNW_X, intNW_Y, fltNW),
-            (intNE_X, intNE_Y, fltNE),
-            (intSW_X, intSW_Y, fltSW),
-            (intSE_X, intSE_Y, fltSE),
-        ]
-
-        H, W = int(H), int(W)
-
-        for intX, intY, weight in positions:
-            # Valid indices within image bounds
-            valid_mask = (intX >= 0) & (intX < W) & (intY >= 0) & (intY < H)
-            if not valid_mask.any():
-                continue
-
-            idx_b = batch_indices[valid_mask]
-            idx_x = intX[valid_mask]
-            idx_y = intY[valid_mask]
-            w = weight[valid_mask]
-            vals = tenIn_flat[valid_mask] * w.unsqueeze(1)
-
-            # Compute linear indices
-            idx_NHW = idx_b * H * W + idx_y * W + idx_x
-
-            # Accumulate values using index_add_
-            tenOut_flat.index_add_(0, idx_NHW, vals)
-
-        # Reshape tenOut back to [N, C, H, W]
-        tenOut = tenOut_flat.view(N, H, W, C).permute(0, 3, 1, 2)
-
-        return tenOut
-
-    # end
-
-    # end
-
-    # end
+        return splat(tenIn, tenFlow)
@@ -0,0 +1,158 @@
+# type: ignore
+import math
+
+import torch
+
+from ccvfi.arch.arch_utils.warplayer import warp_group
+
+# rough number of full resolution channels alive per pixel of a tile while it is refined by IFBlock 1 ~ 4:
+# the cropped inputs (52), the block input (56), the warped frames and features (38), the upsampled block output (13)
+# and the temporaries of interpolate / cat, the conv activations of the blocks are at 1/4 resolution or lower
+TILE_CHANNELS = 256
+
+# the receptive field radius of Head is 7 pixels, an even margin keeps the stride 2 phase of the crops
+ENCODE_MARGIN = 16
+
+
+def get_align(scale_list) -> int:
+    """
+    The alignment of the tiles, IFBlock 1 ~ 4 downsample their input by scale_list[i] then by 4 in conv0
+
+    :param scale_list: The scale list of IFNet
+    :return:
+    """
+    return max(int(round(max(scale_list[1:], default=1) * 4)), 2)
+
+
+def estimate_tile(max_memory: int, batch: int, dtype: torch.dtype, overlap: int) -> int:
+    """
+    Estimate the largest tile size whose refinement fits in max_memory
+
+    :param max_memory: The memory budget of a tile in MiB
+    :param batch: The batch size
+    :param dtype: The dtype of the inference
+    :param overlap: The overlap added on each side of a tile
+    :return:
+    """
+    bytes_per_pixel = TILE_CHANNELS * batch * torch.empty((), dtype=dtype).element_size()
+    crop = int(math.sqrt(max_memory * 1024 * 1024 / bytes_per_pixel))
+    return max(crop - 2 * overlap, 1)
+
+
+def _ceil_to(x: int, align: int) -> int:
+    return int(math.ceil(x / align) * align)
+
+
+def _tile_ranges(size: int, tile: int, overlap: int):
+    """
+    Yield (crop start, crop end) along one axis, the cores of the crops cover [0, size) without gaps
+    """
+    for start in range(0, size, tile):
+        yield max(start - overlap, 0), min(start + tile + overlap, size)
+
+
+def _ramp(start: int, end: int, size: int, band: int, device, dtype) -> torch.Tensor:
+    # linear weight over the band shared with the neighbour crops, 1 at the borders of the frame
+    pos = torch.arange(start, end, device=device, dtype=torch.float32) + 0.5
+    w = torch.ones_like(pos)
+    if start > 0:
+        w = torch.minimum(w, (pos - start) / band)
+    if end < size:
+        w = torch.minimum(w, (end - pos) / band)
+    return w.to(dtype)
+
+
+def tiled_encode(encode, img, tile: int) -> torch.Tensor:
+    """
+    Run the Head encoder tile by tile, the result equals the untiled encoding
+
+    :param encode: The Head module
+    :param img: The frame (B, 3, H, W)
+    :param tile: The tile size
+    :return:
+    """
+    _, _, h, w = img.shape
+    tile = _ceil_to(tile, 2)
+    if tile >= h and tile >= w:
+        return encode(img)
+
+    margin = ENCODE_MARGIN
+    feat = None
+    for y in range(0, h, tile):
+        for x in range(0, w, tile):
+            y0, y1 = max(y - margin, 0), min(y + tile + margin, h)
+            x0, x1 = max(x - margin, 0), min(x + tile + margin, w)
+            out = encode(img[:, :, y0:y1, x0:x1])
+            if feat is None:
+                feat = out.new_empty((out.shape[0], out.shape[1], h, w))
+            ty, tx = min(y + tile, h), min(x + tile, w)
+            feat[:, :, y:ty, x:tx] = out[:, :, y - y0 : ty - y0, x - x0 : tx - x0]
+    return feat
+
+
+def refine(blocks, img0, img1, f0, f1, timestep, flow, mask, feat, scale_list, cache=None) -> torch.Tensor:
+    """
+    Refine the coarse flow of IFBlock 0 with the following blocks, then merge the warped frames
+
+    :param cache: The LRUCache of the backward warp grids
+    :return: The merged frame (B, C, H, W)
+    """
+    for i, block in enumerate(blocks, 1):
+        (warped_img0, wf0), (warped_img1, wf1) = warp_group(
+            [([img0, f0], flow[:, :2]), ([img1, f1], flow[:, 2:4])], cache
+        )
+        fd, mask, feat = block(
+            torch.cat((warped_img0[:, :3], warped_img1[:, :3], wf0, wf1, timestep, mask, feat), 1),
+            flow,
+            scale=scale_list[i],
+        )
+        flow = flow + fd
+    (warped_img0,), (warped_img1,) = warp_group([([img0], flow[:, :2]), ([img1], flow[:, 2:4])], cache)
+    mask = torch.sigmoid(mask)
+    return warped_img0 * mask + warped_img1 * (1 - mask)
+
+
+def tiled_refine(
+    blocks, img0, img1, f0, f1, timestep, flow, mask, feat, scale_list, tile: int, overlap: int, cache=None
+) -> torch.Tensor:
+    """
+    Refine the global coarse flow of IFBlock 0 in overlapping tiles, and feather-blend the merged tiles
+
+    Every tile is refined independently from its crop of the coarse flow, the warps of a tile sample inside its crop,
+    so the overlap should cover the residual motion the refinement blocks correct. The seams are blended with linear
+    weights over the band shared by two neighbour tiles.
+
+    :param blocks: IFBlock 1 ~ 4
+    :param tile: The size of the core of the tiles, rounded up to the alignment of the blocks
+    :param overlap: The overlap added on each side of a tile, rounded up to the alignment of the blocks
+    :param cache: The LRUCache of the backward warp grids
+    :return: The merged frame (B, C, H, W)
+    """
+    b, c, h, w = img0.shape
+    if timestep.shape[0] != b:
+        timestep = timestep.expand(b, -1, -1, -1)
+    if timestep.shape[2:] != img0.shape[2:]:
+        timestep = timestep.expand(-1, -1, h, w)
+
+    align = get_align(scale_list)
+    tile = _ceil_to(tile, align)
+    overlap = _ceil_to(overlap, align) if overlap > 0 else 0
+
+    def _crop(y0, y1, x0, x1):
+        return [t[:, :, y0:y1, x0:x1].expand(b, -1, -1, -1) for t in (img0, img1, f0, f1, timestep, flow, mask, feat)]
+
+    if tile >= h and tile >= w:
+        return refine(blocks, *_crop(0, h, 0, w), scale_list, cache)
+
+    out = img0.new_zeros((b, c, h, w))
+    weight = img0.new_zeros((1, 1, h, w))
+    band = max(2 * overlap, 1)
+    for y0, y1 in _tile_ranges(h, tile, overlap):
+        wy = _ramp(y0, y1, h, band, img0.device, img0.dtype).view(1, 1, -1, 1)
+        for x0, x1 in _tile_ranges(w, tile, overlap):
+            wx = _ramp(x0, x1, w, band, img0.device, img0.dtype).view(1, 1, 1, -1)
+            merged = refine(blocks, *_crop(y0, y1, x0, x1), scale_list, cache)
+            out[:, :, y0:y1, x0:x1] += merged * (wy * wx)
+            weight[:, :, y0:y1, x0:x1] += wy * wx
+
+    return out / weight
@@ -1,33 +1,88 @@
 # type: ignore
 import torch
 
-backwarp_tenGrid = {}
-
-
-def warp(tenInput, tenFlow):
-    k = (str(tenFlow.device), str(tenFlow.size()))
-    if k not in backwarp_tenGrid:
-        tenHorizontal = (
-            torch.linspace(-1.0, 1.0, tenFlow.shape[3], device=tenFlow.device)
-            .view(1, 1, 1, tenFlow.shape[3])
-            .expand(tenFlow.shape[0], -1, tenFlow.shape[2], -1)
-        )
-        tenVertical = (
-            torch.linspace(-1.0, 1.0, tenFlow.shape[2], device=tenFlow.device)
-            .view(1, 1, tenFlow.shape[2], 1)
-            .expand(tenFlow.shape[0], -1, -1, tenFlow.shape[3])
-        )
-        backwarp_tenGrid[k] = torch.cat([tenHorizontal, tenVertical], 1).to(tenFlow.device)
-
-    tenFlow = torch.cat(
-        [
-            tenFlow[:, 0:1, :, :] / ((tenInput.shape[3] - 1.0) / 2.0),
-            tenFlow[:, 1:2, :, :] / ((tenInput.shape[2] - 1.0) / 2.0),
-        ],
-        1,
-    )
+from ccvfi.util.cache import LRUCache
+
+# used when the caller does not own a cache, bounded so that many resolutions do not leak memory
+default_grid_cache = LRUCache(maxsize=16)
+
+
+def is_compiling():
+    """
+    :return: Whether the call is traced by torch.compile / torch.export, False on the torch versions without dynamo
+    """
+    # torch.compiler.is_compiling is torch >= 2.3, torch._dynamo.is_compiling the torch 2.x before it
+    fn = getattr(getattr(torch, "compiler", None), "is_compiling", None)
+    if fn is None:
+        fn = getattr(getattr(torch, "_dynamo", None), "is_compiling", None)
+    return fn is not None and fn()
+
+
+def get_grid(h, w, device, dtype, cache=None):
+    """
+    Get the normalised sampling grid of a size and the factor normalising a flow in pixels, cached per dtype
+
+    :param h: The height
+    :param w: The width
+    :param device: The device
+    :param dtype: The dtype of the warped tensors
+    :param cache: The LRUCache of the grids. If None, use default_grid_cache
+    :return: (1, H, W, 2) grid in [-1, 1] and (2,) flow normalisation factor
+    """
+    if torch.jit.is_tracing() or is_compiling():
+        # traced or compiled (e.g. exported with a dynamic size), the grid is part of the graph and follows h and w
+        tenHorizontal = (torch.arange(w, device=device, dtype=dtype) * (2.0 / (w - 1)) - 1.0).view(1, w).expand(h, w)
+        tenVertical = (torch.arange(h, device=device, dtype=dtype) * (2.0 / (h - 1)) - 1.0).view(h, 1).expand(h, w)
+        norm = torch.stack([torch.as_tensor(2.0 / (w - 1)), torch.as_tensor(2.0 / (h - 1))])
+        norm = norm.to(device=device, dtype=dtype)
+        return torch.stack((tenHorizontal, tenVertical), -1).unsqueeze(0), norm
 
-    g = (backwarp_tenGrid[k] + tenFlow).permute(0, 2, 3, 1).to(tenInput.dtype)
-    return torch.nn.functional.grid_sample(
-        input=tenInput, grid=g.to(tenInput.device), mode="bilinear", padding_mode="border", align_corners=True
+    cache = cache if cache is not None else default_grid_cache
+    key = (h, w, device, dtype)
+    grid = cache.get(key)
+    if grid is None:
+        tenHorizontal = torch.linspace(-1.0, 1.0, w, device=device).view(1, w).expand(h, w)
+        tenVertical = torch.linspace(-1.0, 1.0, h, device=device).view(h, 1).expand(h, w)
+        norm = torch.tensor([2.0 / max(w - 1, 1), 2.0 / max(h - 1, 1)], device=device)
+        grid = (torch.stack((tenHorizontal, tenVertical), -1).unsqueeze(0).to(dtype), norm.to(dtype))
+        cache.put(key, grid)
+    return grid
+
+
+def warp(tenInput, tenFlow, cache=None):
+    """
+    Backward warp the input with a flow in pixels
+
+    :param tenInput: (N, C, H, W) tensor
+    :param tenFlow: (N, 2, H, W) flow
+    :param cache: The LRUCache of the grids. If None, use default_grid_cache
+    :return:
+    """
+    grid, norm = get_grid(tenInput.shape[2], tenInput.shape[3], tenInput.device, tenInput.dtype, cache)
+    g = grid + tenFlow.permute(0, 2, 3, 1).to(tenInput.dtype) * norm
+    out = torch.nn.functional.grid_sample(
+        input=tenInput, grid=g, mode="bilinear", padding_mode="border", align_corners=True
     )
+    # grid_sample returns NCHW, keep a channels_last forward in NHWC
+    if tenInput.dim() == 4 and tenInput.is_contiguous(memory_format=torch.channels_last):
+        out = out.contiguous(memory_format=torch.channels_last)
+    return out
+
+
+def warp_group(groups, cache=None):
+    """
+    Backward warp groups of tensors in a single grid_sample call, the tensors of a group share the flow of the group
+
+    The tensors of a group are concatenated along the channels, the groups along the batch, so the groups should have
+    the same number of channels, e.g. [([img0, f0], flow[:, :2]), ([img1, f1], flow[:, 2:4])].
+
+    :param groups: list of (list of (N, C_i, H, W) tensors, (N, 2, H, W) flow)
+    :param cache: The LRUCache of the grids. If None, use default_grid_cache
+    :return: list of the lists of the warped tensors
+    """
+    inputs = [torch.cat(tensors, 1) if len(tensors) > 1 else tensors[0] for tensors, _ in groups]
+    if any(x.shape != inputs[0].shape for x in inputs):
+        outs = [warp(x, flow, cache) for x, (_, flow) in zip(inputs, groups)]
+    else:
+        outs = warp(torch.cat(inputs, 0), torch.cat([flow for _, flow in groups], 0), cache).chunk(len(groups), 0)
+    return [list(out.split([t.shape[1] for t in tensors], 1)) for out, (tensors, _) in zip(outs, groups)]
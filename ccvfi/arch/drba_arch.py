@@ -5,8 +5,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ccvfi.arch import ARCH_REGISTRY
-from ccvfi.arch.arch_utils.warplayer import warp
+from ccvfi.arch.arch_utils.tile import tiled_encode, tiled_refine
+from ccvfi.arch.arch_utils.warplayer import warp_group
 from ccvfi.type import ArchType
+from ccvfi.util.cache import LRUCache
 from ccvfi.util.misc import distance_calculator
 
 
@@ -23,6 +25,8 @@ class DRBA(nn.Module):
         self.block3 = IFBlock(8 + 4 + 8 + 32, c=64)
         self.block4 = IFBlock(8 + 4 + 8 + 32, c=32)
         self.encode = Head()
+        # backward warp grids of the recent sizes, per dtype
+        self.grid_cache = LRUCache(maxsize=16)
         if support_cupy:
             from ccvfi.arch.arch_utils.softsplat import softsplat as fwarp
 
@@ -32,7 +36,33 @@ class DRBA(nn.Module):
 
             self.fwarp = fwarp
 
-    def inference(self, x, timestep=0.5, scale_list=None, fastmode=True, ensemble=False, f0=None, f1=None):
+    def _format(self, x):
+        # follow the memory format of the weights, the frames are split from a 5D input
+        if self.encode.cnn0.weight.is_contiguous(memory_format=torch.channels_last):
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def _encode(self, img, tile=None):
+        return self.encode(img) if tile is None else tiled_encode(self.encode, img, tile)
+
+    def inference(
+        self,
+        x,
+        timestep=0.5,
+        scale_list=None,
+        fastmode=True,
+        ensemble=False,
+        f0=None,
+        f1=None,
+        tile=None,
+        tile_overlap=0,
+        flow_tol=None,
+    ):
+        """
+        :param scale_list: The downscale factor of each level, a shorter list runs fewer refinement levels
+        :param flow_tol: If not None, skip the remaining levels once the flow update is lower than this number of
+                         pixels, see IFNet.forward
+        """
         if scale_list is None:
             scale_list = [16, 8, 4, 2, 1]
         channel = x.shape[1] // 2
@@ -40,26 +70,45 @@ class DRBA(nn.Module):
         img1 = x[:, channel:]
         if not torch.is_tensor(timestep):
             timestep = (x[:, :1].clone() * 0 + 1) * timestep
-        f0 = self.encode(img0[:, :3]) if f0 is None else f0
-        f1 = self.encode(img1[:, :3]) if f1 is None else f1
+        f0 = self._encode(img0[:, :3], tile) if f0 is None else f0
+        f1 = self._encode(img1[:, :3], tile) if f1 is None else f1
         flow_list = []
         merged = []
         mask_list = []
         warped_img0 = img0
         warped_img1 = img1
+        # the warped features, bound before the refinement blocks read them
+        wf0 = f0
+        wf1 = f1
         flow = None
         mask = None
         block = [self.block0, self.block1, self.block2, self.block3, self.block4]
-        for i in range(5):
+        levels = len(scale_list)
+        for i in range(levels):
             if flow is None:
                 flow, mask, feat = block[i](
                     torch.cat((img0[:, :3], img1[:, :3], f0, f1, timestep), 1), None, scale=scale_list[i]
                 )
                 if ensemble:
                     print("warning: ensemble is not supported since RIFEv4.21")
+                if tile is not None:
+                    merged = tiled_refine(
+                        block[1:levels],
+                        img0,
+                        img1,
+                        f0,
+                        f1,
+                        timestep,
+                        flow,
+                        mask,
+                        feat,
+                        scale_list,
+                        tile,
+                        tile_overlap,
+                        self.grid_cache,
+                    )
+                    return merged, [flow]
             else:
-                wf0 = warp(f0, flow[:, :2])
-                wf1 = warp(f1, flow[:, 2:4])
                 fd, m0, feat = block[i](
                     torch.cat((warped_img0[:, :3], warped_img1[:, :3], wf0, wf1, timestep, mask, feat), 1),
                     flow,
@@ -72,11 +121,25 @@ class DRBA(nn.Module):
                 flow = flow + fd
             mask_list.append(mask)
             flow_list.append(flow)
-            warped_img0 = warp(img0, flow[:, :2])
-            warped_img1 = warp(img1, flow[:, 2:4])
+            # stop once the flow update of a refinement block is below the tolerance (in pixels)
+            last = i == levels - 1
+            if flow_tol is not None and not last and i > 0:
+                # the decision needs the update on the host: one device sync per checked level, none without flow_tol
+                last = bool((fd.abs().float().flatten(1).mean(1).max() < flow_tol).item())
+            if not last:
+                # the frames and the features share the flow, one grid_sample for the four of them
+                (warped_img0, wf0), (warped_img1, wf1) = warp_group(
+                    [([img0, f0], flow[:, :2]), ([img1, f1], flow[:, 2:4])], self.grid_cache
+                )
+            else:
+                (warped_img0,), (warped_img1,) = warp_group(
+                    [([img0], flow[:, :2]), ([img1], flow[:, 2:4])], self.grid_cache
+                )
             merged.append((warped_img0, warped_img1))
+            if last:
+                break
         mask = torch.sigmoid(mask)
-        merged[4] = warped_img0 * mask + warped_img1 * (1 - mask)
+        merged[-1] = warped_img0 * mask + warped_img1 * (1 - mask)
         if not fastmode:
             print("contextnet is removed")
             """
@@ -84,16 +147,16 @@ class DRBA(nn.Module):
             c1 = self.contextnet(img1, flow[:, 2:4])
             tmp = self.unet(img0, img1, warped_img0, warped_img1, mask, flow, c0, c1)
             res = tmp[:, :3] * 2 - 1
-            merged[4] = torch.clamp(merged[4] + res, 0, 1)
+            merged[-1] = torch.clamp(merged[-1] + res, 0, 1)
             """
-        return merged[4], flow_list
+        return merged[-1], flow_list
 
-    def calc_flow(self, a, b, scale, f0=None, f1=None):
+    def calc_flow(self, a, b, scale, f0=None, f1=None, tile=None):
         scale_list = [16 / scale, 8 / scale, 4 / scale, 2 / scale, 1 / scale]
         # calc flow at the lowest resolution (significantly faster with almost no quality loss).
         timestep = (a[:, :1].clone() * 0 + 1) * 0.5
-        f0 = self.encode(a[:, :3]) if f0 is None else f0
-        f1 = self.encode(b[:, :3]) if f1 is None else f1
+        f0 = self._encode(a[:, :3], tile) if f0 is None else f0
+        f1 = self._encode(b[:, :3], tile) if f1 is None else f1
         flow, _, _ = self.block0(torch.cat((a[:, :3], b[:, :3], f0, f1, timestep), 1), None, scale=scale_list[0])
 
         # get flow flow0.5 -> 0/1
@@ -124,13 +187,35 @@ class DRBA(nn.Module):
 
         return flow01, flow10, f0, f1
 
-    def forward(self, x, minus_t, zero_t, plus_t, _left_scene, _right_scene, _scale, _reuse=None):
-        _I0, _I1, _I2 = x[:, 0], x[:, 1], x[:, 2]
-        flow10, flow01, f1, f0 = self.calc_flow(_I1, _I0, _scale) if not _reuse else _reuse
+    def forward(
+        self,
+        x,
+        minus_t,
+        zero_t,
+        plus_t,
+        _left_scene,
+        _right_scene,
+        _scale,
+        _reuse=None,
+        tile=None,
+        tile_overlap=0,
+        refine_scales=(16, 8, 4, 2, 1),
+        flow_tol=None,
+    ):
+        """
+        :param refine_scales: The downscale factor of each level of the interpolation, divided by _scale
+        :param flow_tol: If not None, skip the remaining levels once the flow update is lower than this number of
+                         pixels, see IFNet.forward
+        :param tile: If not None, refine the flow of the interpolated frames in overlapping tiles of this size,
+                     see ccvfi.arch.arch_utils.tile.tiled_refine. The flow of calc_flow is always global
+        :param tile_overlap: The overlap added on each side of a tile
+        """
+        _I0, _I1, _I2 = self._format(x[:, 0]), self._format(x[:, 1]), self._format(x[:, 2])
+        flow10, flow01, f1, f0 = self.calc_flow(_I1, _I0, _scale, tile=tile) if not _reuse else _reuse
         if _reuse is None:
-            flow12, flow21, f1, f2 = self.calc_flow(_I1, _I2, _scale)
+            flow12, flow21, f1, f2 = self.calc_flow(_I1, _I2, _scale, tile=tile)
         else:
-            flow12, flow21, f1, f2 = self.calc_flow(_I1, _I2, _scale, f0=_reuse[2])
+            flow12, flow21, f1, f2 = self.calc_flow(_I1, _I2, _scale, f0=_reuse[2], tile=tile)
 
         # Compute the distance using the optical flow and distance calculator
         d10 = distance_calculator(flow10) + 1e-4
@@ -140,26 +225,15 @@ class DRBA(nn.Module):
         drm10 = d10 / (d10 + d12)
         drm12 = d12 / (d10 + d12)
 
-        ones_mask = torch.ones_like(drm10, device=drm10.device)
-
-        def calc_drm_rife(_t):
+        def calc_drm_rife(_drm, _flow, _ts):
             # The distance ratio map (drm) is initially aligned with I1.
             # To align it with I0 and I2, we need to warp the drm maps.
             # Note: 1. To reverse the direction of the drm map, use 1 - drm and then warp it.
             # 2. For RIFE, drm should be aligned with the time corresponding to the intermediate frame.
-            _drm01r = self.fwarp(1 - drm10, flow10 * ((1 - drm10) * 2) * _t, None, strMode="avg")
-            _drm21r = self.fwarp(1 - drm12, flow12 * ((1 - drm12) * 2) * _t, None, strMode="avg")
-
-            self.warped_ones_mask01r = self.fwarp(ones_mask, flow10 * ((1 - drm10) * 2) * _t, None, strMode="avg")
-            self.warped_ones_mask21r = self.fwarp(ones_mask, flow12 * ((1 - drm12) * 2) * _t, None, strMode="avg")
-
-            holes01r = self.warped_ones_mask01r < 0.999
-            holes21r = self.warped_ones_mask21r < 0.999
-
-            _drm01r[holes01r] = _drm01r[holes01r]
-            _drm21r[holes21r] = _drm21r[holes21r]
-
-            return _drm01r, _drm21r
+            # All the timesteps of one side are splatted in one batched call, the holes of the avg splat stay 0.
+            _flows = torch.cat([_flow * ((1 - _drm) * 2) * _t for _t in _ts], 0)
+            _drms = self.fwarp((1 - _drm).repeat(len(_ts), 1, 1, 1), _flows, None, strMode="avg")
+            return list(_drms.chunk(len(_ts), 0))
 
         output1, output2 = [], []
 
@@ -172,25 +246,34 @@ class DRBA(nn.Module):
                 zero_t = np.append(zero_t, 0)
             plus_t = []
 
-        disable_drm = False
+        minus_t = [-t for t in minus_t]
+        # the timesteps inferred on each side, t == 1 repeats the outer frame
+        minus_todo = [t for t in minus_t if t != 1]
+        plus_todo = [t for t in plus_t if t != 1]
+
         if (_left_scene and not _right_scene) or (not _left_scene and _right_scene):
-            drm01r, drm21r = (ones_mask.clone() * 0.5 for _ in range(2))
-            drm01r = torch.nn.functional.interpolate(drm01r, size=_I0.shape[2:], mode="bilinear", align_corners=False)
-            drm21r = torch.nn.functional.interpolate(drm21r, size=_I0.shape[2:], mode="bilinear", align_corners=False)
-            disable_drm = True
+            drm = torch.full_like(drm10, 0.5)
+            drm = torch.nn.functional.interpolate(drm, size=_I0.shape[2:], mode="bilinear", align_corners=False)
+            drm01r = [drm] * len(minus_todo)
+            drm21r = [drm] * len(plus_todo)
+        else:
+            # each side only splats the ratio map it reads
+            drm01r = calc_drm_rife(drm10, flow10, minus_todo) if len(minus_todo) > 0 else []
+            drm21r = calc_drm_rife(drm12, flow12, plus_todo) if len(plus_todo) > 0 else []
+        drm01r, drm21r = iter(drm01r), iter(drm21r)
 
         for t in minus_t:
-            t = -t
             if t == 1:
                 output1.append(_I0)
                 continue
-            if not disable_drm:
-                drm01r, _ = calc_drm_rife(t)
             output1.append(
                 self.inference(
                     torch.cat((_I1, _I0), 1),
-                    timestep=t * (2 * drm01r),
-                    scale_list=[16 / _scale, 8 / _scale, 4 / _scale, 2 / _scale, 1 / _scale],
+                    timestep=t * (2 * next(drm01r)),
+                    scale_list=[s / _scale for s in refine_scales],
+                    tile=tile,
+                    tile_overlap=tile_overlap,
+                    flow_tol=flow_tol,
                 )[0]
             )
         for _ in zero_t:
@@ -199,13 +282,14 @@ class DRBA(nn.Module):
             if t == 1:
                 output2.append(_I2)
                 continue
-            if not disable_drm:
-                _, drm21r = calc_drm_rife(t)
             output2.append(
                 self.inference(
                     torch.cat((_I1, _I2), 1),
-                    timestep=t * (2 * drm21r),
-                    scale_list=[16 / _scale, 8 / _scale, 4 / _scale, 2 / _scale, 1 / _scale],
+                    timestep=t * (2 * next(drm21r)),
+                    scale_list=[s / _scale for s in refine_scales],
+                    tile=tile,
+                    tile_overlap=tile_overlap,
+                    flow_tol=flow_tol,
                 )[0]
             )
 
@@ -293,14 +377,18 @@ class IFBlock(nn.Module):
         self.lastconv = nn.Sequential(nn.ConvTranspose2d(c, 4 * 13, 4, 2, 1), nn.PixelShuffle(2))
 
     def forward(self, x, flow=None, scale=1):
-        x = F.interpolate(x, scale_factor=1.0 / scale, mode="bilinear", align_corners=False)
+        # a bilinear resampling to the same size is the identity, skipped at scale 1
+        if scale != 1:
+            x = F.interpolate(x, scale_factor=1.0 / scale, mode="bilinear", align_corners=False)
         if flow is not None:
-            flow = F.interpolate(flow, scale_factor=1.0 / scale, mode="bilinear", align_corners=False) * 1.0 / scale
+            if scale != 1:
+                flow = F.interpolate(flow, scale_factor=1.0 / scale, mode="bilinear", align_corners=False) * 1.0 / scale
             x = torch.cat((x, flow), 1)
         feat = self.conv0(x)
         feat = self.convblock(feat)
         tmp = self.lastconv(feat)
-        tmp = F.interpolate(tmp, scale_factor=scale, mode="bilinear", align_corners=False)
+        if scale != 1:
+            tmp = F.interpolate(tmp, scale_factor=scale, mode="bilinear", align_corners=False)
         flow = tmp[:, :4] * scale
         mask = tmp[:, 4:5]
         feat = tmp[:, 5:]
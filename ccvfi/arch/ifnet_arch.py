@@ -4,8 +4,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ccvfi.arch import ARCH_REGISTRY
-from ccvfi.arch.arch_utils.warplayer import warp
+from ccvfi.arch.arch_utils.tile import tiled_encode, tiled_refine
+from ccvfi.arch.arch_utils.warplayer import warp_group
 from ccvfi.type import ArchType
+from ccvfi.util.cache import LRUCache
+from ccvfi.util.misc import distance_calculator
 
 
 @ARCH_REGISTRY.register(name=ArchType.IFNET)
@@ -18,8 +21,91 @@ class IFNet(nn.Module):
         self.block3 = IFBlock(8 + 4 + 8 + 32, c=64)
         self.block4 = IFBlock(8 + 4 + 8 + 32, c=32)
         self.encode = Head()
+        # backward warp grids of the recent sizes, per dtype
+        self.grid_cache = LRUCache(maxsize=16)
 
-    def forward(self, x, timestep=0.5, scale_list=None, fastmode=True, ensemble=False):
+    def encode_frame(self, img, scale_list=None, tile=None):
+        """
+        Precompute the per-frame part of forward: the Head features and the downsampled block0 input.
+        The result can be cached and fed back to forward as ctx0 / ctx1, every frame is used by two pairs.
+
+        :param img: The padded frame (B, C, H, W)
+        :param scale_list: The scale list of forward
+        :param tile: If not None, run the Head encoder in tiles of this size
+        :return: dict with the padded frame, its Head features and its pyramid (scale -> downsampled img + feat)
+        """
+        if scale_list is None:
+            scale_list = [16, 8, 4, 2, 1]
+        feat = self.encode(img[:, :3]) if tile is None else tiled_encode(self.encode, img[:, :3], tile)
+        ctx = {"img": img, "feat": feat, "pyramid": {}}
+        self._get_pyramid(ctx, scale_list[0])
+        return ctx
+
+    @staticmethod
+    def _get_pyramid(ctx, scale):
+        if scale not in ctx["pyramid"]:
+            ctx["pyramid"][scale] = F.interpolate(
+                torch.cat((ctx["img"][:, :3], ctx["feat"]), 1),
+                scale_factor=1.0 / scale,
+                mode="bilinear",
+                align_corners=False,
+            )
+        return ctx["pyramid"][scale]
+
+    def _block0_input(self, ctx0, ctx1, timestep, b, scale):
+        # interpolation is channel-wise, the downsampled block0 input is the concat of the per-frame pyramids
+        p0 = self._get_pyramid(ctx0, scale).expand(b, -1, -1, -1)
+        p1 = self._get_pyramid(ctx1, scale).expand(b, -1, -1, -1)
+        return torch.cat((p0[:, :3], p1[:, :3], p0[:, 3:], p1[:, 3:], timestep.expand(b, -1, -1, -1)), 1)
+
+    def estimate_motion(self, ctx0, ctx1, scale_list=None):
+        """
+        Cheap motion estimate of frame pairs: the coarse flow of block0 only, at the middle timestep
+
+        :param ctx0: The context of the first frames, see encode_frame
+        :param ctx1: The context of the second frames
+        :param scale_list: The scale list of forward
+        :return: (B,) mean flow magnitude between the frames, in pixels of the padded frame,
+                 and (B,) mean absolute difference of the downsampled frames
+        """
+        if scale_list is None:
+            scale_list = [16, 8, 4, 2, 1]
+        p0 = self._get_pyramid(ctx0, scale_list[0])
+        p1 = self._get_pyramid(ctx1, scale_list[0])
+        b = max(p0.shape[0], p1.shape[0])
+        timestep = p0[:1, :1] * 0 + 0.5
+        flow, _, _ = self.block0(
+            self._block0_input(ctx0, ctx1, timestep, b, scale_list[0]), None, scale=scale_list[0], downsampled=True
+        )
+        # the flows point from the middle frame to both frames, their magnitudes add up to the motion of the pair
+        motion = (distance_calculator(flow[:, :2]) + distance_calculator(flow[:, 2:4])).float().mean((1, 2, 3))
+        diff = (p0[:, :3] - p1[:, :3]).abs().float().mean((1, 2, 3))
+        return motion, diff.expand(b)
+
+    def forward(
+        self,
+        x,
+        timestep=0.5,
+        scale_list=None,
+        fastmode=True,
+        ensemble=False,
+        ctx0=None,
+        ctx1=None,
+        tile=None,
+        tile_overlap=0,
+        flow_tol=None,
+    ):
+        """
+        :param scale_list: The downscale factor of each level, block i runs at scale_list[i], a shorter list runs
+                           fewer refinement levels
+        :param tile: If not None, estimate the coarse flow (block0) on the whole frame, then refine it (block1 ~ 4)
+                     in overlapping tiles of this size, see ccvfi.arch.arch_utils.tile.tiled_refine
+        :param tile_overlap: The overlap added on each side of a tile
+        :param flow_tol: If not None, skip the remaining levels once the mean absolute flow update of a refinement
+                         block is lower than this number of pixels (for every sample), not used in tiled mode.
+                         The check syncs the device once per refinement level but the last, it pays off when the
+                         skipped levels cost more than the syncs (e.g. the full-resolution level)
+        """
         if scale_list is None:
             scale_list = [16, 8, 4, 2, 1]
         channel = x.shape[1] // 2
@@ -27,26 +113,54 @@ class IFNet(nn.Module):
         img1 = x[:, channel:]
         if not torch.is_tensor(timestep):
             timestep = (x[:, :1].clone() * 0 + 1) * timestep
-        f0 = self.encode(img0[:, :3])
-        f1 = self.encode(img1[:, :3])
+        if ctx0 is None:
+            ctx0 = self.encode_frame(img0, scale_list, tile)
+        if ctx1 is None:
+            ctx1 = self.encode_frame(img1, scale_list, tile)
+        b = x.shape[0]
+        f0 = ctx0["feat"].expand(b, -1, -1, -1)
+        f1 = ctx1["feat"].expand(b, -1, -1, -1)
+        x0 = self._block0_input(
+            ctx0,
+            ctx1,
+            F.interpolate(timestep, scale_factor=1.0 / scale_list[0], mode="bilinear", align_corners=False),
+            b,
+            scale_list[0],
+        )
         flow_list = []
         merged = []
         mask_list = []
         warped_img0 = img0
         warped_img1 = img1
+        # the warped features, bound before the refinement blocks read them
+        wf0 = f0
+        wf1 = f1
         flow = None
         mask = None
         block = [self.block0, self.block1, self.block2, self.block3, self.block4]
-        for i in range(5):
+        levels = len(scale_list)
+        for i in range(levels):
             if flow is None:
-                flow, mask, feat = block[i](
-                    torch.cat((img0[:, :3], img1[:, :3], f0, f1, timestep), 1), None, scale=scale_list[i]
-                )
+                flow, mask, feat = block[i](x0, None, scale=scale_list[i], downsampled=True)
                 if ensemble:
                     print("warning: ensemble is not supported since RIFEv4.21")
+                if tile is not None:
+                    return tiled_refine(
+                        block[1:levels],
+                        img0,
+                        img1,
+                        f0,
+                        f1,
+                        timestep,
+                        flow,
+                        mask,
+                        feat,
+                        scale_list,
+                        tile,
+                        tile_overlap,
+                        self.grid_cache,
+                    )
             else:
-                wf0 = warp(f0, flow[:, :2])
-                wf1 = warp(f1, flow[:, 2:4])
                 fd, m0, feat = block[i](
                     torch.cat((warped_img0[:, :3], warped_img1[:, :3], wf0, wf1, timestep, mask, feat), 1),
                     flow,
@@ -59,11 +173,25 @@ class IFNet(nn.Module):
                 flow = flow + fd
             mask_list.append(mask)
             flow_list.append(flow)
-            warped_img0 = warp(img0, flow[:, :2])
-            warped_img1 = warp(img1, flow[:, 2:4])
+            # stop once the flow update of a refinement block is below the tolerance (in pixels)
+            last = i == levels - 1
+            if flow_tol is not None and not last and i > 0:
+                # the decision needs the update on the host: one device sync per checked level, none without flow_tol
+                last = bool((fd.abs().float().flatten(1).mean(1).max() < flow_tol).item())
+            if not last:
+                # the frames and the features share the flow, one grid_sample for the four of them
+                (warped_img0, wf0), (warped_img1, wf1) = warp_group(
+                    [([img0, f0], flow[:, :2]), ([img1, f1], flow[:, 2:4])], self.grid_cache
+                )
+            else:
+                (warped_img0,), (warped_img1,) = warp_group(
+                    [([img0], flow[:, :2]), ([img1], flow[:, 2:4])], self.grid_cache
+                )
             merged.append((warped_img0, warped_img1))
+            if last:
+                break
         mask = torch.sigmoid(mask)
-        merged[4] = warped_img0 * mask + warped_img1 * (1 - mask)
+        merged[-1] = warped_img0 * mask + warped_img1 * (1 - mask)
         if not fastmode:
             print("contextnet is removed")
             """
@@ -71,9 +199,9 @@ class IFNet(nn.Module):
             c1 = self.contextnet(img1, flow[:, 2:4])
             tmp = self.unet(img0, img1, warped_img0, warped_img1, mask, flow, c0, c1)
             res = tmp[:, :3] * 2 - 1
-            merged[4] = torch.clamp(merged[4] + res, 0, 1)
+            merged[-1] = torch.clamp(merged[-1] + res, 0, 1)
             """
-        return merged[4]
+        return merged[-1]
 
 
 def conv(in_planes, out_planes, kernel_size=3, stride=1, padding=1, dilation=1):
@@ -153,15 +281,19 @@ class IFBlock(nn.Module):
         )
         self.lastconv = nn.Sequential(nn.ConvTranspose2d(c, 4 * 13, 4, 2, 1), nn.PixelShuffle(2))
 
-    def forward(self, x, flow=None, scale=1):
-        x = F.interpolate(x, scale_factor=1.0 / scale, mode="bilinear", align_corners=False)
+    def forward(self, x, flow=None, scale=1, downsampled=False):
+        # a bilinear resampling to the same size is the identity, skipped at scale 1
+        if not downsampled and scale != 1:
+            x = F.interpolate(x, scale_factor=1.0 / scale, mode="bilinear", align_corners=False)
         if flow is not None:
-            flow = F.interpolate(flow, scale_factor=1.0 / scale, mode="bilinear", align_corners=False) * 1.0 / scale
+            if scale != 1:
+                flow = F.interpolate(flow, scale_factor=1.0 / scale, mode="bilinear", align_corners=False) * 1.0 / scale
             x = torch.cat((x, flow), 1)
         feat = self.conv0(x)
         feat = self.convblock(feat)
         tmp = self.lastconv(feat)
-        tmp = F.interpolate(tmp, scale_factor=scale, mode="bilinear", align_corners=False)
+        if scale != 1:
+            tmp = F.interpolate(tmp, scale_factor=scale, mode="bilinear", align_corners=False)
         flow = tmp[:, :4] * scale
         mask = tmp[:, 4:5]
         feat = tmp[:, 5:]
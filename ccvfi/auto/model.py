@@ -17,6 +17,7 @@ class AutoModel:
         compile_backend: Optional[str] = None,
         model_dir: Optional[str] = None,
         gh_proxy: Optional[str] = None,
+        **kwargs: Any,
     ) -> Any:
         """
         Get a model instance from a pretrained model name.
@@ -28,6 +29,7 @@ class AutoModel:
         :param compile_backend: backend of torch.compile
         :param model_dir: The path to cache the downloaded model. Should be a full path. If None, use default cache path.
         :param gh_proxy: The proxy for downloading from github release. Example: https://github.abskoop.workers.dev/
+        :param kwargs: Model specific arguments, e.g. tile, tile_overlap and max_memory of VFIBaseModel
         :return:
         """
 
@@ -40,6 +42,7 @@ class AutoModel:
             compile_backend=compile_backend,
             model_dir=model_dir,
             gh_proxy=gh_proxy,
+            **kwargs,
         )
 
     @staticmethod
@@ -51,6 +54,7 @@ class AutoModel:
         compile_backend: Optional[str] = None,
         model_dir: Optional[str] = None,
         gh_proxy: Optional[str] = None,
+        **kwargs: Any,
     ) -> Any:
         """
         Get a model instance from a config.
@@ -62,6 +66,7 @@ class AutoModel:
         :param compile_backend: backend of torch.compile
         :param model_dir: The path to cache the downloaded model. Should be a full path. If None, use default cache path.
         :param gh_proxy: The proxy for downloading from github release. Example: https://github.abskoop.workers.dev/
+        :param kwargs: Model specific arguments, e.g. tile, tile_overlap and max_memory of VFIBaseModel
         :return:
         """
 
@@ -74,6 +79,7 @@ class AutoModel:
             compile_backend=compile_backend,
             model_dir=model_dir,
             gh_proxy=gh_proxy,
+            **kwargs,
         )
 
         return model
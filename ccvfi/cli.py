@@ -0,0 +1,462 @@
+import argparse
+import json
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from fractions import Fraction
+from typing import IO, Any, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from ccvfi.auto import AutoModel
+from ccvfi.config import CONFIG_REGISTRY
+from ccvfi.model import VFIBaseModel
+from ccvfi.model.vfi_base_model import BACKENDS, REFINE_PRESETS
+from ccvfi.scdet import SCDET_REGISTRY, SceneIndex, analyze_video
+from ccvfi.util.misc import ALIGN_MODES
+
+# end of stream marker of the queues
+_EOS = object()
+
+
+def parse_fps(fps: str) -> float:
+    """
+    Parse a framerate, either a number or a ffmpeg rational like 24000/1001
+
+    :param fps: The framerate
+    :return:
+    """
+    return float(Fraction(fps))
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    """
+    Parse a frame size like 1080x1920
+
+    :param size: HxW
+    :return: (h, w)
+    """
+    h, w = size.lower().split("x")
+    return int(h), int(w)
+
+
+def probe(ffprobe: str, path: str) -> Tuple[int, int, float]:
+    """
+    Probe the width, height and framerate of the first video stream with ffprobe
+
+    :param ffprobe: The ffprobe executable
+    :param path: The input video
+    :return: (width, height, fps)
+    """
+    cmd = [
+        ffprobe,
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=width,height,r_frame_rate",
+        "-of",
+        "json",
+        path,
+    ]
+    stream = json.loads(subprocess.check_output(cmd))["streams"][0]
+    return int(stream["width"]), int(stream["height"]), parse_fps(stream["r_frame_rate"])
+
+
+def decode_cmd(ffmpeg: str, path: str) -> List[str]:
+    return [ffmpeg, "-v", "error", "-i", path, "-map", "0:v:0", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+
+
+def encode_cmd(
+    ffmpeg: str, path: str, output: str, width: int, height: int, fps: float, encoder_args: Sequence[str]
+) -> List[str]:
+    return [
+        ffmpeg,
+        "-v",
+        "error",
+        "-y",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-s",
+        f"{width}x{height}",
+        "-r",
+        str(fps),
+        "-i",
+        "-",
+        "-i",
+        path,
+        "-map",
+        "0:v",
+        "-map",
+        "1:a?",
+        "-c:a",
+        "copy",
+        *encoder_args,
+        output,
+    ]
+
+
+def _read_exact(stream: IO[bytes], size: int) -> Optional[bytearray]:
+    # a writable buffer, so that the frame is wrapped by numpy and torch without a copy
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = stream.readinto(view[pos:])
+        if not n:
+            return None
+        pos += n
+    return buf
+
+
+class Pipeline:
+    """
+    Decode, interpolate and encode a video with three threads connected by bounded queues
+
+    The reader thread decodes rawvideo frames from a ffmpeg subprocess and converts them to tensors, the inference
+    thread runs model.inference_stream, the writer thread converts the output tensors back and pipes them into the
+    encoder subprocess. The occupancy of the queues shows the bottleneck: a full decode queue means the inference is
+    the slowest stage, a full encode queue means the encoder is, both queues empty means the decoder is.
+
+    :param model: The VFI model
+    :param decoder: The decoder subprocess, writing rgb24 rawvideo to stdout
+    :param encoder: The encoder subprocess, reading rgb24 rawvideo from stdin
+    :param width: The frame width
+    :param height: The frame height
+    :param src_fps: The source framerate
+    :param tar_fps: The target framerate
+    :param queue_size: The capacity of the decode and encode queues
+    :param inference_kwargs: The extra arguments of model.inference_stream
+    """
+
+    def __init__(
+        self,
+        model: VFIBaseModel,
+        decoder: subprocess.Popen,
+        encoder: subprocess.Popen,
+        width: int,
+        height: int,
+        src_fps: float,
+        tar_fps: float,
+        queue_size: int = 8,
+        **inference_kwargs: Any,
+    ) -> None:
+        self.model = model
+        self.decoder = decoder
+        self.encoder = encoder
+        self.width = width
+        self.height = height
+        self.src_fps = src_fps
+        self.tar_fps = tar_fps
+        self.inference_kwargs = inference_kwargs
+
+        self.decode_queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.encode_queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.errors: List[BaseException] = []
+
+        # statistics
+        self.frames_read: int = 0
+        self.frames_written: int = 0
+
+    def _put(self, q: "queue.Queue[Any]", item: Any) -> bool:
+        # never block forever, another stage may have failed
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: "queue.Queue[Any]") -> Any:
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _EOS
+
+    def _run(self, target: Any) -> None:
+        try:
+            target()
+        except BaseException as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    def _reader(self) -> None:
+        size = self.width * self.height * 3
+        try:
+            while True:
+                buf = _read_exact(self.decoder.stdout, size)  # type: ignore
+                if buf is None:
+                    break
+                img = np.frombuffer(buf, dtype=np.uint8).reshape(self.height, self.width, 3)
+                tensor = torch.from_numpy(img).permute(2, 0, 1).float().div_(255.0)
+                if not self._put(self.decode_queue, tensor):
+                    return
+                self.frames_read += 1
+        finally:
+            self._put(self.decode_queue, _EOS)
+
+    def _frames(self) -> Iterator[torch.Tensor]:
+        while True:
+            item = self._get(self.decode_queue)
+            if item is _EOS:
+                return
+            yield item
+
+    def _inference(self) -> None:
+        try:
+            for out in self.model.inference_stream(
+                self._frames(), src_fps=self.src_fps, tar_fps=self.tar_fps, **self.inference_kwargs
+            ):
+                if not self._put(self.encode_queue, out):
+                    return
+        finally:
+            self._put(self.encode_queue, _EOS)
+
+    def _writer(self) -> None:
+        while True:
+            out = self._get(self.encode_queue)
+            if out is _EOS:
+                break
+            img = out.clamp(0.0, 1.0).mul(255.0).round_().byte().permute(1, 2, 0).contiguous().cpu().numpy()
+            self.encoder.stdin.write(memoryview(img).cast("B"))  # type: ignore
+            self.frames_written += 1
+        self.encoder.stdin.close()  # type: ignore
+
+    def run(self, stats_interval: float = 1.0, log: IO[str] = sys.stderr) -> None:
+        """
+        Run the pipeline until the end of the input, print the statistics every stats_interval seconds
+
+        :param stats_interval: The interval of the statistics in seconds
+        :param log: The stream the statistics are printed to
+        :return:
+        """
+        threads = [
+            threading.Thread(target=self._run, args=(fn,), name=f"ccvfi_{fn.__name__[1:]}", daemon=True)
+            for fn in (self._reader, self._inference, self._writer)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+
+        last_time, last_written = start, 0
+        while any(t.is_alive() for t in threads):
+            threads[-1].join(timeout=stats_interval)
+            now = time.perf_counter()
+            written = self.frames_written
+            print(
+                f"[ccvfi] read {self.frames_read} written {written} | "
+                f"{(written - last_written) / max(now - last_time, 1e-9):.2f} fps | "
+                f"decode queue {self.decode_queue.qsize()}/{self.decode_queue.maxsize} "
+                f"encode queue {self.encode_queue.qsize()}/{self.encode_queue.maxsize}",
+                file=log,
+                flush=True,
+            )
+            last_time, last_written = now, written
+
+        elapsed = time.perf_counter() - start
+        if self.errors:
+            raise self.errors[0]
+        print(
+            f"[ccvfi] done, {self.frames_written} frames in {elapsed:.2f}s, "
+            f"sustained {self.frames_written / max(elapsed, 1e-9):.2f} fps",
+            file=log,
+            flush=True,
+        )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="ccvfi", description="Interpolate a video with ffmpeg, without vapoursynth")
+    parser.add_argument("input", help="input video")
+    parser.add_argument("output", help="output video")
+    parser.add_argument(
+        "-m",
+        "--model",
+        default="DRBA_IFNet.pkl",
+        choices=[name for name, _ in CONFIG_REGISTRY],
+        help="registered config name (default: %(default)s)",
+    )
+    parser.add_argument("--tar-fps", type=parse_fps, default=60.0, help="target framerate (default: %(default)s)")
+    parser.add_argument("--src-fps", type=parse_fps, default=None, help="source framerate, probed if not given")
+    parser.add_argument("--scale", type=float, default=1.0, help="flow scale factor (default: %(default)s)")
+    parser.add_argument("--no-scdet", dest="scdet", action="store_false", help="disable scene change detection")
+    parser.add_argument("--scdet-threshold", type=float, default=0.3, help="(default: %(default)s)")
+    parser.add_argument("--lookahead", type=int, default=0, help="windows inferred per call (default: %(default)s)")
+    parser.add_argument(
+        "--scene-index",
+        default=None,
+        help="scene index of a pre-analysis pass (see ccvfi-scdet), 'auto' to use the sidecar of the input if present",
+    )
+    parser.add_argument("--device", default=None, help="inference device, e.g. cuda:0 (default: auto)")
+    parser.add_argument("--no-fp16", dest="fp16", action="store_false", help="inference in fp32")
+    parser.add_argument("--compile", action="store_true", help="use torch.compile")
+    parser.add_argument("--optimize", action="store_true", help="fold and fuse the model layers for inference")
+    parser.add_argument("--channels-last", action="store_true", help="run the model in the NHWC memory format")
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="torch",
+        help="execution backend, onnxruntime runs the exported model on cpu (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--buckets",
+        type=parse_size,
+        nargs="+",
+        default=None,
+        help="HxW shape buckets the aligned frames are padded to, with --compile (default: disabled)",
+    )
+    parser.add_argument("--model-dir", default=None, help="the path to cache the downloaded model")
+    parser.add_argument(
+        "--motion-threshold",
+        type=float,
+        default=None,
+        help="blend the pairs whose estimated mean motion is lower than this number of pixels (default: disabled)",
+    )
+    parser.add_argument(
+        "--align-mode",
+        choices=ALIGN_MODES,
+        default="resize",
+        help="align the frames to the model by resampling or by padding (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--refine",
+        choices=list(REFINE_PRESETS),
+        default="quality",
+        help="refinement levels of the flow, trade quality for speed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--flow-tol",
+        type=float,
+        default=None,
+        help="skip the remaining refinement levels below this flow update in pixels (default: disabled)",
+    )
+    parser.add_argument("--queue-size", type=int, default=8, help="decode/encode queue size (default: %(default)s)")
+    parser.add_argument("--stats-interval", type=float, default=1.0, help="seconds between the statistics lines")
+    parser.add_argument(
+        "--encoder-args",
+        default="-c:v libx265 -crf 16 -pix_fmt yuv420p10le",
+        help="ffmpeg output arguments (default: %(default)s)",
+    )
+    parser.add_argument("--ffmpeg", default="ffmpeg", help="ffmpeg executable")
+    parser.add_argument("--ffprobe", default="ffprobe", help="ffprobe executable")
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+
+    width, height, probed_fps = probe(args.ffprobe, args.input)
+    src_fps = args.src_fps if args.src_fps is not None else probed_fps
+
+    model: VFIBaseModel = AutoModel.from_pretrained(
+        pretrained_model_name=args.model,
+        device=torch.device(args.device) if args.device is not None else None,
+        fp16=args.fp16,
+        compile=args.compile,
+        model_dir=args.model_dir,
+        motion_threshold=args.motion_threshold,
+        align_mode=args.align_mode,
+        refine=args.refine,
+        flow_tol=args.flow_tol,
+        optimize=args.optimize,
+        channels_last=args.channels_last,
+        backend=args.backend,
+        buckets=args.buckets,
+    )
+    if args.compile:
+        # compile before the pipeline starts, the statistics do not include it
+        model.warmup(resolutions=[(height, width)], scale=args.scale)
+
+    decoder = subprocess.Popen(decode_cmd(args.ffmpeg, args.input), stdout=subprocess.PIPE)
+    encoder = subprocess.Popen(
+        encode_cmd(args.ffmpeg, args.input, args.output, width, height, args.tar_fps, shlex.split(args.encoder_args)),
+        stdin=subprocess.PIPE,
+    )
+
+    scene_index = args.scene_index
+    if scene_index == "auto":
+        sidecar = SceneIndex.sidecar_path(args.input)
+        scene_index = sidecar if sidecar.exists() else None
+
+    pipeline = Pipeline(
+        model=model,
+        decoder=decoder,
+        encoder=encoder,
+        width=width,
+        height=height,
+        src_fps=src_fps,
+        tar_fps=args.tar_fps,
+        queue_size=args.queue_size,
+        scale=args.scale,
+        scdet=args.scdet,
+        scdet_threshold=args.scdet_threshold,
+        lookahead=args.lookahead,
+        scene_index=scene_index,
+    )
+    try:
+        pipeline.run(stats_interval=args.stats_interval)
+    finally:
+        decoder.kill()
+        decoder.wait()
+        if encoder.stdin is not None and not encoder.stdin.closed:
+            encoder.stdin.close()
+        encoder.wait()
+
+    if encoder.returncode != 0:
+        sys.exit(f"ffmpeg encoder exited with code {encoder.returncode}")
+
+
+def build_scdet_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="ccvfi-scdet", description="Scan a video for scene changes and write a sidecar scene index"
+    )
+    parser.add_argument("input", help="input video")
+    parser.add_argument("-o", "--output", default=None, help="index path (default: <input>.scdet.json)")
+    parser.add_argument(
+        "-d",
+        "--detector",
+        default="ssim",
+        choices=[name for name, _ in SCDET_REGISTRY],
+        help="scene change detector (default: %(default)s)",
+    )
+    parser.add_argument("--threshold", type=float, default=None, help="similarity threshold (default: per detector)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of cpus)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="frames per worker task (default: %(default)s)")
+    return parser
+
+
+def scdet_main(argv: Optional[Sequence[str]] = None) -> None:
+    args = build_scdet_parser().parse_args(argv)
+
+    start = time.perf_counter()
+    index = analyze_video(
+        args.input,
+        detector=args.detector,
+        threshold=args.threshold,
+        num_workers=args.workers,
+        chunk_size=args.chunk_size,
+        save=args.output is None,
+    )
+    if args.output is not None:
+        index.save(args.output)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"[ccvfi] {index.num_frames} frames, {len(index.cuts)} scene changes in {elapsed:.2f}s "
+        f"({index.num_frames / max(elapsed, 1e-9):.2f} fps)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import Any, List
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -7,14 +7,17 @@ from torch import Tensor
 from torchvision import transforms
 
 from ccvfi.arch import DRBA
+from ccvfi.arch.arch_utils import fuse
 from ccvfi.model import MODEL_REGISTRY, VFIBaseModel
 from ccvfi.type import ModelType
-from ccvfi.util.misc import de_resize, resize
 
 
 @MODEL_REGISTRY.register(name=ModelType.DRBA)
 class DRBAModel(VFIBaseModel):
     def load_model(self) -> Any:
+        if self.backend != "torch":
+            raise ValueError(f"DRBA only supports the torch backend, got {self.backend}")
+
         # cfg: DRBAConfig = self.config
         state_dict = self.get_state_dict()
 
@@ -34,6 +37,8 @@ class DRBAModel(VFIBaseModel):
 
         model.load_state_dict(_convert(state_dict), strict=False)
         model.eval().to(self.device)
+        if self.optimize:
+            fuse.optimize_for_inference(model)
         return model
 
     @torch.inference_mode()  # type: ignore
@@ -65,18 +70,74 @@ class DRBAModel(VFIBaseModel):
 
         I0, I1, I2 = imgs[:, 0], imgs[:, 1], imgs[:, 2]
         _, _, h, w = I0.shape
-        I0 = resize(I0, scale).unsqueeze(0)
-        I1 = resize(I1, scale).unsqueeze(0)
-        I2 = resize(I2, scale).unsqueeze(0)
+        I0 = self.align(I0, scale).unsqueeze(0)
+        I1 = self.align(I1, scale).unsqueeze(0)
+        I2 = self.align(I2, scale).unsqueeze(0)
 
         inp = torch.cat([I0, I1, I2], dim=1)
 
-        results, reuse = self.model(inp, minus_t, zero_t, plus_t, left_scene_change, right_scene_change, scale, reuse)
-
-        results = torch.cat(tuple(de_resize(result, h, w).unsqueeze(0) for result in results), dim=1)
+        with self.watch_compiles(inp.shape):
+            results, reuse = self.model(
+                inp,
+                minus_t,
+                zero_t,
+                plus_t,
+                left_scene_change,
+                right_scene_change,
+                scale,
+                reuse,
+                tile=self.get_tile(1, inp.dtype),
+                tile_overlap=self.tile_overlap,
+                refine_scales=self.refine_scales,
+                flow_tol=self.flow_tol,
+            )
+
+        results = torch.cat(tuple(self.de_align(result, h, w, scale).unsqueeze(0) for result in results), dim=1)
 
         return results, reuse
 
+    @torch.inference_mode()  # type: ignore
+    def inference_windows(
+        self,
+        windows: List[torch.Tensor],
+        timestamps: List[List[float]],
+        scenes: List[List[bool]],
+        frame_keys: List[List[Hashable]],
+        scale: float,
+        reuse: Optional[Any] = None,
+    ) -> Tuple[List[List[torch.Tensor]], Any, Optional[List[List[Dict[str, Any]]]]]:
+        """
+        Inference the (I0, I1, I2) windows scheduled by ccvfi.util.scheduler.VFIScheduler
+
+        The windows are inferred one by one, each one reuses the flow of the previous.
+
+        :param windows: The input windows, (1, 3, C, H, W) tensors
+        :param timestamps: The timestamps of the output frames of each window, relative to I1
+        :param scenes: The scene change flags (I0 and I1, I1 and I2) of each window
+        :param frame_keys: Unused
+        :param scale: Flow scale.
+        :param reuse: Reusable output of the previous call, if its last window directly precedes the first one
+
+        :return: The output frames (1, C, H, W) of each window, reusable contents, and None (no metadata).
+        """
+        outputs: List[List[torch.Tensor]] = []
+
+        for imgs, ts, scene in zip(windows, timestamps, scenes):
+            if len(ts) == 0:
+                outputs.append([])
+                reuse = None
+                continue
+
+            vfi_timestamp = np.round(np.asarray(ts, dtype=float), 4)
+            minus_t = vfi_timestamp[vfi_timestamp < 0].tolist()
+            zero_t = vfi_timestamp[vfi_timestamp == 0].tolist()
+            plus_t = vfi_timestamp[vfi_timestamp > 0].tolist()
+
+            results, reuse = self.inference(imgs, minus_t, zero_t, plus_t, scene[0], scene[1], scale, reuse)
+            outputs.append([results[0, i : i + 1] for i in range(results.shape[1])])
+
+        return outputs, reuse, None
+
     @torch.inference_mode()  # type: ignore
     def inference_image_list(self, img_list: List[np.ndarray]) -> List[np.ndarray]:
         """
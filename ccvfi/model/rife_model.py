@@ -1,4 +1,7 @@
-from typing import Any, List
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union, cast
 
 import cv2
 import numpy as np
@@ -6,14 +9,26 @@ import torch
 from torchvision import transforms
 
 from ccvfi.arch import IFNet
+from ccvfi.arch.arch_utils import fuse
 from ccvfi.model import MODEL_REGISTRY
 from ccvfi.model.vfi_base_model import VFIBaseModel
 from ccvfi.type import ModelType
-from ccvfi.util.misc import de_resize, resize
+from ccvfi.util import aot
+from ccvfi.util.onnx_backend import DEFAULT_OPSET, ORTSession, export_ifnet
+
+# the largest mean absolute difference (of the 1/16 frames) of two frames copied instead of blended
+COPY_THRESHOLD = 1 / 255
 
 
 @MODEL_REGISTRY.register(name=ModelType.RIFE)
 class RIFEModel(VFIBaseModel):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        # onnxruntime sessions of the exported model, per scale list
+        self.sessions: Dict[Tuple[float, ...], ORTSession] = {}
+        # AOTInductor-compiled models per (scale list, aligned size), None if the compile failed
+        self.compiled: Dict[Tuple[Tuple[float, ...], Tuple[int, int]], Optional[Callable[..., torch.Tensor]]] = {}
+        super().__init__(*args, **kwargs)
+
     def load_model(self) -> Any:
         state_dict = self.get_state_dict()
 
@@ -24,34 +39,307 @@ class RIFEModel(VFIBaseModel):
 
         model.load_state_dict(_convert(state_dict), strict=False)
         model.eval().to(self.device)
+        if self.optimize:
+            fuse.optimize_for_inference(model)
         return model
 
+    def export_onnx(self, f: Union[str, "os.PathLike[str]"], scale: float = 1.0, opset: int = DEFAULT_OPSET) -> None:
+        """
+        Export IFNet to ONNX, with the timestep as an input tensor and a dynamic batch, height and width.
+        See ccvfi.util.onnx_backend.export_ifnet for the inputs and the output of the graph.
+
+        :param f: The path of the ONNX model
+        :param scale: Flow scale, the refinement levels (see get_scale_list) are baked into the graph
+        :param opset: The ONNX opset version
+        :return:
+        """
+        if self.int8:
+            raise ValueError("The int8 model can not be exported to ONNX")
+        export_ifnet(getattr(self.model, "_orig_mod", self.model), f, self.get_scale_list(scale), opset)
+
+    def get_session(self, scale: float) -> ORTSession:
+        """
+        Get the onnxruntime session of a flow scale, the model is exported on the first call
+
+        :param scale: Flow scale.
+        :return:
+        """
+        key = tuple(self.get_scale_list(scale))
+        if key not in self.sessions:
+            # exported to a temporary file, the session keeps the bytes of the model
+            with tempfile.TemporaryDirectory() as tmp:
+                path = Path(tmp) / "ifnet.onnx"
+                self.export_onnx(path, scale)
+                self.sessions[key] = ORTSession(path.read_bytes())
+        return self.sessions[key]
+
+    def get_frame_context(self, key: Optional[Hashable], img: torch.Tensor, scale: float) -> Dict[str, Any]:
+        """
+        Get the per-frame precomputation (padded frame, pyramid and Head features) of a frame, cached by key
+
+        :param key: The key of the frame, e.g. its index in the clip. If None, the context is not cached
+        :param img: The frame (1, C, H, W)
+        :param scale: Flow scale.
+        :return:
+        """
+        cache_key = (key, scale)
+        ctx = self.frame_cache.get(cache_key) if key is not None else None
+        if ctx is None:
+            scale_list = self.get_scale_list(scale)
+            img = self.to_memory_format(self.align(img, scale))
+            ctx = cast(IFNet, self.model).encode_frame(img, scale_list, self.get_tile(1, img.dtype))
+            if key is not None:
+                self.frame_cache.put(cache_key, ctx)
+        return ctx
+
+    def get_artifact_path(self, scale: float, size: Tuple[int, int]) -> Path:
+        """
+        :param scale: Flow scale.
+        :param size: The aligned (h, w) of the frames, see get_input_size
+        :return: The path of the AOTInductor artifact of the model, see ccvfi.util.aot.get_artifact_path
+        """
+        assert self.device is not None
+        key = (
+            self.device.type,
+            str(torch.float16 if self.fp16 else torch.float32),
+            tuple(size),
+            tuple(self.get_scale_list(scale)),
+            self.channels_last,
+            self.optimize,
+        )
+        return aot.get_artifact_path(self.config, key, self.model_dir)
+
+    def compile_aot(self, sizes: Sequence[Tuple[int, int]], scale: float = 1.0) -> List[Path]:
+        """
+        Compile the model ahead of time with AOTInductor for frame sizes, and persist the artifacts next to the
+        cached weights. The following processes with the aoti backend load them instead of compiling.
+
+        :param sizes: The (h, w) of the frames, e.g. [(1080, 1920)]
+        :param scale: Flow scale.
+        :return: The paths of the artifacts
+        """
+        if self.int8:
+            raise ValueError("The int8 model can not be compiled ahead of time")
+        paths = []
+        for h, w in sizes:
+            size = self.get_input_size(h, w, scale)
+            path = self.get_artifact_path(scale, size)
+            if not path.exists():
+                aot.compile_ifnet(getattr(self.model, "_orig_mod", self.model), path, self.get_scale_list(scale), size)
+            paths.append(path)
+        return paths
+
+    def get_compiled(self, scale: float, size: Tuple[int, int]) -> Optional[Callable[..., torch.Tensor]]:
+        """
+        Get the AOTInductor-compiled model of a flow scale and an aligned size, loaded from its artifact or compiled
+        on the first call. None if the compile failed, the eager model is used instead.
+
+        :param scale: Flow scale.
+        :param size: The aligned (h, w) of the frames
+        :return:
+        """
+        key = (tuple(self.get_scale_list(scale)), size)
+        if key not in self.compiled:
+            try:
+                self.compiled[key] = aot.load_artifact(self.compile_aot([size], scale)[0])
+            except Exception as e:
+                print(f"Error: {e}, AOT compile is not supported on this model, fall back to eager mode.")
+                self.compiled[key] = None
+        return self.compiled[key]
+
+    @staticmethod
+    def _collate_context(ctxs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # same frame for the whole batch, e.g. all the timesteps of one pair
+        if all(ctx is ctxs[0] for ctx in ctxs):
+            return ctxs[0]
+        return {
+            "img": torch.cat([ctx["img"] for ctx in ctxs], dim=0),
+            "feat": torch.cat([ctx["feat"] for ctx in ctxs], dim=0),
+            "pyramid": {
+                s: torch.cat([IFNet._get_pyramid(ctx, s) for ctx in ctxs], dim=0) for s in ctxs[0]["pyramid"].keys()
+            },
+        }
+
     @torch.inference_mode()  # type: ignore
-    def inference(self, imgs: torch.Tensor, timestep: float, scale: float) -> torch.Tensor:
+    def inference(
+        self,
+        imgs: torch.Tensor,
+        timestep: Union[float, Sequence[float], torch.Tensor],
+        scale: float,
+        frame_keys: Optional[Sequence[Tuple[Hashable, Hashable]]] = None,
+    ) -> torch.Tensor:
         """
         Inference with the model
 
+        All samples of the batch run through one IFNet forward, so several timesteps of a pair (or several pairs)
+        can be interpolated at once by stacking them along the batch dimension.
+
         :param imgs: The input frames (B, 2, C, H, W)
-        :param timestep: Timestep between 0 and 1 (img0 and img1)
+        :param timestep: Timestep between 0 and 1 (img0 and img1), a float for the whole batch or one per sample
         :param scale: Flow scale.
+        :param frame_keys: The keys (key0, key1) of the two frames of each sample. If given, the padded frames,
+                           their pyramid and their Head features are cached in self.frame_cache and reused by the
+                           following calls with the same keys.
 
-        :return: an immediate frame between I0 and I1
+        :return: the immediate frames between I0 and I1 (B, C, H, W)
         """
 
         I0, I1 = imgs[:, 0], imgs[:, 1]
-        _, _, h, w = I0.shape
-        I0 = resize(I0, scale)
-        I1 = resize(I1, scale)
+        b, _, h, w = I0.shape
+        scale_list = self.get_scale_list(scale)
+
+        # the timestep is always a tensor, so that a compiled model does not specialise on its value
+        ts = torch.as_tensor(timestep, dtype=I0.dtype, device=I0.device).view(-1, 1, 1, 1)
+        if ts.shape[0] == 1:
+            ts = ts.expand(b, -1, -1, -1)
+        elif ts.shape[0] != b:
+            raise ValueError(f"Got {ts.shape[0]} timesteps for a batch of {b} frame pairs")
 
-        inp = torch.cat([I0, I1], dim=1)
-        scale_list = [16 / scale, 8 / scale, 4 / scale, 2 / scale, 1 / scale]
+        # an exported / compiled graph encodes the frames itself, the frame keys are not used
+        if self.backend != "torch":
+            x0 = self.to_memory_format(self.align(I0, scale))
+            x1 = self.to_memory_format(self.align(I1, scale))
+            run: Optional[Callable[..., torch.Tensor]] = None
+            if self.backend == "onnxruntime":
+                run = self.get_session(scale)
+            elif self.backend == "aoti":
+                run = self.get_compiled(scale, (x0.shape[2], x0.shape[3]))
+            if run is not None:
+                result = run(x0, x1, ts.contiguous())
+                return self.de_align(result, h, w, scale).contiguous()
 
-        result = self.model(inp, timestep, scale_list)
+        if frame_keys is None:
+            ctx0, ctx1 = None, None
+            inp = self.to_memory_format(torch.cat([self.align(I0, scale), self.align(I1, scale)], dim=1))
+        else:
+            if len(frame_keys) != b:
+                raise ValueError(f"Got {len(frame_keys)} frame keys for a batch of {b} frame pairs")
+            ctx0 = self._collate_context(
+                [self.get_frame_context(k0, I0[i : i + 1], scale) for i, (k0, _) in enumerate(frame_keys)]
+            )
+            ctx1 = self._collate_context(
+                [self.get_frame_context(k1, I1[i : i + 1], scale) for i, (_, k1) in enumerate(frame_keys)]
+            )
+            inp = torch.cat([ctx0["img"].expand(b, -1, -1, -1), ctx1["img"].expand(b, -1, -1, -1)], dim=1)
 
-        result = de_resize(result, h, w)
+        # broadcast to a (B, 1, H, W) map
+        ts = ts.expand(-1, 1, inp.shape[2], inp.shape[3])
+
+        with self.watch_compiles(inp.shape):
+            result = self.model(
+                inp,
+                ts,
+                scale_list,
+                ctx0=ctx0,
+                ctx1=ctx1,
+                tile=self.get_tile(b, inp.dtype),
+                tile_overlap=self.tile_overlap,
+                flow_tol=self.flow_tol,
+            )
+
+        result = self.de_align(result, h, w, scale).contiguous()
 
         return result
 
+    def estimate_motion(
+        self, windows: List[torch.Tensor], frame_keys: List[List[Hashable]], scale: float
+    ) -> Tuple[List[float], List[float]]:
+        """
+        Cheap motion estimate of the (I0, I1) windows, from the coarse flow of IFNet block0 on the cached contexts
+
+        :param windows: The input windows, (1, 2, C, H, W) tensors
+        :param frame_keys: The keys of I0 and I1 of each window
+        :param scale: Flow scale.
+        :return: The mean flow magnitude (in pixels of the frame) and the mean absolute difference of each window
+        """
+        ctx0 = self._collate_context(
+            [self.get_frame_context(keys[0], imgs[:, 0], scale) for imgs, keys in zip(windows, frame_keys)]
+        )
+        ctx1 = self._collate_context(
+            [self.get_frame_context(keys[1], imgs[:, 1], scale) for imgs, keys in zip(windows, frame_keys)]
+        )
+        scale_list = self.get_scale_list(scale)
+        motion, diff = cast(IFNet, self.model).estimate_motion(ctx0, ctx1, scale_list)
+        # one device sync for the whole call, the flow is measured on the frame resized by scale
+        motion, diff = torch.stack([motion / scale, diff]).tolist()
+        return motion, diff
+
+    @torch.inference_mode()  # type: ignore
+    def inference_windows(
+        self,
+        windows: List[torch.Tensor],
+        timestamps: List[List[float]],
+        scenes: List[List[bool]],
+        frame_keys: List[List[Hashable]],
+        scale: float,
+        reuse: Optional[Any] = None,
+    ) -> Tuple[List[List[torch.Tensor]], Any, List[List[Dict[str, Any]]]]:
+        """
+        Inference the (I0, I1) windows scheduled by ccvfi.util.scheduler.VFIScheduler
+
+        All the timesteps of all the windows run in one batch. With self.motion_threshold set, the motion of the
+        windows is estimated first, the near-static windows skip IFNet: their frames are the linear blend of I0 and
+        I1, or a copy of the nearest one when the frames are identical.
+
+        :param windows: The input windows, (1, 2, C, H, W) tensors
+        :param timestamps: The timestamps of the output frames of each window, relative to its center
+        :param scenes: The scene change flag between I0 and I1 of each window
+        :param frame_keys: The keys of I0 and I1 of each window
+        :param scale: Flow scale.
+        :param reuse: Unused, every window is independent
+
+        :return: The output frames (1, C, H, W) of each window, None, and the path of each output frame
+        """
+        outputs: List[List[torch.Tensor]] = []
+        infos: List[List[Dict[str, Any]]] = []
+        batch_imgs: List[torch.Tensor] = []
+        batch_ts: List[float] = []
+        batch_keys: List[Tuple[Hashable, Hashable]] = []
+        batch_pos: List[Tuple[int, int]] = []
+
+        motion: List[Optional[float]] = [None] * len(windows)
+        diff: List[Optional[float]] = [None] * len(windows)
+        motion_threshold = self.motion_threshold
+        if motion_threshold is not None:
+            todo = [w for w, scene in enumerate(scenes) if not scene[0]]
+            if len(todo) > 0:
+                m, d = self.estimate_motion([windows[w] for w in todo], [frame_keys[w] for w in todo], scale)
+                for w, mw, dw in zip(todo, m, d):
+                    motion[w], diff[w] = mw, dw
+
+        for w, (imgs, ts, scene, keys) in enumerate(zip(windows, timestamps, scenes, frame_keys)):
+            I0, I1 = imgs[:, 0], imgs[:, 1]
+            outputs.append([])
+            infos.append([])
+            motion_w, diff_w = motion[w], diff[w]
+            for j, t in enumerate(ts):
+                t = t + 0.5
+                outputs[w].append(I0)
+                if scene[0]:
+                    path = "scene"
+                elif t == 0:
+                    path = "source"
+                elif diff_w is not None and diff_w < COPY_THRESHOLD:
+                    path = "copy"
+                    outputs[w][j] = I0 if t < 0.5 else I1
+                elif motion_w is not None and motion_threshold is not None and motion_w < motion_threshold:
+                    path = "blend"
+                    outputs[w][j] = I0 * (1 - t) + I1 * t
+                else:
+                    path = "model"
+                    batch_imgs.append(imgs)
+                    batch_ts.append(t)
+                    batch_keys.append((keys[0], keys[1]))
+                    batch_pos.append((w, j))
+                infos[w].append({"path": path, "motion": motion_w})
+
+        if len(batch_imgs) > 0:
+            output = self.inference(torch.cat(batch_imgs, dim=0), timestep=batch_ts, scale=scale, frame_keys=batch_keys)
+            for b, (w, j) in enumerate(batch_pos):
+                outputs[w][j] = output[b : b + 1]
+
+        return outputs, None, infos
+
     @torch.inference_mode()  # type: ignore
     def inference_image_list(self, img_list: List[np.ndarray]) -> List[np.ndarray]:
         """
@@ -1,13 +1,312 @@
-from typing import Any, List
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
 
+from ccvfi.arch.arch_utils import fuse, quantize
+from ccvfi.arch.arch_utils.tile import estimate_tile
 from ccvfi.cache_models import load_file_from_url
+from ccvfi.scdet import SceneIndex, Timeline
+from ccvfi.scdet.index import load_scene_index
 from ccvfi.type import BaseConfig, BaseModelInterface
+from ccvfi.util.cache import LRUCache
+from ccvfi.util.misc import ALIGN_MODES, de_resize, get_align_size, get_bucket_size, pad_to, resize
+from ccvfi.util.stream import Frame, FrameSource, inference_stream
+
+# the downscale factor of each refinement level of IFNet (block i runs at scale / flow scale), the full-resolution
+# levels cost the most: balanced runs the last block at 1/2, fast stops after four blocks at 1/4
+REFINE_PRESETS: Dict[str, Tuple[float, ...]] = {
+    "quality": (16, 8, 4, 2, 1),
+    "balanced": (16, 8, 4, 2, 2),
+    "fast": (16, 8, 4, 4),
+}
+
+# the execution backends of the model, onnxruntime runs the exported graph on cpu, aoti the AOTInductor-compiled
+# graph persisted next to the weights (RIFE)
+BACKENDS = ("torch", "onnxruntime", "aoti")
 
 
 class VFIBaseModel(BaseModelInterface):
+    """
+    Base model of video frame interpolation, see BaseModelInterface for the common parameters
+
+    :param tile: Opt-in tiled mode, the coarse flow is estimated on the whole frame, then refined and warped in
+                 overlapping tiles of this size (in pixels of the padded frame) whose seams are feather-blended
+    :param tile_overlap: The overlap added on each side of a tile in tiled mode
+    :param max_memory: Opt-in tiled mode, the memory budget of a tile in MiB, the tile size is estimated from it
+                       when tile is None
+    :param motion_threshold: Opt-in motion-adaptive mode (RIFE), the pairs whose estimated mean motion is lower than
+                             this number of pixels skip the model, their frames are linearly blended
+    :param align_mode: How the frames are aligned to the size the model expects: "resize" resamples them bilinearly
+                       (and back), "reflect" / "replicate" pad them and crop the output, without resampling
+    :param refine: The refinement levels of IFNet, a preset name in REFINE_PRESETS or the downscale factor of each
+                   level (1 to 5 levels)
+    :param flow_tol: If not None, skip the remaining refinement levels once the mean flow update of a level is lower
+                     than this number of pixels. Each checked level costs a device sync, without it none is made
+    :param optimize: Fold and fuse the model for inference once loaded, see optimize_for_inference
+    :param backend: The execution backend, one of BACKENDS, without tiled mode and early exit if not torch (RIFE).
+                    onnxruntime runs the model exported to ONNX with its cpu provider, in float32 on cpu whatever
+                    the device and fp16 options. aoti runs the model compiled ahead of time with AOTInductor once per
+                    device, dtype and aligned frame size, the artifacts are persisted next to the cached weights
+    :param buckets: Opt-in shape buckets, the (h, w) sizes the aligned frames are padded to (the smallest one which
+                    contains them, by replication), so that a compiled model sees a small fixed set of shapes
+    :param pool: Share the loaded module with the other instances of the same weights, device, dtype and
+                 optimisations (see ccvfi.util.pool.MODEL_POOL), it is copied before being modified in place
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        tile: Optional[int] = None,
+        tile_overlap: int = 64,
+        max_memory: Optional[int] = None,
+        motion_threshold: Optional[float] = None,
+        align_mode: str = "resize",
+        refine: Union[str, Sequence[float]] = "quality",
+        flow_tol: Optional[float] = None,
+        optimize: bool = False,
+        backend: str = "torch",
+        buckets: Optional[Sequence[Tuple[int, int]]] = None,
+        pool: bool = True,
+        **kwargs: Any,
+    ) -> None:
+        if tile is not None and tile < 1:
+            raise ValueError("The tile size should be greater than 0")
+        if max_memory is not None and max_memory < 1:
+            raise ValueError("The max memory should be greater than 0")
+        if tile_overlap < 0:
+            raise ValueError("The tile overlap should be greater than or equal to 0")
+        if motion_threshold is not None and motion_threshold < 0:
+            raise ValueError("The motion threshold should be greater than or equal to 0")
+        if align_mode not in ALIGN_MODES:
+            raise ValueError(f"The align mode should be one of {ALIGN_MODES}, got {align_mode}")
+        if isinstance(refine, str):
+            if refine not in REFINE_PRESETS:
+                raise ValueError(f"The refine preset should be one of {list(REFINE_PRESETS)}, got {refine}")
+            refine = REFINE_PRESETS[refine]
+        if not 1 <= len(refine) <= 5 or any(s <= 0 for s in refine):
+            raise ValueError("The refine scales should be 1 to 5 factors greater than 0")
+        if flow_tol is not None and flow_tol < 0:
+            raise ValueError("The flow tolerance should be greater than or equal to 0")
+        if buckets is not None and any(len(b) != 2 or b[0] < 1 or b[1] < 1 for b in buckets):
+            raise ValueError("The buckets should be (h, w) sizes greater than 0")
+        if backend not in BACKENDS:
+            raise ValueError(f"The backend should be one of {BACKENDS}, got {backend}")
+        if backend != "torch" and (tile is not None or max_memory is not None or flow_tol is not None):
+            raise ValueError(f"The {backend} backend does not support the tiled mode and the flow tolerance")
+        if backend == "onnxruntime":
+            # the exported graph and its inputs are float32 on cpu
+            kwargs["device"] = torch.device("cpu")
+            kwargs["fp16"] = False
+
+        self.tile: Optional[int] = tile
+        self.tile_overlap: int = tile_overlap
+        self.max_memory: Optional[int] = max_memory
+        self.motion_threshold: Optional[float] = motion_threshold
+        self.align_mode: str = align_mode
+        self.refine_scales: Tuple[float, ...] = tuple(refine)
+        self.flow_tol: Optional[float] = flow_tol
+        self.optimize: bool = optimize
+        self.backend: str = backend
+        self.buckets: Optional[List[Tuple[int, int]]] = (
+            [(int(h), int(w)) for h, w in buckets] if buckets is not None else None
+        )
+        self.pool: bool = pool
+        # the torch.compile graph compiles, see watch_compiles
+        self.compile_events: List[Dict[str, Any]] = []
+        self._warming_up: bool = False
+        self.int8: bool = False
+
+        # bounded per-frame precomputation cache, keyed by the frame keys given to inference
+        self.frame_cache: LRUCache = LRUCache(maxsize=4)
+        super().__init__(*args, **kwargs)
+
+    def get_weight_key(self) -> Hashable:
+        """
+        :return: The key of the weights of the config, its hash if known, so that configs with the same weights share
+                 them
+        """
+        cfg: BaseConfig = self.config
+        if cfg.hash is not None:
+            return cfg.hash
+        return str(cfg.path) if cfg.path is not None else (cfg.name, self.model_dir)
+
+    def get_pool_key(self) -> Optional[Hashable]:
+        """
+        :return: The key of the loaded module in ccvfi.util.pool.MODEL_POOL, None if pool is disabled
+        """
+        if not self.pool:
+            return None
+        cfg: BaseConfig = self.config
+        return (
+            type(self).__name__,
+            str(cfg.arch),
+            self.get_weight_key(),
+            str(self.device),
+            self.fp16,
+            self.channels_last,
+            self.optimize,
+        )
+
+    def get_tile(self, batch: int, dtype: torch.dtype) -> Optional[int]:
+        """
+        Get the tile size of an inference call, None if the tiled mode is disabled
+
+        :param batch: The batch size of the call
+        :param dtype: The dtype of the inputs
+        :return:
+        """
+        if self.tile is not None:
+            return self.tile
+        if self.max_memory is not None:
+            return estimate_tile(self.max_memory, batch, dtype, self.tile_overlap)
+        return None
+
+    def optimize_for_inference(self) -> None:
+        """
+        Fold the beta of the ResConv blocks into their conv weights, and fuse the ConvTranspose2d + PixelShuffle of
+        the IFBlocks into one ConvTranspose2d, in place. The outputs are unchanged up to rounding.
+
+        :return:
+        """
+        self.unshare_model()
+        # the compiled wrapper shares its modules with the original one
+        fuse.optimize_for_inference(getattr(self.model, "_orig_mod", self.model))
+        self.optimize = True
+
+    def quantize_int8(self, frames: Sequence[np.ndarray], engine: Optional[str] = None) -> None:
+        """
+        Opt-in int8 mode for cpu inference, the conv stacks of the IFBlocks run as int8 convs, the rest in float32
+
+        The activation ranges are calibrated on the windows of consecutive frames, a few frames of the video to
+        interpolate are the best calibration. The ResConv betas are folded as with optimize_for_inference.
+
+        :param frames: At least in_frame_count consecutive (H, W, 3) uint8 BGR frames
+        :param engine: The quantized engine, e.g. "x86" or "qnnpack". If None, the first one this cpu supports
+        :return:
+        """
+        if self.int8:
+            raise ValueError("The model is already quantized")
+        assert self.device is not None
+        if self.device.type != "cpu" or self.fp16 or self.compile or self.backend != "torch":
+            raise ValueError("The int8 mode needs an uncompiled float32 model on cpu, with the torch backend")
+        n = self.config.in_frame_count
+        if len(frames) < n:
+            raise ValueError(f"The calibration needs at least {n} frames, got {len(frames)}")
+
+        self.unshare_model()
+        model = getattr(self.model, "_orig_mod", self.model)
+        quantize.prepare_int8(model, engine)
+        for i in range(len(frames) - n + 1):
+            self.inference_image_list(list(frames[i : i + n]))
+        quantize.convert_int8(model)
+        # the cached contexts were encoded while calibrating
+        self.frame_cache.clear()
+        self.optimize = True
+        self.int8 = True
+
+    def get_input_size(self, h: int, w: int, scale: float) -> Tuple[int, int]:
+        """
+        :param h: The height of a frame
+        :param w: The width of a frame
+        :param scale: Flow scale.
+        :return: The (h, w) of the frame once aligned, see align
+        """
+        size = get_align_size(h, w, scale)
+        if self.buckets is not None:
+            # a bucket which is not a multiple of the alignment is aligned too
+            size = get_align_size(*get_bucket_size(*size, self.buckets), scale)
+        return size
+
+    def align(self, img: torch.Tensor, scale: float) -> torch.Tensor:
+        """
+        Align a frame to the size the model expects (see align_mode), then pad it to its shape bucket if any
+
+        :param img: (B, C, H, W) tensor
+        :param scale: Flow scale.
+        :return:
+        """
+        aligned = resize(img, scale, self.align_mode)
+        if self.buckets is not None:
+            aligned = pad_to(aligned, *self.get_input_size(img.shape[2], img.shape[3], scale))
+        return aligned
+
+    def de_align(self, img: torch.Tensor, h: int, w: int, scale: float) -> torch.Tensor:
+        """
+        Undo align
+
+        :param img: (B, C, H, W) tensor
+        :param h: The height of the frame before align
+        :param w: The width of the frame before align
+        :param scale: Flow scale.
+        :return:
+        """
+        if self.buckets is not None:
+            ah, aw = get_align_size(h, w, scale) if self.align_mode == "resize" else (h, w)
+            img = img[:, :, :ah, :aw]
+        return de_resize(img, h, w, self.align_mode)
+
+    @contextmanager
+    def watch_compiles(self, shape: Sequence[int]) -> Iterator[None]:
+        """
+        Record the torch.compile graph compiles of the calls in the block into compile_events, and report the
+        recompiles after warmup, a steady state with shape buckets should never recompile
+
+        :param shape: The input shape of the block
+        :return:
+        """
+        if not self.compile:
+            yield
+            return
+
+        from torch._dynamo.utils import counters
+
+        before = counters["stats"]["unique_graphs"]
+        yield
+        graphs = counters["stats"]["unique_graphs"] - before
+        if graphs > 0:
+            self.compile_events.append({"shape": tuple(shape), "graphs": graphs, "warmup": self._warming_up})
+            if not self._warming_up:
+                print(f"Warning: torch.compile compiled {graphs} new graph(s) for the input shape {tuple(shape)}")
+
+    @torch.inference_mode()  # type: ignore
+    def warmup(
+        self, resolutions: Sequence[Tuple[int, int]], scale: float = 1.0, batch_sizes: Sequence[int] = (1,)
+    ) -> None:
+        """
+        Run the model once per frame size and number of timesteps per window, so that torch.compile compiles before
+        the first frames. The compiles of the warmup are recorded in compile_events with warmup=True.
+
+        :param resolutions: The (h, w) of the frames, e.g. [(1080, 1920), (720, 1280)]
+        :param scale: Flow scale.
+        :param batch_sizes: The numbers of timesteps per window, e.g. (1, 2) for a 2x and a 3x interpolation
+        :return:
+        """
+        cfg: BaseConfig = self.config
+        dtype = torch.float16 if self.fp16 else torch.float32
+
+        self._warming_up = True
+        try:
+            for h, w in resolutions:
+                window = torch.rand((1, cfg.in_frame_count, 3, h, w), device=self.device, dtype=dtype)
+                for b in batch_sizes:
+                    ts = [-0.5 + (i + 1) / (b + 1) for i in range(b)]
+                    self.inference_windows(
+                        [window], [ts], [[False] * (cfg.in_frame_count - 1)], [[None] * cfg.in_frame_count], scale
+                    )
+        finally:
+            self._warming_up = False
+            self.frame_cache.clear()
+
+    def get_scale_list(self, scale: float) -> List[float]:
+        """
+        :param scale: Flow scale.
+        :return: The downscale factor of each refinement level of IFNet
+        """
+        return [s / scale for s in self.refine_scales]
+
     def get_state_dict(self) -> Any:
         """
         Load the state dict of the model from config
@@ -29,19 +328,57 @@ class VFIBaseModel(BaseModelInterface):
                     config=cfg, force_download=True, model_dir=self.model_dir, gh_proxy=self.gh_proxy
                 )
 
-        return torch.load(state_dict_path, map_location=self.device, weights_only=True)
+        # read once per process for the configs with the same weights, shared read-only and held with the model
+        key = (self.get_weight_key(), str(self.device))
+        return self.acquire_weights(
+            key, lambda: torch.load(state_dict_path, map_location=self.device, weights_only=True)
+        )
 
     @torch.inference_mode()  # type: ignore
     def inference(self, *args, **kwargs) -> torch.Tensor:
         raise NotImplementedError
 
+    @torch.inference_mode()  # type: ignore
+    def inference_windows(
+        self,
+        windows: List[torch.Tensor],
+        timestamps: List[List[float]],
+        scenes: List[List[bool]],
+        frame_keys: List[List[Hashable]],
+        scale: float,
+        reuse: Optional[Any] = None,
+    ) -> Tuple[List[List[torch.Tensor]], Any, Optional[List[List[Dict[str, Any]]]]]:
+        """
+        Inference the windows of in_frame_count frames scheduled by ccvfi.util.scheduler.VFIScheduler
+
+        :param windows: The input windows, (1, in_frame_count, C, H, W) tensors
+        :param timestamps: The timestamps of the output frames of each window, relative to its center
+        :param scenes: The scene change flags between the adjacent frames of each window
+        :param frame_keys: The keys of the frames of each window
+        :param scale: Flow scale.
+        :param reuse: Reusable output of the previous call, if its last window directly precedes the first one
+
+        :return: The output frames (1, C, H, W) of each window, reusable contents, and the metadata of each output
+                 frame (e.g. {"path": "model"}) or None
+        """
+        raise NotImplementedError
+
     @torch.inference_mode()  # type: ignore
     def inference_image_list(self, img_list: List[np.ndarray]) -> List[np.ndarray]:
         raise NotImplementedError
 
     @torch.inference_mode()  # type: ignore
     def inference_video(
-        self, clip: Any, scale: float = 1.0, tar_fps: float = 60, scdet: bool = True, scdet_threshold: float = 0.3
+        self,
+        clip: Any,
+        scale: float = 1.0,
+        tar_fps: float = 60,
+        scdet: bool = True,
+        scdet_threshold: float = 0.3,
+        lookahead: int = 0,
+        prefetch: int = 2,
+        scene_index: Union[SceneIndex, str, Path, None] = None,
+        timeline: Optional[Timeline] = None,
     ) -> Any:
         """
         Inference the video with the model, the clip should be a vapoursynth clip
@@ -51,6 +388,12 @@ class VFIBaseModel(BaseModelInterface):
         :param tar_fps: The fps of the interpolated video
         :param scdet: Enable SSIM scene change detection
         :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
+        :param lookahead: The number of following frame pairs batched into the same inference call
+        :param prefetch: The number of source frames decoded and converted to tensors ahead of the inference
+        :param scene_index: The scene changes of a pre-analysis pass (a SceneIndex or the path of a saved one),
+                            read instead of the inline detection, see ccvfi.scdet.analyze_video
+        :param timeline: The distinct frames and their (retimed) times, the held frames are not interpolated,
+                         see ccvfi.scdet.Timeline.from_held
         :return:
         """
 
@@ -58,8 +401,11 @@ class VFIBaseModel(BaseModelInterface):
 
         cfg: BaseConfig = self.config
 
+        # every frame of the lookahead windows stays cached until its last window is inferred
+        self.frame_cache.maxsize = max(self.frame_cache.maxsize, cfg.in_frame_count + lookahead)
+
         return inference_vfi(
-            inference=self.inference,
+            inference=self.inference_windows,
             clip=clip,
             scale=scale,
             tar_fps=tar_fps,
@@ -67,4 +413,62 @@ class VFIBaseModel(BaseModelInterface):
             scdet=scdet,
             scdet_threshold=scdet_threshold,
             device=self.device,
+            lookahead=lookahead,
+            prefetch=prefetch,
+            scene_index=load_scene_index(scene_index),
+            timeline=timeline,
+        )
+
+    @torch.inference_mode()  # type: ignore
+    def inference_stream(
+        self,
+        frames: FrameSource,
+        src_fps: float,
+        tar_fps: float,
+        scale: float = 1.0,
+        scdet: bool = True,
+        scdet_threshold: float = 0.3,
+        lookahead: int = 0,
+        scene_index: Union[SceneIndex, str, Path, None] = None,
+        timeline: Optional[Timeline] = None,
+        with_info: bool = False,
+    ) -> Iterator[Union[Frame, Tuple[Frame, Optional[Dict[str, Any]]]]]:
+        """
+        Inference a stream of frames with the model, without vapoursynth. Yield the interpolated frames in order.
+
+        :param frames: Any iterable of (H, W, 3) uint8 BGR numpy arrays or (3, H, W) RGB tensors in [0, 1]
+        :param src_fps: The fps of the input frames
+        :param tar_fps: The fps of the interpolated frames
+        :param scale: The flow scale factor
+        :param scdet: Enable SSIM scene change detection
+        :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
+        :param lookahead: The number of following windows inferred in the same inference call
+        :param scene_index: The scene changes of a pre-analysis pass (a SceneIndex or the path of a saved one),
+                            read instead of the inline detection, see ccvfi.scdet.analyze_video
+        :param timeline: The distinct frames and their (retimed) times, the held frames are not interpolated,
+                         see ccvfi.scdet.Timeline.from_held
+        :param with_info: Yield (frame, info) tuples, info is the metadata of the frame, e.g. the path it took, or None
+        :return:
+        """
+
+        cfg: BaseConfig = self.config
+
+        self.frame_cache.maxsize = max(self.frame_cache.maxsize, cfg.in_frame_count + lookahead)
+
+        assert self.device is not None
+        yield from inference_stream(
+            inference=self.inference_windows,
+            frames=frames,
+            src_fps=src_fps,
+            tar_fps=tar_fps,
+            device=self.device,
+            fp16=self.fp16,
+            scale=scale,
+            in_frame_count=cfg.in_frame_count,
+            scdet=scdet,
+            scdet_threshold=scdet_threshold,
+            lookahead=lookahead,
+            scene_index=load_scene_index(scene_index),
+            timeline=timeline,
+            with_info=with_info,
         )
@@ -0,0 +1,12 @@
+from ccvfi.util.registry import Registry
+
+SCDET_REGISTRY: Registry = Registry("SCDET")
+
+from ccvfi.scdet.detector import (  # noqa
+    BaseSceneDetector,
+    HistogramSceneDetector,
+    LumaSceneDetector,
+    SSIMSceneDetector,
+)
+from ccvfi.scdet.index import SceneIndex, analyze_frames, analyze_video  # noqa
+from ccvfi.scdet.cadence import Timeline, detect_held_frames, retime_cadence  # noqa
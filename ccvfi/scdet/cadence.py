@@ -0,0 +1,149 @@
+import bisect
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from ccvfi.scdet.detector import LumaSceneDetector
+from ccvfi.util.stream import Frame, img_to_tensor
+
+# the longest repeating hold pattern detected, 5 covers 2:2, 3:3, 3:2 and 2:2:2:2:1 / 1:1:1:2 pulldowns
+MAX_PERIOD = 5
+
+
+class Timeline:
+    """
+    The distinct frames of a clip and their times on the motion timeline
+
+    A clip animated on twos / threes or telecined holds the same picture for several frames. The timeline keeps only
+    the distinct frames, so the scheduler interpolates between two different pictures, at the time of each distinct
+    frame. With a repeating cadence (e.g. 3:2) the times are retimed evenly, as the motion was shot.
+
+    The times are in source frame units, the virtual index j is the index in the list of distinct frames, a fractional
+    virtual index is mapped to time by linear interpolation between the distinct frames (slope 1 beyond them).
+
+    :param frames: The source indices of the distinct frames, increasing, starting at 0
+    :param num_frames: The number of source frames
+    :param times: The times of the distinct frames. If None, their source indices
+    """
+
+    def __init__(self, frames: Sequence[int], num_frames: int, times: Optional[Sequence[float]] = None) -> None:
+        if len(frames) == 0 or frames[0] != 0:
+            raise ValueError("The first distinct frame should be the frame 0")
+        if any(b <= a for a, b in zip(frames[:-1], frames[1:])) or frames[-1] >= num_frames:
+            raise ValueError("The distinct frames should be increasing source frame indices")
+
+        self.frames: List[int] = [int(f) for f in frames]
+        self.num_frames: int = num_frames
+        self.times: List[float] = [float(t) for t in (times if times is not None else frames)]
+
+        if len(self.times) != len(self.frames):
+            raise ValueError("The timeline should have one time per distinct frame")
+        if any(b <= a for a, b in zip(self.times[:-1], self.times[1:])):
+            raise ValueError("The times of the distinct frames should be increasing")
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def to_time(self, u: float) -> float:
+        """
+        :param u: A (fractional) virtual index
+        :return: The time in source frame units
+        """
+        m = len(self.times)
+        if u <= 0 or m == 1:
+            return self.times[0] + u
+        if u >= m - 1:
+            return self.times[-1] + u - (m - 1)
+        j = int(u)
+        return self.times[j] + (u - j) * (self.times[j + 1] - self.times[j])
+
+    def to_virtual(self, t: float) -> float:
+        """
+        :param t: A time in source frame units
+        :return: The (fractional) virtual index
+        """
+        m = len(self.times)
+        if t <= self.times[0] or m == 1:
+            return t - self.times[0]
+        if t >= self.times[-1]:
+            return m - 1 + t - self.times[-1]
+        j = bisect.bisect_right(self.times, t) - 1
+        return j + (t - self.times[j]) / (self.times[j + 1] - self.times[j])
+
+    def virtual_index(self, idx: int) -> int:
+        """
+        :param idx: A source frame index
+        :return: The virtual index of the distinct frame shown at the source frame idx
+        """
+        return bisect.bisect_right(self.frames, idx) - 1
+
+    @classmethod
+    def from_held(cls, held: Sequence[bool], retime: bool = True, max_hold: int = 3) -> "Timeline":
+        """
+        Build the timeline from the held flags of the frames
+
+        :param held: held[i] is True if the frame i repeats the frame i - 1, held[0] is ignored
+        :param retime: Retime the distinct frames of repeating cadences evenly
+        :param max_hold: The longest hold (in frames) of a cadence
+        :return:
+        """
+        frames = [0] + [i for i in range(1, len(held)) if not held[i]]
+        times = retime_cadence(frames, max_hold=max_hold) if retime else None
+        return cls(frames, num_frames=len(held), times=times)
+
+
+def retime_cadence(frames: Sequence[int], max_hold: int = 3) -> List[float]:
+    """
+    Retime the distinct frames of the segments whose holds repeat with a period up to MAX_PERIOD
+
+    The times of a segment are spread evenly between its first and its last distinct frame, e.g. the holds 3, 2, 3, 2
+    (a 3:2 pulldown) are retimed to 2.5, 2.5, 2.5, 2.5. Irregular holds (e.g. a mix of ones and twos) are kept.
+
+    :param frames: The source indices of the distinct frames
+    :param max_hold: The longest hold (in frames) of a cadence
+    :return: The times of the distinct frames
+    """
+    times = [float(f) for f in frames]
+    holds = np.diff(np.asarray(frames))
+    k = 0
+    while k < len(holds):
+        best_end, best_period = k, 0
+        for p in range(1, MAX_PERIOD + 1):
+            end = k
+            while end < len(holds) and holds[end] <= max_hold and (end - k < p or holds[end] == holds[end - p]):
+                end += 1
+            # whole periods only, so that the segment is evenly spread
+            end = k + (end - k) // p * p
+            if end - k > best_end - k:
+                best_end, best_period = end, p
+
+        # at least two periods of a pattern with a hold
+        if best_period > 0 and best_end - k >= 2 * best_period and holds[k:best_end].max() > 1:
+            step = (frames[best_end] - frames[k]) / (best_end - k)
+            for j in range(k + 1, best_end):
+                times[j] = frames[k] + (j - k) * step
+            k = best_end
+        else:
+            k += 1
+    return times
+
+
+def detect_held_frames(
+    frames: Iterable[Frame], threshold: float = 0.004, device: Optional[torch.device] = None
+) -> List[bool]:
+    """
+    Detect the frames which repeat their previous frame, by the luma difference of their thumbnails
+
+    :param frames: (H, W, 3) uint8 BGR numpy arrays, or (3, H, W) RGB tensors in [0, 1]
+    :param threshold: The largest mean absolute luma difference of a held frame, in [0, 1]
+    :param device: The device of the detection
+    :return: held[i] is True if the frame i repeats the frame i - 1
+    """
+    device = device if device is not None else torch.device("cpu")
+    detector = LumaSceneDetector(threshold=1 - threshold)
+    thumbs = [detector.thumbnail(img_to_tensor(img, device)) for img in frames]
+    if len(thumbs) < 2:
+        return [False] * len(thumbs)
+    scores = detector.score(torch.cat(thumbs[:-1], dim=0), torch.cat(thumbs[1:], dim=0))
+    return [False, *(scores >= detector.threshold).tolist()]
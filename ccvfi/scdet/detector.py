@@ -0,0 +1,110 @@
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+from ccvfi.scdet import SCDET_REGISTRY
+from ccvfi.util.misc import get_scene_thumbnail, ssim_matlab_batch
+
+
+class BaseSceneDetector(ABC):
+    """
+    Base scene change detector
+
+    A detector scores the similarity of many pairs of frame thumbnails in one call, a pair whose score is lower than
+    the threshold is a scene change (greater is sensitive).
+
+    :param threshold: The similarity threshold. If None, use the default threshold of the detector
+    """
+
+    default_threshold: float = 0.3
+
+    def __init__(self, threshold: Optional[float] = None) -> None:
+        self.threshold: float = threshold if threshold is not None else self.default_threshold
+
+    def thumbnail(self, x: Tensor) -> Tensor:
+        """
+        Downsample a frame to the thumbnail compared by the detector
+
+        :param x: 3D (C, H, W), 4D (1, C, H, W) or 5D (1, 1, C, H, W) RGB tensor in [0, 1]
+        :return: (1, C, h, w) tensor
+        """
+        return get_scene_thumbnail(x)
+
+    @abstractmethod
+    def score(self, thumbs0: Tensor, thumbs1: Tensor) -> Tensor:
+        """
+        The similarity of every pair of thumbnails, computed on the device without sync
+
+        :param thumbs0: (N, C, h, w) thumbnails of the first frames
+        :param thumbs1: (N, C, h, w) thumbnails of the second frames
+        :return: (N,) tensor
+        """
+        raise NotImplementedError
+
+    def is_cut(self, scores: Tensor) -> Tensor:
+        """
+        :param scores: (N,) similarity scores
+        :return: (N,) bool tensor, True if the scene changes
+        """
+        return scores < self.threshold
+
+
+@SCDET_REGISTRY.register(name="ssim")
+class SSIMSceneDetector(BaseSceneDetector):
+    """
+    SSIM of the 32x32 thumbnails, the inline detector of the scheduler
+    """
+
+    default_threshold: float = 0.3
+
+    def score(self, thumbs0: Tensor, thumbs1: Tensor) -> Tensor:
+        return ssim_matlab_batch(thumbs0, thumbs1)
+
+
+@SCDET_REGISTRY.register(name="histogram")
+class HistogramSceneDetector(BaseSceneDetector):
+    """
+    Intersection of the per-channel color histograms of the thumbnails, insensitive to motion inside a shot
+
+    :param threshold: The similarity threshold. If None, use the default threshold of the detector
+    :param bins: The number of bins per channel
+    """
+
+    default_threshold: float = 0.5
+
+    def __init__(self, threshold: Optional[float] = None, bins: int = 32) -> None:
+        super().__init__(threshold)
+        self.bins = bins
+
+    def thumbnail(self, x: Tensor) -> Tensor:
+        # a histogram needs more samples than the 32x32 SSIM thumbnail
+        return get_scene_thumbnail(x, size=64)
+
+    def _histogram(self, thumbs: Tensor) -> Tensor:
+        n, c, h, w = thumbs.shape
+        idx = (thumbs.float().clamp(0.0, 1.0) * (self.bins - 1)).round().long().flatten(2)
+        idx = idx + torch.arange(c, device=thumbs.device).view(1, c, 1) * self.bins
+        hist = torch.zeros((n, c * self.bins), device=thumbs.device)
+        hist.scatter_add_(1, idx.flatten(1), torch.ones_like(idx.flatten(1), dtype=hist.dtype))
+        return hist / (h * w)
+
+    def score(self, thumbs0: Tensor, thumbs1: Tensor) -> Tensor:
+        c = thumbs0.shape[1]
+        return torch.minimum(self._histogram(thumbs0), self._histogram(thumbs1)).sum(1) / c
+
+
+@SCDET_REGISTRY.register(name="luma")
+class LumaSceneDetector(BaseSceneDetector):
+    """
+    1 - mean absolute difference of the luma (BT.709) of the thumbnails, the cheapest detector
+    """
+
+    default_threshold: float = 0.85
+
+    def score(self, thumbs0: Tensor, thumbs1: Tensor) -> Tensor:
+        weight = torch.tensor([0.2126, 0.7152, 0.0722], device=thumbs0.device, dtype=torch.float32).view(1, 3, 1, 1)
+        luma0 = (thumbs0[:, :3].float() * weight).sum(1)
+        luma1 = (thumbs1[:, :3].float() * weight).sum(1)
+        return 1 - (luma0 - luma1).abs().flatten(1).mean(1)
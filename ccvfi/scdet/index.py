@@ -0,0 +1,223 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import cv2
+import numpy as np
+import torch
+
+from ccvfi.scdet import SCDET_REGISTRY
+from ccvfi.scdet.detector import BaseSceneDetector
+from ccvfi.util.stream import Frame, img_to_tensor
+
+# the number of pairs scored by one detector call
+_BATCH_SIZE = 64
+
+
+class SceneIndex:
+    """
+    Sidecar index of the scene changes of a clip, the result of a pre-analysis pass
+
+    The index keeps the similarity score of every pair of adjacent frames (i, i + 1), the cuts are the pairs whose
+    score is lower than the threshold, so the threshold can be changed without analysing the clip again.
+
+    :param scores: The similarity score of every pair of adjacent frames
+    :param detector: The name of the detector in SCDET_REGISTRY
+    :param threshold: The similarity threshold of the cuts
+    """
+
+    version: int = 1
+
+    def __init__(self, scores: Union[List[float], np.ndarray], detector: str, threshold: float) -> None:
+        self.scores: np.ndarray = np.asarray(scores, dtype=np.float32)
+        self.detector: str = detector
+        self.threshold: float = threshold
+        self.cuts: np.ndarray = np.flatnonzero(self.scores < threshold)
+        self._cut_set = set(self.cuts.tolist())
+
+    @property
+    def num_frames(self) -> int:
+        return len(self.scores) + 1
+
+    def is_cut(self, idx: int) -> bool:
+        """
+        :param idx: The index of the first frame of the pair (idx, idx + 1)
+        :return: True if the scene changes between the frame idx and idx + 1
+        """
+        return idx in self._cut_set
+
+    def with_threshold(self, threshold: float) -> "SceneIndex":
+        """
+        A copy of the index with another threshold
+
+        :param threshold: The similarity threshold of the cuts
+        :return:
+        """
+        return SceneIndex(self.scores, self.detector, threshold)
+
+    @staticmethod
+    def sidecar_path(video_path: Union[str, Path]) -> Path:
+        """
+        The default path of the index of a video, next to it
+
+        :param video_path: The path of the video
+        :return:
+        """
+        return Path(str(video_path) + ".scdet.json")
+
+    def save(self, path: Union[str, Path]) -> None:
+        data = {
+            "version": self.version,
+            "detector": self.detector,
+            "threshold": self.threshold,
+            "num_frames": self.num_frames,
+            "cuts": self.cuts.tolist(),
+            "scores": [round(float(s), 4) for s in self.scores],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "SceneIndex":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != cls.version:
+            raise ValueError(f"Unsupported scene index version {data.get('version')} in {path}")
+        return cls(data["scores"], data["detector"], data["threshold"])
+
+
+def get_detector(detector: Union[str, BaseSceneDetector], threshold: Optional[float] = None) -> BaseSceneDetector:
+    if isinstance(detector, BaseSceneDetector):
+        return detector
+    return SCDET_REGISTRY.get(detector)(threshold=threshold)
+
+
+def _detector_name(detector: Union[str, BaseSceneDetector]) -> str:
+    if isinstance(detector, str):
+        return detector
+    for name, cls in SCDET_REGISTRY:
+        if type(detector) is cls:
+            return name
+    return type(detector).__name__
+
+
+def _score(detector: BaseSceneDetector, thumbs: List[torch.Tensor]) -> List[float]:
+    scores: List[float] = []
+    for i in range(0, len(thumbs) - 1, _BATCH_SIZE):
+        chunk = thumbs[i : i + _BATCH_SIZE + 1]
+        scores += detector.score(torch.cat(chunk[:-1], dim=0), torch.cat(chunk[1:], dim=0)).tolist()
+    return scores
+
+
+def analyze_frames(
+    frames: Iterable[Frame],
+    detector: Union[str, BaseSceneDetector] = "ssim",
+    threshold: Optional[float] = None,
+    device: Optional[torch.device] = None,
+) -> SceneIndex:
+    """
+    Analyse a sequence of frames in the current process
+
+    :param frames: (H, W, 3) uint8 BGR numpy arrays, or (3, H, W) RGB tensors in [0, 1]
+    :param detector: The detector, or its name in SCDET_REGISTRY
+    :param threshold: The similarity threshold. If None, use the default threshold of the detector
+    :param device: The device of the detector
+    :return:
+    """
+    det = get_detector(detector, threshold)
+    device = device if device is not None else torch.device("cpu")
+    thumbs = [det.thumbnail(img_to_tensor(img, device)) for img in frames]
+    return SceneIndex(_score(det, thumbs), _detector_name(detector), det.threshold)
+
+
+def _analyze_chunk(path: str, start: int, end: int, detector: str, threshold: Optional[float]) -> List[float]:
+    # runs in a worker process, scores the pairs (start, start + 1) ... (end - 1, end)
+    torch.set_num_threads(1)
+    det = get_detector(detector, threshold)
+    cap = cv2.VideoCapture(path)
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        # the seek is inexact on some sources (long GOP, VFR), the scores of a shifted chunk would be misplaced
+        pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        if pos != start:
+            raise ValueError(f"The video {path} can not be seeked to the frame {start}, got the frame {pos}")
+        thumbs = []
+        for _ in range(start, end + 1):
+            ret, img = cap.read()
+            if not ret:
+                break
+            thumbs.append(det.thumbnail(img_to_tensor(img, torch.device("cpu"))))
+    finally:
+        cap.release()
+    if len(thumbs) != end - start + 1:
+        raise ValueError(
+            f"The video {path} has {len(thumbs)} frames from the frame {start}, {end - start + 1} expected"
+        )
+    return _score(det, thumbs)
+
+
+def analyze_video(
+    path: Union[str, Path],
+    detector: str = "ssim",
+    threshold: Optional[float] = None,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 500,
+    save: bool = True,
+) -> SceneIndex:
+    """
+    Analyse a video file over worker processes, each worker decodes a chunk of frames with cv2.VideoCapture
+
+    The chunks overlap by one frame, so every pair of adjacent frames is scored exactly once. A chunk that can not be
+    seeked to its first frame, or decodes fewer frames than expected (e.g. an inexact frame count), raises a
+    ValueError instead of shifting the following cuts.
+
+    :param path: The path of the video
+    :param detector: The name of the detector in SCDET_REGISTRY
+    :param threshold: The similarity threshold. If None, use the default threshold of the detector
+    :param num_workers: The number of worker processes. If None, use the number of cpus
+    :param chunk_size: The number of pairs scored by a worker task
+    :param save: Save the index next to the video, see SceneIndex.sidecar_path
+    :return:
+    """
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        raise ValueError(f"Can not open the video {path}")
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    starts = list(range(0, max(num_frames - 1, 0), chunk_size))
+    scores: List[float] = []
+    if len(starts) > 0:
+        # spawn, torch is not fork safe
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(starts)), mp_context=ctx) as executor:
+            chunks = [(start, min(start + chunk_size, num_frames - 1)) for start in starts]
+            futures = [
+                executor.submit(_analyze_chunk, str(path), start, end, detector, threshold) for start, end in chunks
+            ]
+            for (start, end), future in zip(chunks, futures):
+                chunk_scores = future.result()
+                if len(chunk_scores) != end - start:
+                    raise ValueError(f"The chunk [{start}, {end}] of the video {path} has {len(chunk_scores)} scores")
+                scores += chunk_scores
+
+    index = SceneIndex(scores, detector, get_detector(detector, threshold).threshold)
+    if save:
+        index.save(SceneIndex.sidecar_path(path))
+    return index
+
+
+def load_scene_index(scene_index: Union[SceneIndex, str, Path, None]) -> Optional[SceneIndex]:
+    """
+    :param scene_index: A SceneIndex, the path of a saved index, or None
+    :return:
+    """
+    if scene_index is None or isinstance(scene_index, SceneIndex):
+        return scene_index
+    return SceneIndex.load(scene_index)
@@ -1,10 +1,21 @@
+import copy
+import functools
 import sys
+import weakref
 from abc import ABC, abstractmethod
-from typing import Any, Optional
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
 import torch
 
 from ccvfi.util.device import DEFAULT_DEVICE
+from ccvfi.util.pool import MODEL_POOL, WEIGHT_POOL, ModelPool
+
+
+def _release_pooled(leases: List[Tuple[ModelPool, Hashable, int]]) -> None:
+    # not a method, the finalizer of an instance must not reference it
+    while leases:
+        pool, key, token = leases.pop()
+        pool.release(key, token)
 
 
 class BaseModelInterface(ABC):
@@ -18,6 +29,7 @@ class BaseModelInterface(ABC):
     :param compile_backend: backend of torch.compile
     :param model_dir: The path to cache the downloaded model. Should be a full path. If None, use default cache path.
     :param gh_proxy: The proxy for downloading from github release. Example: https://github.abskoop.workers.dev/
+    :param channels_last: Use the channels_last (NHWC) memory format for the weights and the activations
     """
 
     def __init__(
@@ -29,6 +41,7 @@ class BaseModelInterface(ABC):
         compile_backend: Optional[str] = None,
         model_dir: Optional[str] = None,
         gh_proxy: Optional[str] = None,
+        channels_last: bool = False,
     ) -> None:
         # extra config
         self.one_frame_out: bool = False  # for vsr model type
@@ -41,22 +54,87 @@ class BaseModelInterface(ABC):
         self.compile_backend: Optional[str] = compile_backend
         self.model_dir: Optional[str] = model_dir
         self.gh_proxy: Optional[str] = gh_proxy
+        self.channels_last: bool = channels_last
 
         if device is None:
             self.device = DEFAULT_DEVICE
 
-        self.model: torch.nn.Module = self.load_model()
+        # the loaded module is shared with the other instances of the same key, see get_pool_key
+        self.pool_key: Optional[Hashable] = self.get_pool_key()
+        # the entries of WEIGHT_POOL held by this instance, see acquire_weights
+        self._weights: Dict[Hashable, Any] = {}
+        # the (pool, key, token) of the held entries, the module and the weights are released together, with the
+        # instance or by release
+        self._leases: List[Tuple[ModelPool, Hashable, int]] = []
+        self._finalizer: Optional[weakref.finalize] = weakref.finalize(self, _release_pooled, self._leases)
+        if self.pool_key is None:
+            self.model, self.fp16 = self.build_model()
+        else:
+            (self.model, self.fp16, weights), token = MODEL_POOL.acquire(self.pool_key, self._build_pooled_model)
+            self._leases.append((MODEL_POOL, self.pool_key, token))
+            # the instances sharing the module hold its weights too, the builder already does. The weights are still
+            # loaded, put back as they are if they were evicted
+            for key in weights:
+                self.acquire_weights(key, functools.partial(weights.__getitem__, key))
+
+        self.compile_model()
+
+    def get_pool_key(self) -> Optional[Hashable]:
+        """
+        The key of the loaded module in ccvfi.util.pool.MODEL_POOL, None to load a private one
+
+        :return: What the loaded module depends on, e.g. (weight hash, device, dtype, optimisations)
+        """
+        return None
+
+    def acquire_weights(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Get an entry of ccvfi.util.pool.WEIGHT_POOL, held until the instance is released, once per key
+
+        :param key: The key of the weights, e.g. (weight hash, device)
+        :param factory: Load the weights
+        :return: The shared weights
+        """
+        if key not in self._weights:
+            self._weights[key], token = WEIGHT_POOL.acquire(key, factory)
+            self._leases.append((WEIGHT_POOL, key, token))
+        return self._weights[key]
+
+    def _build_pooled_model(self) -> Tuple[torch.nn.Module, bool, Dict[Hashable, Any]]:
+        model, fp16 = self.build_model()
+        return model, fp16, dict(self._weights)
+
+    def build_model(self) -> Tuple[torch.nn.Module, bool]:
+        """
+        Load the model, convert it to fp16 and to the memory format
+
+        :return: The model and whether it is fp16
+        """
+        model: torch.nn.Module = self.load_model()
+        fp16 = self.fp16
 
         # fp16
-        if self.fp16:
+        if fp16:
             try:
-                self.model = self.model.half()
+                model = model.half()
             except Exception as e:
                 print(f"Error: {e}, fp16 is not supported on this model.")
+                fp16 = False
                 self.fp16 = False
-                self.model = self.load_model()
+                model = self.load_model()
+
+        # channels_last, the convs run in NHWC once their weights are, and keep their outputs in NHWC
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
 
-        # compile
+        return model, fp16
+
+    def compile_model(self) -> None:
+        """
+        Wrap the model with torch.compile if compile is enabled
+
+        :return:
+        """
         if self.compile:
             try:
                 if self.compile_backend is None:
@@ -68,6 +146,43 @@ class BaseModelInterface(ABC):
             except Exception as e:
                 print(f"Error: {e}, compile is not supported on this model.")
 
+    def unshare_model(self) -> None:
+        """
+        Replace a pooled model with a private copy, before modifying it in place
+
+        :return:
+        """
+        if self.pool_key is None:
+            return
+        model = copy.deepcopy(getattr(self.model, "_orig_mod", self.model))
+        self.release()
+        self.model = model
+        self.compile_model()
+
+    def release(self) -> None:
+        """
+        Release the pooled model and weights, they are dropped from the pools with their last holder. Also done on
+        garbage collection.
+
+        :return:
+        """
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self._weights.clear()
+        self.pool_key = None
+
+    def to_memory_format(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Convert a 4D input tensor to the memory format of the model
+
+        :param x: (B, C, H, W) tensor
+        :return:
+        """
+        if self.channels_last:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
     def get_state_dict(self) -> Any:
         raise NotImplementedError
 
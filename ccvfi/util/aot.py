@@ -0,0 +1,93 @@
+import hashlib
+from pathlib import Path
+from typing import Any, Callable, Optional, Sequence, Tuple, Union
+
+import torch
+
+from ccvfi.cache_models import CACHE_PATH
+from ccvfi.type import BaseConfig
+from ccvfi.util.onnx_backend import IFNetExport
+
+# the largest batch (timesteps x windows) of a compiled artifact
+MAX_BATCH = 64
+
+
+def get_artifact_path(
+    config: BaseConfig,
+    key: Tuple[Any, ...],
+    model_dir: Optional[str] = None,
+) -> Path:
+    """
+    Get the path of the AOTInductor artifact of a model, next to its cached weights
+
+    The artifacts are not portable across torch versions and devices, the torch version is part of the key. The
+    weights are baked into the artifact, so is their identity: the hash of the config, and the path, the mtime and
+    the size of config.path (a file replaced under the same name gets a new artifact).
+
+    :param config: The config of the model
+    :param key: What the compiled graph depends on, e.g. (device type, dtype, aligned size, scale list)
+    :param model_dir: The path of the cached weights. If None, the folder of config.path or the default cache path
+    :return: <model_dir>/aot/<config name>-<size>-<hash>.pt2
+    """
+    if model_dir is not None:
+        root = Path(model_dir)
+    elif config.path is not None:
+        root = Path(config.path).parent
+    else:
+        root = CACHE_PATH
+
+    weights: Tuple[Any, ...] = (config.hash,)
+    if config.path is not None:
+        weight_path = Path(config.path).resolve()
+        stat = weight_path.stat()
+        weights = (*weights, str(weight_path), stat.st_mtime_ns, stat.st_size)
+
+    key = (config.name, torch.__version__, weights, *key)
+    digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+    return root / "aot" / f"{Path(config.name).stem}-{digest}.pt2"
+
+
+def compile_ifnet(
+    model: torch.nn.Module,
+    path: Union[str, Path],
+    scale_list: Sequence[float],
+    size: Tuple[int, int],
+) -> Path:
+    """
+    Export IFNet with torch.export and compile it ahead of time with AOTInductor into a package
+
+    The graph has the inputs of ccvfi.util.onnx_backend.IFNetExport, the frames are of the aligned size, the batch
+    is dynamic (up to MAX_BATCH). The device and the dtype are those of the model.
+
+    :param model: The IFNet
+    :param path: The path of the package (.pt2)
+    :param scale_list: The downscale factor of each refinement level
+    :param size: The aligned (h, w) of the frames
+    :return: The path of the package
+    """
+    param = next(model.parameters())
+    img = torch.rand((2, 3, *size), device=param.device, dtype=param.dtype)
+    timestep = torch.full((2, 1, 1, 1), 0.5, device=param.device, dtype=param.dtype)
+    batch = torch.export.Dim("batch", min=1, max=MAX_BATCH)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.inference_mode(False), torch.no_grad():
+        program = torch.export.export(
+            IFNetExport(model, scale_list).eval(),
+            (img, img.clone(), timestep),
+            dynamic_shapes={"img0": {0: batch}, "img1": {0: batch}, "timestep": {0: batch}},
+        )
+        # write to a temporary file first, a concurrent worker never loads a partial package
+        tmp = path.with_suffix(".tmp.pt2")
+        torch._inductor.aoti_compile_and_package(program, package_path=str(tmp))
+    tmp.replace(path)
+    return path
+
+
+def load_artifact(path: Union[str, Path]) -> Callable[..., torch.Tensor]:
+    """
+    :param path: The path of an AOTInductor package
+    :return: The compiled model, called with the inputs of the exported module
+    """
+    return torch._inductor.aoti_load_package(str(path))
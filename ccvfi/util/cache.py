@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """
+    A thread-safe, bounded least-recently-used cache
+
+    :param maxsize: The maximum number of entries, the least recently used entry is evicted when exceeded
+    """
+
+    def __init__(self, maxsize: int = 8) -> None:
+        if maxsize < 1:
+            raise ValueError("The maxsize of the cache should be greater than 0")
+
+        self._maxsize: int = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize: int) -> None:
+        if maxsize < 1:
+            raise ValueError("The maxsize of the cache should be greater than 0")
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """
+        Get the value of the key and mark it as the most recently used one
+
+        :param key: The key
+        :param default: The value returned when the key is not cached
+        :return:
+        """
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Cache the value under the key, evict the least recently used entries if the cache is full
+
+        :param key: The key
+        :param value: The value
+        :return:
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # the entries are not copied, so that a module owning the cache can be deep-copied or pickled
+        return {"maxsize": self._maxsize}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["maxsize"])  # type: ignore
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
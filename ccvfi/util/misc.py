@@ -1,7 +1,8 @@
 import math
 import random
+from functools import lru_cache
 from math import exp
-from typing import Any
+from typing import Any, Sequence, Tuple
 
 import numpy as np
 import torch
@@ -21,17 +22,90 @@ def set_random_seed(seed: int = 0) -> None:
         pass
 
 
-def resize(img: Tensor, _scale: float) -> Tensor:
+# the alignment modes of resize / de_resize: bilinear resampling, or padding with F.pad and cropping back
+ALIGN_MODES = ("resize", "reflect", "replicate")
+
+
+@lru_cache(maxsize=32)
+def get_align_size(h: int, w: int, _scale: float) -> Tuple[int, int]:
+    """
+    The smallest size greater than or equal to (h, w) whose sides are multiples of 64 / scale
+
+    :param h: The height
+    :param w: The width
+    :param _scale: Flow scale.
+    :return: (aligned h, aligned w)
+    """
+    align = 64 / _scale
+    return int(math.ceil(h / align) * align), int(math.ceil(w / align) * align)
+
+
+def resize(img: Tensor, _scale: float, mode: str = "resize") -> Tensor:
+    """
+    Align the frame to the size the model expects, see get_align_size, an aligned frame is returned as is
+
+    :param img: (B, C, H, W) tensor
+    :param _scale: Flow scale.
+    :param mode: "resize" resamples the frame bilinearly, "reflect" / "replicate" pad its bottom and right borders
+    :return:
+    """
     _, _, _h, _w = img.shape
-    while _h * _scale % 64 != 0:
-        _h += 1
-    while _w * _scale % 64 != 0:
-        _w += 1
-    return F.interpolate(img, size=(int(_h), int(_w)), mode="bilinear", align_corners=False)
+    h, w = get_align_size(_h, _w, _scale)
+    if (h, w) == (_h, _w):
+        return img
+    if mode == "resize":
+        return F.interpolate(img, size=(h, w), mode="bilinear", align_corners=False)
+    if mode == "reflect" and (h - _h >= _h or w - _w >= _w):
+        # a reflection can not be wider than the frame
+        mode = "replicate"
+    return F.pad(img, (0, w - _w, 0, h - _h), mode=mode)
+
+
+def de_resize(img: Any, ori_h: int, ori_w: int, mode: str = "resize") -> Tensor:
+    """
+    Undo resize
 
+    :param img: (B, C, H, W) tensor
+    :param ori_h: The height of the frame before resize
+    :param ori_w: The width of the frame before resize
+    :param mode: The mode of resize
+    :return:
+    """
+    if img.shape[2] == ori_h and img.shape[3] == ori_w:
+        return img
+    if mode == "resize":
+        return F.interpolate(img, size=(int(ori_h), int(ori_w)), mode="bilinear", align_corners=False)
+    return img[:, :, :ori_h, :ori_w]
 
-def de_resize(img: Any, ori_h: int, ori_w: int) -> Tensor:
-    return F.interpolate(img, size=(int(ori_h), int(ori_w)), mode="bilinear", align_corners=False)
+
+def get_bucket_size(h: int, w: int, buckets: Sequence[Tuple[int, int]]) -> Tuple[int, int]:
+    """
+    The smallest (by area) of the shape buckets which contains a size
+
+    :param h: The height
+    :param w: The width
+    :param buckets: The (h, w) of the buckets
+    :return: The bucket, or (h, w) if no bucket contains it
+    """
+    fits = [(bh, bw) for bh, bw in buckets if bh >= h and bw >= w]
+    if len(fits) == 0:
+        return h, w
+    return min(fits, key=lambda b: b[0] * b[1])
+
+
+def pad_to(img: Tensor, h: int, w: int) -> Tensor:
+    """
+    Pad the bottom and right borders of the frame to a size by replication, undo with img[:, :, :ori_h, :ori_w]
+
+    :param img: (B, C, H, W) tensor, not larger than (h, w)
+    :param h: The padded height
+    :param w: The padded width
+    :return:
+    """
+    _, _, _h, _w = img.shape
+    if (h, w) == (_h, _w):
+        return img
+    return F.pad(img, (0, w - _w, 0, h - _h), mode="replicate")
 
     # Flow distance calculator
 
@@ -62,6 +136,22 @@ class TMapper:
             return [((_i / self.times) - _min) / (_max - _min) for _i in range(_start, _end)]
         return [_i / self.times for _i in range(_start, _end)]
 
+    def get_pair_timestamp(self, n: int) -> Tuple[int, float]:
+        """
+        Map the output frame n to the source frame pair (i, i + 1) and the normalized timestep between them,
+        consistent with get_range_timestamps(i, i + 1, lclose=True, rclose=False, normalize=True)
+
+        :param n: The output frame index
+        :return: (i, timestep)
+        """
+        i = math.floor(n / self.times)
+        # align with the ceil rounding of get_range_timestamps
+        while i > 0 and math.ceil(i * self.times) > n:
+            i -= 1
+        while math.ceil((i + 1) * self.times) <= n:
+            i += 1
+        return i, n / self.times - i
+
 
 def gaussian(window_size: int, sigma: float) -> Tensor:
     gauss = Tensor([exp(-((x - window_size // 2) ** 2) / float(2 * sigma**2)) for x in range(window_size)])
@@ -76,6 +166,12 @@ def create_window_3d(window_size: int, channel: int = 1) -> Tensor:
     return window
 
 
+@lru_cache(maxsize=16)
+def _get_window_3d(window_size: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+    # the window only depends on its size, build it once per device and dtype
+    return create_window_3d(window_size, channel=1).to(device=device, dtype=dtype)
+
+
 def ssim_matlab(
     img1: Tensor,
     img2: Tensor,
@@ -95,12 +191,23 @@ def ssim_matlab(
         min_val = 0
     L = max_val - min_val
 
-    padd = 0
     (_, _, height, width) = img1.size()
     if window is None:
-        real_size = min(window_size, height, width)
-        window = create_window_3d(real_size, channel=1).to(img1.device).to(img1.dtype)
         # Channel is set to 1 since we consider color images as volumetric images
+        window = _get_window_3d(min(window_size, height, width), img1.device, img1.dtype)
+
+    ssim_map = _ssim_map(img1, img2, window, L)
+
+    if size_average:
+        ret = ssim_map.mean()
+    else:
+        ret = ssim_map.mean(1).mean(1).mean(1)
+
+    return ret
+
+
+def _ssim_map(img1: Tensor, img2: Tensor, window: Tensor, L: Any) -> Tensor:
+    padd = 0
 
     img1 = img1.unsqueeze(1)
     img2 = img2.unsqueeze(1)
@@ -122,14 +229,61 @@ def ssim_matlab(
     v1 = 2.0 * sigma12 + C2
     v2 = sigma1_sq + sigma2_sq + C2
 
-    ssim_map = ((2 * mu1_mu2 + C1) * v1) / ((mu1_sq + mu2_sq + C1) * v2)
+    return ((2 * mu1_mu2 + C1) * v1) / ((mu1_sq + mu2_sq + C1) * v2)
 
-    if size_average:
-        ret = ssim_map.mean()
-    else:
-        ret = ssim_map.mean(1).mean(1).mean(1)
 
-    return ret
+def ssim_matlab_batch(img1: Tensor, img2: Tensor, window_size: int = 11) -> Tensor:
+    """
+    The SSIM of every pair (img1[i], img2[i]) of a batch, same as ssim_matlab on each pair, without device sync
+
+    :param img1: (N, C, H, W) tensor
+    :param img2: (N, C, H, W) tensor
+    :return: (N,) tensor
+    """
+    # the value range of each pair, computed on the device instead of branching on the host
+    flat = img1.flatten(1)
+    max_val = torch.where(flat.max(dim=1).values > 128, 255.0, 1.0)
+    min_val = torch.where(flat.min(dim=1).values < -0.5, -1.0, 0.0)
+    L = (max_val - min_val).to(img1.dtype).view(-1, 1, 1, 1, 1)
+
+    (_, _, height, width) = img1.size()
+    window = _get_window_3d(min(window_size, height, width), img1.device, img1.dtype)
+
+    return _ssim_map(img1, img2, window, L).flatten(1).mean(1)
+
+
+def get_scene_thumbnail(x: Tensor, size: int = 32) -> Tensor:
+    """
+    Downsample a frame to the thumbnail (32x32 by default) used by the scene change detection
+
+    The thumbnail of a frame can be cached and compared with the thumbnails of its two neighbours.
+
+    :param x: 3D (C, H, W), 4D (1, C, H, W) or 5D (1, 1, C, H, W) tensor
+    :param size: The size of the thumbnail
+    :return: (1, C, size, size) tensor
+    """
+    if x.dim() not in [3, 4, 5]:
+        raise ValueError("The input tensor must be 3D, 4D, or 5D.")
+
+    if x.dim() == 3:
+        x = x.unsqueeze(0)
+
+    if x.dim() == 5:
+        x = x.squeeze(0)
+
+    return F.interpolate(x, (size, size), mode="bilinear", align_corners=False)
+
+
+def check_scene_batch(thumbs1: Tensor, thumbs2: Tensor, scdet_threshold: float) -> Tensor:
+    """
+    Check the scene changes of many pairs of thumbnails at once, the result stays on the device
+
+    :param thumbs1: (N, C, 32, 32) thumbnails of the first frames, see get_scene_thumbnail
+    :param thumbs2: (N, C, 32, 32) thumbnails of the second frames
+    :param scdet_threshold: The threshold of the SSIM value.
+    :return: (N,) bool tensor, True if the scene changes between the two frames of the pair
+    """
+    return ssim_matlab_batch(thumbs1, thumbs2) < scdet_threshold
 
 
 def check_scene(x1: Tensor, x2: Tensor, enable_scdet: bool, scdet_threshold: float) -> bool:
@@ -148,21 +302,5 @@ def check_scene(x1: Tensor, x2: Tensor, enable_scdet: bool, scdet_threshold: flo
         return False
     if x1.dim() != x2.dim():
         raise ValueError("The dimensions of the two input tensors must be the same.")
-    if x1.dim() not in [3, 4, 5]:
-        raise ValueError("The input tensor must be 3D, 4D, or 5D.")
-
-    _x1 = x1.clone()
-    _x2 = x2.clone()
-
-    if _x1.dim() == 3:
-        _x1 = _x1.unsqueeze(0)
-        _x2 = _x2.unsqueeze(0)
-
-    if _x1.dim() == 5:
-        _x1 = _x1.squeeze(0)
-        _x2 = _x2.squeeze(0)
-
-    _x1 = F.interpolate(_x1, (32, 32), mode="bilinear", align_corners=False)
-    _x2 = F.interpolate(_x2, (32, 32), mode="bilinear", align_corners=False)
 
-    return ssim_matlab(_x1, _x2).item() < scdet_threshold
+    return bool(check_scene_batch(get_scene_thumbnail(x1), get_scene_thumbnail(x2), scdet_threshold).item())
@@ -0,0 +1,123 @@
+import inspect
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+DEFAULT_OPSET = 17
+
+# the names of the inputs and the output of the exported graph
+INPUT_NAMES = ["img0", "img1", "timestep"]
+OUTPUT_NAMES = ["output"]
+
+
+class IFNetExport(torch.nn.Module):
+    """
+    IFNet with the timestep as an input tensor, the module exported to ONNX. The refinement levels are baked into the
+    graph, the batch, the height and the width are dynamic.
+
+    :param model: The IFNet
+    :param scale_list: The downscale factor of each refinement level
+    """
+
+    def __init__(self, model: torch.nn.Module, scale_list: Sequence[float]) -> None:
+        super().__init__()
+        self.model = model
+        self.scale_list = list(scale_list)
+
+    def forward(self, img0: torch.Tensor, img1: torch.Tensor, timestep: torch.Tensor) -> torch.Tensor:
+        # (B, 1, 1, 1) timestep broadcast to a (B, 1, H, W) map
+        timestep = img0[:, :1] * 0 + timestep
+        return self.model(torch.cat((img0, img1), 1), timestep, self.scale_list)
+
+
+def export_ifnet(
+    model: torch.nn.Module,
+    f: Union[str, "os.PathLike[str]"],
+    scale_list: Sequence[float],
+    opset: int = DEFAULT_OPSET,
+) -> None:
+    """
+    Export IFNet to ONNX
+
+    The graph takes img0 and img1 (B, 3, H, W) in [0, 1], already aligned (see ccvfi.util.misc.resize), and the
+    timestep (B, 1, 1, 1), and returns the interpolated frames (B, 3, H, W). The tiled mode and the early exit of
+    the refinement are not exported.
+
+    :param model: The float IFNet, not quantized
+    :param f: The path of the ONNX model
+    :param scale_list: The downscale factor of each refinement level
+    :param opset: The ONNX opset version
+    :return:
+    """
+    param = next(model.parameters())
+    img = torch.rand((1, 3, 256, 256), device=param.device, dtype=param.dtype)
+    timestep = torch.full((1, 1, 1, 1), 0.5, device=param.device, dtype=param.dtype)
+
+    kwargs: Dict[str, Any] = {}
+    # the dynamic shapes rely on the traced sizes, see ccvfi.arch.arch_utils.warplayer.get_grid
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+
+    with torch.inference_mode(False), torch.no_grad():
+        torch.onnx.export(
+            IFNetExport(model, scale_list).eval(),
+            (img, img.clone(), timestep),
+            f,
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes={
+                "img0": {0: "batch", 2: "height", 3: "width"},
+                "img1": {0: "batch", 2: "height", 3: "width"},
+                "timestep": {0: "batch"},
+                "output": {0: "batch", 2: "height", 3: "width"},
+            },
+            opset_version=opset,
+            **kwargs,
+        )
+
+
+class ORTSession:
+    """
+    An exported IFNet run by onnxruntime, with all the graph optimisations enabled
+
+    :param model: The path or the bytes of the ONNX model
+    :param providers: The execution providers of onnxruntime
+    :param threads: The number of intra-op threads. If None, onnxruntime decides
+    """
+
+    def __init__(
+        self,
+        model: Union[str, Path, bytes],
+        providers: Sequence[str] = ("CPUExecutionProvider",),
+        threads: Optional[int] = None,
+    ) -> None:
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The onnxruntime backend needs onnxruntime: pip install onnxruntime") from e
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session: Any = ort.InferenceSession(
+            model if isinstance(model, bytes) else str(model), sess_options=options, providers=list(providers)
+        )
+
+    @staticmethod
+    def _to_numpy(x: torch.Tensor) -> np.ndarray:
+        return np.ascontiguousarray(x.detach().float().cpu().numpy())
+
+    def __call__(self, img0: torch.Tensor, img1: torch.Tensor, timestep: torch.Tensor) -> torch.Tensor:
+        """
+        :param img0: (B, 3, H, W) aligned frames
+        :param img1: (B, 3, H, W) aligned frames
+        :param timestep: (B, 1, 1, 1) timesteps
+        :return: (B, 3, H, W) interpolated frames, on the device and in the dtype of img0
+        """
+        inputs = {name: self._to_numpy(x) for name, x in zip(INPUT_NAMES, (img0, img1, timestep))}
+        (out,) = self.session.run(OUTPUT_NAMES, inputs)
+        return torch.from_numpy(out).to(device=img0.device, dtype=img0.dtype)
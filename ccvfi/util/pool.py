@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class ModelPool:
+    """
+    Process-wide pool of shared read-only objects (loaded modules, state dicts), with reference counting
+
+    An entry is created by its factory on the first acquire, and handed out to the following ones. The entries
+    released by all their holders are kept for a next acquire, up to max_unused of them (the least recently released
+    one is evicted first), evict drops them explicitly. The holders must not modify the shared objects in place.
+    Each entry gets a new token, an acquire returns it and the release gives it back, so that the holders of an
+    evicted entry never release the entry created after it under the same key.
+
+    :param max_unused: The number of unreferenced entries kept in the pool
+    """
+
+    def __init__(self, max_unused: int = 0) -> None:
+        if max_unused < 0:
+            raise ValueError("The number of unused entries should be greater than or equal to 0")
+        self.max_unused: int = max_unused
+        self._entries: Dict[Hashable, Any] = {}
+        self._refs: Dict[Hashable, int] = {}
+        self._tokens: Dict[Hashable, int] = {}
+        self._next_token: int = 0
+        self._unused: "OrderedDict[Hashable, None]" = OrderedDict()
+        # the keys being created, set once their factory returns or raises
+        self._building: Dict[Hashable, threading.Event] = {}
+        # guards the bookkeeping only, the factories run outside of it
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def refcount(self, key: Hashable) -> int:
+        """
+        :param key: The key of an entry
+        :return: The number of holders of the entry, 0 if it is not in the pool
+        """
+        return self._refs.get(key, 0)
+
+    def acquire(self, key: Hashable, factory: Callable[[], Any]) -> Tuple[Any, int]:
+        """
+        Get the entry of a key, created by the factory if it is not in the pool, and count one more holder.
+        The factory runs outside of the lock, the other keys are acquired meanwhile. A concurrent acquire of the same
+        key waits for the factory instead of loading twice, and calls its own one if that factory raised.
+        The factory must not acquire its own key.
+
+        :param key: The key, e.g. (weight hash, device, dtype, optimisations)
+        :param factory: Create the entry
+        :return: The shared entry and its token, given back to release
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._refs[key] += 1
+                    self._unused.pop(key, None)
+                    return self._entries[key], self._tokens[key]
+                event = self._building.get(key)
+                if event is None:
+                    event = self._building[key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            entry = factory()
+        except BaseException:
+            with self._lock:
+                del self._building[key]
+            event.set()
+            raise
+
+        with self._lock:
+            del self._building[key]
+            self._next_token += 1
+            token = self._next_token
+            self._entries[key] = entry
+            self._refs[key] = 1
+            self._tokens[key] = token
+            self._unused.pop(key, None)
+        event.set()
+        return entry, token
+
+    def release(self, key: Hashable, token: int) -> None:
+        """
+        Count one holder less, an entry without holders is kept up to max_unused unused entries.
+        Releasing an evicted entry does nothing, even if the key was acquired again since.
+
+        :param key: The key of an acquired entry
+        :param token: The token returned by acquire
+        :return:
+        """
+        with self._lock:
+            if self._tokens.get(key) != token or self._refs[key] == 0:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] == 0:
+                self._unused[key] = None
+                while len(self._unused) > self.max_unused:
+                    old, _ = self._unused.popitem(last=False)
+                    self._drop(old)
+
+    def evict(self, key: Optional[Hashable] = None) -> int:
+        """
+        Drop entries from the pool, their holders keep using them, the next acquire creates a new one
+
+        :param key: The key of the entry to drop, even if it is held. If None, drop all the unused entries
+        :return: The number of dropped entries
+        """
+        with self._lock:
+            if key is not None:
+                if key not in self._entries:
+                    return 0
+                self._drop(key)
+                return 1
+            unused = list(self._unused)
+            for k in unused:
+                self._drop(k)
+            return len(unused)
+
+    def clear(self) -> None:
+        """
+        Drop all the entries
+
+        :return:
+        """
+        with self._lock:
+            for k in list(self._entries):
+                self._drop(k)
+
+    def _drop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        self._refs.pop(key, None)
+        self._tokens.pop(key, None)
+        self._unused.pop(key, None)
+
+
+# the loaded modules, shared by the model instances with the same key and dropped with their last holder
+MODEL_POOL = ModelPool(max_unused=0)
+
+# the loaded state dicts, the last released one is kept, e.g. two configs with the same weights or a fp16 fallback
+WEIGHT_POOL = ModelPool(max_unused=1)
@@ -0,0 +1,326 @@
+import math
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from ccvfi.util.misc import TMapper, check_scene_batch, get_scene_thumbnail
+
+if TYPE_CHECKING:
+    from ccvfi.scdet import SceneIndex, Timeline
+
+
+class RingBuffer:
+    """
+    A fixed-size, thread-safe ring buffer indexed by frame index, with O(1) lookup
+
+    The slot idx % capacity keeps the latest value put with it, an index overwritten by a newer one reads as missing.
+
+    :param capacity: The number of slots
+    """
+
+    def __init__(self, capacity: int) -> None:
+        if capacity < 1:
+            raise ValueError("The capacity of the ring buffer should be greater than 0")
+
+        self.capacity: int = capacity
+        self._keys: List[Optional[int]] = [None] * capacity
+        self._values: List[Any] = [None] * capacity
+        self._lock = threading.Lock()
+
+    def get(self, idx: int) -> Any:
+        slot = idx % self.capacity
+        with self._lock:
+            if self._keys[slot] != idx:
+                return None
+            return self._values[slot]
+
+    def put(self, idx: int, value: Any) -> None:
+        slot = idx % self.capacity
+        with self._lock:
+            self._keys[slot] = idx
+            self._values[slot] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys = [None] * self.capacity
+            self._values = [None] * self.capacity
+
+
+class VFIScheduler:
+    """
+    Sliding-window scheduler of video frame interpolation, for models with any number of input frames
+
+    The window of step i is the in_frame_count source frames i - (N - 1) // 2 ... i + N // 2 (clamped to the clip),
+    centered on c = i for odd N and c = i + 0.5 for even N. Step i infers all the output frames whose time falls in
+    [c - 0.5, c + 0.5), so the output frame n is deterministically mapped to a step, and can be requested in any order
+    and from several threads. Output frames behind the last step repeat the last source frame.
+
+    With a timeline (see ccvfi.scdet.Timeline) the windows are made of the distinct frames only, the held frames are
+    skipped, and the time of the output frames is mapped onto the (retimed) times of the distinct frames.
+
+    The input tensors, their scene detection thumbnails, the scene flags and the output tensors live in fixed-size
+    ring buffers, the memory footprint is in_capacity input frames plus out_capacity output frames. The thumbnail of a
+    frame is computed once, and the scene flags of all the new pairs of an inference call are evaluated in one batch
+    with a single device sync.
+
+    The inference function is called with the windows of the requested step and of the next `lookahead` steps:
+
+        outputs, reuse = inference(windows, timestamps, scenes, frame_keys, scale, reuse)
+
+    - windows: list of (1, N, C, H, W) tensors
+    - timestamps: list of the timestamps of the output frames of each window, relative to its center, in [-0.5, 0.5)
+    - scenes: list of the N - 1 scene change flags between the adjacent frames of each window
+    - frame_keys: list of the N keys of the frames of each window, unique per scheduler, for per-frame caching
+    - scale: the flow scale
+    - reuse: what the previous call returned if its last window directly precedes the first one, otherwise None
+    - outputs: list of the output frames of each window, (1, C, H, W) tensors in the order of timestamps
+
+    The inference function may return a third item, the metadata dicts of the output frames (same layout as outputs),
+    e.g. the path an output frame took, read back with get_info, or None without metadata.
+
+    :param inference: The window inference function
+    :param fetch: The function returning the (1, 1, C, H, W) input tensor of a source frame index
+    :param num_frames: The number of source frames
+    :param mapper: The framerate mapper
+    :param in_frame_count: The input frame count of the vfi method once infer
+    :param scale: The flow scale factor
+    :param scdet: Enable SSIM scene change detection
+    :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
+    :param lookahead: The number of following steps inferred in the same call
+    :param in_capacity: The number of input frames kept in the ring buffer. If None, the minimum for a sequential run
+    :param scene_index: The scene changes of a pre-analysis pass, read instead of the inline detection
+    :param timeline: The distinct frames of the clip and their times, to skip the held frames
+    """
+
+    def __init__(
+        self,
+        inference: Callable,
+        fetch: Callable[[int], torch.Tensor],
+        num_frames: int,
+        mapper: TMapper,
+        in_frame_count: int,
+        scale: float = 1.0,
+        scdet: bool = True,
+        scdet_threshold: float = 0.3,
+        lookahead: int = 0,
+        in_capacity: Optional[int] = None,
+        scene_index: Optional["SceneIndex"] = None,
+        timeline: Optional["Timeline"] = None,
+    ) -> None:
+        if in_frame_count < 1:
+            raise ValueError("The input frame count should be greater than 0")
+
+        if lookahead < 0:
+            raise ValueError("The lookahead should be greater than or equal to 0")
+
+        self.inference = inference
+        self.fetch = fetch
+        self.num_frames: int = num_frames
+        self.mapper = mapper
+        self.in_frame_count = in_frame_count
+        self.scale = scale
+        self.scdet = scdet
+        self.scdet_threshold = scdet_threshold
+        self.lookahead = lookahead
+        self.scene_index = scene_index
+        self.timeline = timeline
+
+        self.offset: float = 0.5 if in_frame_count % 2 == 0 else 0.0
+        self.last_step: int = 0
+        self.num_outputs: int = 0
+        self.set_num_frames(num_frames)
+
+        self.in_capacity: int = in_capacity if in_capacity is not None else in_frame_count + lookahead + 1
+        # the longest step spans the longest gap between two distinct frames
+        gap = 1.0 if timeline is None else max([1.0] + [b - a for a, b in zip(timeline.times[:-1], timeline.times[1:])])
+        self.out_capacity: int = (math.ceil(mapper.times * gap) + 1) * (lookahead + 1) * 2
+        self._inputs = RingBuffer(self.in_capacity)
+        self._thumbs = RingBuffer(self.in_capacity)
+        self._scenes = RingBuffer(self.in_capacity)
+        self._outputs = RingBuffer(self.out_capacity)
+        self._infos = RingBuffer(self.out_capacity)
+
+        # unique per scheduler, so that the frame keys never collide with another clip inferred by the same model
+        self._token = object()
+        self._lock = threading.Lock()
+        self._reuse: Any = None
+        self._reuse_step: int = -2
+
+    def set_num_frames(self, num_frames: int) -> None:
+        """
+        Set the number of source frames, e.g. once the end of a stream of unknown length is reached
+
+        :param num_frames: The number of source frames
+        :return:
+        """
+        # the windows are made of the distinct frames of the timeline
+        window_frames = len(self.timeline) if self.timeline is not None else num_frames
+        if window_frames < self.in_frame_count:
+            raise ValueError(
+                f"Do not have enough frames for vfi method require {self.in_frame_count} frames once infer"
+            )
+
+        self.num_frames = window_frames
+        self.last_step = window_frames - 1 - (1 if self.in_frame_count % 2 == 0 else 0)
+        self.num_outputs = math.ceil(num_frames * self.mapper.times)
+
+    def _to_time(self, u: float) -> float:
+        # the frame index of the windows to the time in source frames
+        return u if self.timeline is None else self.timeline.to_time(u)
+
+    def _to_index(self, t: float) -> float:
+        return t if self.timeline is None else self.timeline.to_virtual(t)
+
+    def window(self, i: int) -> List[int]:
+        """
+        The source frame indices of the window of step i, clamped to the clip
+
+        :param i: The step index
+        :return:
+        """
+        start = i - (self.in_frame_count - 1) // 2
+        return [min(max(start + j, 0), self.num_frames - 1) for j in range(self.in_frame_count)]
+
+    def step_of(self, n: int) -> int:
+        """
+        The step inferring the output frame n
+
+        :param n: The output frame index
+        :return:
+        """
+        times = self.mapper.times
+        i = math.floor(self._to_index(n / times) - self.offset + 0.5)
+        # align with the ceil rounding of TMapper.get_range_timestamps
+        while i > 0 and math.ceil(self._to_time(i + self.offset - 0.5) * times) > n:
+            i -= 1
+        while math.ceil(self._to_time(i + self.offset + 0.5) * times) <= n:
+            i += 1
+        return i
+
+    def step_outputs(self, i: int) -> List[Tuple[int, float]]:
+        """
+        The output frames of step i, with their timestamps relative to the window center
+
+        :param i: The step index
+        :return: list of (output frame index, timestamp)
+        """
+        times = self.mapper.times
+        c = i + self.offset
+        first = math.ceil(self._to_time(c - 0.5) * times)
+        end = math.ceil(self._to_time(c + 0.5) * times)
+        return [(k, self._to_index(k / times) - c) for k in range(max(first, 0), end)]
+
+    def _fetch(self, idx: int) -> torch.Tensor:
+        x = self._inputs.get(idx)
+        if x is None:
+            x = self.fetch(idx if self.timeline is None else self.timeline.frames[idx])
+            self._inputs.put(idx, x)
+        return x
+
+    def _thumb(self, idx: int) -> torch.Tensor:
+        thumb = self._thumbs.get(idx)
+        if thumb is None:
+            thumb = get_scene_thumbnail(self._fetch(idx))
+            self._thumbs.put(idx, thumb)
+        return thumb
+
+    def _detect_scenes(self, pairs: List[Tuple[int, int]]) -> None:
+        # the scene flag of the pair (a, a + 1) is cached under a
+        todo = sorted({a for a, b in pairs if a != b and self._scenes.get(a) is None})
+        if not self.scdet or len(todo) == 0:
+            return
+        if self.scene_index is not None:
+            for a in todo:
+                if self.timeline is None:
+                    self._scenes.put(a, self.scene_index.is_cut(a))
+                else:
+                    # a cut anywhere between two distinct frames
+                    src = range(self.timeline.frames[a], self.timeline.frames[a + 1])
+                    self._scenes.put(a, any(self.scene_index.is_cut(k) for k in src))
+            return
+        thumbs0 = torch.cat([self._thumb(a) for a in todo], dim=0)
+        thumbs1 = torch.cat([self._thumb(a + 1) for a in todo], dim=0)
+        for a, scene in zip(todo, check_scene_batch(thumbs0, thumbs1, self.scdet_threshold).tolist()):
+            self._scenes.put(a, scene)
+
+    def _scene(self, a: int, b: int) -> bool:
+        if a == b or not self.scdet:
+            return False
+        scene = self._scenes.get(a)
+        if scene is None:
+            self._detect_scenes([(a, b)])
+            scene = self._scenes.get(a)
+        return bool(scene)
+
+    def _infer_steps(self, first: int) -> Dict[int, torch.Tensor]:
+        steps = list(range(first, min(first + self.lookahead + 1, self.last_step + 1)))
+
+        self._detect_scenes([p for i in steps for p in zip(self.window(i)[:-1], self.window(i)[1:])])
+
+        windows, timestamps, scenes, frame_keys, indices = [], [], [], [], []
+        for i in steps:
+            frames = self.window(i)
+            outs = self.step_outputs(i)
+            windows.append(torch.cat([self._fetch(j) for j in frames], dim=1))
+            timestamps.append([t for _, t in outs])
+            scenes.append([self._scene(a, b) for a, b in zip(frames[:-1], frames[1:])])
+            frame_keys.append([(self._token, j) for j in frames])
+            indices.append([k for k, _ in outs])
+
+        reuse = self._reuse if self._reuse_step == first - 1 else None
+        ret = self.inference(windows, timestamps, scenes, frame_keys, self.scale, reuse)
+        outputs, self._reuse = ret[0], ret[1]
+        infos = ret[2] if len(ret) > 2 else None
+        if infos is None:
+            infos = [[None] * len(idx) for idx in indices]
+        self._reuse_step = steps[-1]
+
+        result: Dict[int, torch.Tensor] = {}
+        for idx, out, info in zip(indices, outputs, infos):
+            for k, o, m in zip(idx, out, info):
+                result[k] = o
+                # the metadata first, so that it is ready when the output is found
+                self._infos.put(k, m)
+                self._outputs.put(k, o)
+
+        return result
+
+    def get(self, n: int) -> torch.Tensor:
+        """
+        Get the output frame n, inferring its step (and the lookahead ones) if it is not cached
+
+        :param n: The output frame index
+        :return: (1, C, H, W) tensor
+        """
+        i = self.step_of(n)
+
+        # behind the last step
+        if i > self.last_step:
+            return self._fetch(self.num_frames - 1).squeeze(0)
+
+        out = self._outputs.get(n)
+        if out is not None:
+            return out
+
+        # fetch outside the lock, so that it overlaps with the inference of other threads
+        for idx in self.window(i):
+            self._fetch(idx)
+
+        with self._lock:
+            out = self._outputs.get(n)
+            if out is None:
+                out = self._infer_steps(i)[n]
+
+        return out
+
+    def get_info(self, n: int) -> Optional[Dict[str, Any]]:
+        """
+        Get the metadata the inference function returned with the output frame n, call it after get(n)
+
+        :param n: The output frame index
+        :return: The metadata dict, {"path": "source"} behind the last step, None if the inference returned none
+        """
+        if self.step_of(n) > self.last_step:
+            return {"path": "source"}
+        return self._infos.get(n)
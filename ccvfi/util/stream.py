@@ -0,0 +1,174 @@
+import math
+import sys
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, Optional, Protocol, Tuple, Union
+
+import cv2
+import numpy as np
+import torch
+
+from ccvfi.util.misc import TMapper
+from ccvfi.util.scheduler import RingBuffer, VFIScheduler
+
+if TYPE_CHECKING:
+    from ccvfi.scdet import SceneIndex, Timeline
+
+Frame = Union[np.ndarray, torch.Tensor]
+
+
+class FrameSource(Protocol):
+    """
+    A source of frames for the streaming API, any iterable works, e.g. a list, a generator or a video reader
+
+    The frames are either (H, W, 3) uint8 BGR numpy arrays (cv2 convention), or (3, H, W) RGB tensors in [0, 1].
+    """
+
+    def __iter__(self) -> Iterator[Frame]:
+        ...
+
+
+def img_to_tensor(img: Frame, device: torch.device, fp16: bool = False) -> torch.Tensor:
+    """
+    Convert a frame to a (1, 1, 3, H, W) input tensor
+
+    :param img: (H, W, 3) uint8 BGR numpy array, or (3, H, W) RGB tensor in [0, 1]
+    :param device: The device
+    :param fp16: Convert to half precision
+    :return:
+    """
+    if isinstance(img, np.ndarray):
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        tensor = torch.from_numpy(img).to(device).permute(2, 0, 1).float() / 255.0
+    else:
+        tensor = img.to(device).float()
+
+    if fp16:
+        tensor = tensor.half()
+
+    return tensor.unsqueeze(0).unsqueeze(0)
+
+
+def tensor_to_img(tensor: torch.Tensor) -> np.ndarray:
+    """
+    Convert a (1, 3, H, W) output tensor to a (H, W, 3) uint8 BGR numpy array
+
+    :param tensor: The output tensor
+    :return:
+    """
+    img = tensor.squeeze(0).permute(1, 2, 0).float().cpu().numpy()
+    img = (img * 255).clip(0, 255).astype("uint8")
+    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+
+def inference_stream(
+    inference: Callable,
+    frames: FrameSource,
+    src_fps: float,
+    tar_fps: float,
+    device: torch.device,
+    fp16: bool = False,
+    scale: float = 1.0,
+    in_frame_count: int = 2,
+    scdet: bool = True,
+    scdet_threshold: float = 0.3,
+    lookahead: int = 0,
+    scene_index: Optional["SceneIndex"] = None,
+    timeline: Optional["Timeline"] = None,
+    with_info: bool = False,
+) -> Iterator[Union[Frame, Tuple[Frame, Optional[Dict[str, Any]]]]]:
+    """
+    Interpolate a stream of frames, without vapoursynth
+
+    The frames are read lazily and scheduled by the same ccvfi.util.scheduler.VFIScheduler as the vapoursynth node,
+    only the frames of the current windows are kept in memory, so the memory stays constant over long inputs.
+    The output frames are yielded in order, with the same type as the input frames.
+
+    :param inference: The window inference function
+    :param frames: The input frames
+    :param src_fps: The fps of the input frames
+    :param tar_fps: The fps of the interpolated frames
+    :param device: The device
+    :param fp16: Inference in half precision
+    :param scale: The flow scale factor
+    :param in_frame_count: The input frame count of vfi method once infer
+    :param scdet: Enable SSIM scene change detection
+    :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
+    :param lookahead: The number of following windows inferred in the same inference call
+    :param scene_index: The scene changes of a pre-analysis pass, read instead of the inline detection
+    :param timeline: The distinct frames of the stream and their times, the held frames are read but not buffered
+    :param with_info: Yield (frame, info) tuples, info is the metadata of the frame, see VFIScheduler.get_info
+    :return:
+    """
+
+    if src_fps > tar_fps:
+        raise ValueError("The target fps should be greater than the source fps")
+
+    if scale < 0 or not math.log2(scale).is_integer():
+        raise ValueError("The scale should be greater than 0 and is power of two")
+
+    iterator = iter(frames)
+    capacity = in_frame_count + lookahead + 1
+    inputs = RingBuffer(capacity)
+    num_read: int = 0
+    ended: bool = False
+    finalized: bool = False
+    to_numpy: Optional[bool] = None
+
+    def slot(idx: int) -> int:
+        # with a timeline only the distinct frames are buffered, by their index in the timeline
+        return idx if timeline is None else timeline.virtual_index(idx)
+
+    def read_until(idx: int) -> None:
+        nonlocal num_read, ended, to_numpy
+        while not ended and num_read <= idx:
+            try:
+                img = next(iterator)
+            except StopIteration:
+                ended = True
+                break
+            if to_numpy is None:
+                to_numpy = isinstance(img, np.ndarray)
+            if timeline is None or timeline.frames[slot(num_read)] == num_read:
+                inputs.put(slot(num_read), img_to_tensor(img, device=device, fp16=fp16))
+            num_read += 1
+
+    def fetch(idx: int) -> torch.Tensor:
+        x = inputs.get(slot(idx))
+        if x is None:
+            raise IndexError(f"Frame {idx} is not buffered any more, the stream can not seek backwards")
+        return x
+
+    # the length is unknown until the end of the stream, the windows are not clamped at the tail before
+    scheduler = VFIScheduler(
+        inference=inference,
+        fetch=fetch,
+        num_frames=sys.maxsize if timeline is None else timeline.num_frames,
+        mapper=TMapper(src_fps, tar_fps),
+        in_frame_count=in_frame_count,
+        scale=scale,
+        scdet=scdet,
+        scdet_threshold=scdet_threshold,
+        lookahead=lookahead,
+        in_capacity=capacity,
+        scene_index=scene_index,
+        timeline=timeline,
+    )
+
+    n = 0
+    while not ended or n < scheduler.num_outputs:
+        i = scheduler.step_of(n)
+        last = scheduler.window(i + lookahead)[-1]
+        target = last if timeline is None else timeline.frames[last]
+        if n >= scheduler.num_outputs:
+            # behind the frames of the timeline, read until the end of the stream
+            target = num_read
+        read_until(target)
+        if ended and not finalized:
+            scheduler.set_num_frames(num_read)
+            finalized = True
+            if n >= scheduler.num_outputs:
+                break
+
+        out = scheduler.get(n)
+        img = tensor_to_img(out) if to_numpy else out.squeeze(0)
+        yield (img, scheduler.get_info(n)) if with_info else img
+        n += 1
@@ -1,16 +1,67 @@
+import threading
+from typing import Optional
+
 import numpy as np
 import torch
 import vapoursynth as vs
 
+# per-thread pinned staging buffers for host to device copies, reused across frames of the same shape
+_staging = threading.local()
+
+
+def _get_staging(shape: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+    buf: Optional[torch.Tensor] = getattr(_staging, "buf", None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+        _staging.buf = buf
+    return buf
+
+
+def frame_to_tensor(frame: vs.VideoFrame, device: torch.device, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Read the planes of a frame into a (C, H, W) tensor
+
+    Every plane is copied once, straight into its slice of the destination (or of a reused pinned staging buffer
+    which is then sent to the device in a single transfer), no intermediate per-plane tensors are stacked.
 
-def frame_to_tensor(frame: vs.VideoFrame, device: torch.device) -> torch.Tensor:
-    return torch.stack(
-        [torch.from_numpy(np.asarray(frame[plane])).to(device) for plane in range(frame.format.num_planes)]
-    ).clamp(0.0, 1.0)
+    :param frame: The vapoursynth frame
+    :param device: The device of the returned tensor
+    :param out: A preallocated (C, H, W) tensor to read into, reused by the caller. If None, a new one is allocated
+    :return:
+    """
+    planes = [np.asarray(frame[plane]) for plane in range(frame.format.num_planes)]
+    shape = torch.Size((len(planes), *planes[0].shape))
+    dtype = torch.from_numpy(planes[0]).dtype
+
+    if out is None:
+        out = torch.empty(shape, dtype=dtype, device=device)
+
+    if out.device.type == "cpu":
+        for plane, array in enumerate(planes):
+            out[plane].copy_(torch.from_numpy(array))
+    else:
+        staging = _get_staging(shape, dtype)
+        for plane, array in enumerate(planes):
+            staging[plane].copy_(torch.from_numpy(array))
+        # synchronous, the staging buffer is reused by the next frame of this thread
+        out.copy_(staging)
+
+    return out.clamp_(0.0, 1.0)
 
 
 def tensor_to_frame(tensor: torch.Tensor, frame: vs.VideoFrame) -> vs.VideoFrame:
-    array = tensor.squeeze(0).detach().cpu().numpy()
+    """
+    Write a (1, C, H, W) or (C, H, W) tensor into the planes of a writable frame
+
+    The planes are written in place through a tensor view of the frame memory, without an intermediate host copy.
+
+    :param tensor: The tensor
+    :param frame: The writable destination frame
+    :return:
+    """
+    tensor = tensor.detach()
+    if tensor.dim() == 4:
+        tensor = tensor.squeeze(0)
     for plane in range(frame.format.num_planes):
-        np.copyto(np.asarray(frame[plane]), array[plane])
+        torch.from_numpy(np.asarray(frame[plane])).copy_(tensor[plane])
     return frame
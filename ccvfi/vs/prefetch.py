@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+import torch
+import vapoursynth as vs
+
+from ccvfi.util.cache import LRUCache
+
+
+class FramePrefetcher:
+    """
+    Prefetch the source frames of a clip and convert them to tensors ahead of the inference
+
+    Requesting frame n starts decoding the next `depth` frames with get_frame_async, their conversion to tensors runs
+    in a worker thread while the model infers the current frames. The fetched tensors are kept in a thread-safe
+    bounded cache, so the prefetcher can be shared by the threads of a vapoursynth node.
+
+    :param clip: The source clip
+    :param convert: The function converting a source frame to an input tensor
+    :param depth: The number of frames prefetched ahead of the requested one, 0 to disable prefetching
+    :param cache_size: The number of fetched tensors kept in cache, at least depth + 1
+    """
+
+    def __init__(
+        self,
+        clip: vs.VideoNode,
+        convert: Callable[[vs.VideoFrame], torch.Tensor],
+        depth: int = 2,
+        cache_size: int = 4,
+    ) -> None:
+        if depth < 0:
+            raise ValueError("The prefetch depth should be greater than or equal to 0")
+
+        self.clip = clip
+        self.convert = convert
+        self.depth = depth
+
+        self._futures = LRUCache(maxsize=max(cache_size, depth + 1))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ccvfi_prefetch")
+        self._lock = threading.Lock()
+
+        # statistics
+        self.requests: int = 0
+        self.starved: int = 0
+
+    def _convert(self, frame: "Future[vs.VideoFrame]", future: "Future[torch.Tensor]") -> None:
+        if future.done():
+            return
+        try:
+            tensor = self.convert(frame.result())
+        except Exception as e:
+            with self._lock:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        with self._lock:
+            if not future.done():
+                future.set_result(tensor)
+
+    def _submit(self, idx: int) -> "Future[torch.Tensor]":
+        with self._lock:
+            future = self._futures.get(idx)
+            if future is None:
+                future = Future()
+                self._futures.put(idx, future)
+                # decoding starts on the vapoursynth threads right away, the conversion is queued to the worker
+                # once the frame is ready
+                self.clip.get_frame_async(idx).add_done_callback(
+                    lambda frame, _future=future: self._executor.submit(self._convert, frame, _future)
+                )
+            return future
+
+    def get(self, idx: int) -> torch.Tensor:
+        """
+        Get the input tensor of the source frame idx, and prefetch the following frames
+
+        :param idx: The source frame index
+        :return:
+        """
+        future = self._submit(idx)
+        for i in range(idx + 1, min(idx + 1 + self.depth, self.clip.num_frames)):
+            self._submit(i)
+
+        with self._lock:
+            self.requests += 1
+            ready = future.done()
+            if not ready:
+                self.starved += 1
+
+        if ready:
+            return future.result()
+
+        # starved, never block on another thread: with core.num_threads == 1 the only vapoursynth thread may be
+        # the caller itself. get_frame hands its thread back to vapoursynth while waiting
+        tensor = self.convert(self.clip.get_frame(idx))
+        with self._lock:
+            if not future.done():
+                future.set_result(tensor)
+        return tensor
+
+    @property
+    def starvation_rate(self) -> float:
+        """
+        The ratio of requests which had to wait for the decoding or the conversion of their frame
+        """
+        return self.starved / self.requests if self.requests > 0 else 0.0
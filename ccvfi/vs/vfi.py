@@ -1,13 +1,15 @@
 import math
-from typing import Callable, Dict
+from typing import Callable, Optional
 
-import numpy as np
 import torch
 import vapoursynth as vs
 from vapoursynth import core
 
-from ccvfi.util.misc import TMapper, check_scene
+from ccvfi.scdet import SceneIndex, Timeline
+from ccvfi.util.misc import TMapper
+from ccvfi.util.scheduler import VFIScheduler
 from ccvfi.vs.convert import frame_to_tensor, tensor_to_frame
+from ccvfi.vs.prefetch import FramePrefetcher
 
 
 def inference_vfi(
@@ -19,11 +21,24 @@ def inference_vfi(
     in_frame_count: int = 2,
     scdet: bool = True,
     scdet_threshold: float = 0.3,
+    lookahead: int = 0,
+    prefetch: int = 2,
+    scene_index: Optional[SceneIndex] = None,
+    timeline: Optional[Timeline] = None,
 ) -> vs.VideoNode:
     """
     Inference the video with the model, the clip should be a vapoursynth clip
 
-    :param inference: The inference function
+    The frames are scheduled by ccvfi.util.scheduler.VFIScheduler: the output frame n is mapped to a window of
+    in_frame_count source frames, so the node supports out of order requests and core.num_threads > 1.
+    The inference function is called with the windows, see VFIScheduler for its signature.
+
+    The output frames carry the prefetch statistics in the frame props ccvfi_prefetch_requests and
+    ccvfi_prefetch_starved (the number of source frames the inference had to wait for). When the inference function
+    returns metadata, they also carry the path of the frame in ccvfi_vfi_path (e.g. model, blend, copy, scene,
+    source) and the estimated motion of its pair in ccvfi_vfi_motion
+
+    :param inference: The window inference function
     :param clip: vs.VideoNode
     :param scale: The flow scale factor
     :param tar_fps: The fps of the interpolated video
@@ -31,12 +46,13 @@ def inference_vfi(
     :param in_frame_count: The input frame count of vfi method once infer
     :param scdet: Enable SSIM scene change detection
     :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
+    :param lookahead: The number of following windows inferred in the same inference call
+    :param prefetch: The number of source frames decoded and converted to tensors ahead of the inference
+    :param scene_index: The scene changes of a pre-analysis pass, read instead of the inline detection
+    :param timeline: The distinct frames of the clip and their times, only the distinct frames are interpolated
     :return:
     """
 
-    if core.num_threads != 1:
-        raise ValueError("The number of threads must be 1 when enable frame interpolation")
-
     if clip.format.id not in [vs.RGBH, vs.RGBS]:
         raise vs.Error("Only vs.RGBH and vs.RGBS formats are supported")
 
@@ -50,215 +66,58 @@ def inference_vfi(
     if scale < 0 or not math.log2(scale).is_integer():
         raise ValueError("The scale should be greater than 0 and is power of two")
 
-    vfi_methods = {
-        2: inference_vsr_two_frame_in,
-        3: inference_vsr_three_frame_in,
-    }
+    if lookahead < 0:
+        raise ValueError("The lookahead should be greater than or equal to 0")
 
-    if in_frame_count not in vfi_methods:
-        raise ValueError(f"The vfi method with {in_frame_count} frame input is not supported")
-
-    mapper = TMapper(src_fps, tar_fps)
+    if prefetch < 0:
+        raise ValueError("The prefetch depth should be greater than or equal to 0")
 
-    return vfi_methods[in_frame_count](inference, clip, mapper, scale, scdet, scdet_threshold, device)
+    if scene_index is not None and scene_index.num_frames != clip.num_frames:
+        raise ValueError(
+            f"The scene index covers {scene_index.num_frames} frames, but the clip has {clip.num_frames} frames"
+        )
 
+    if timeline is not None and timeline.num_frames != clip.num_frames:
+        raise ValueError(f"The timeline covers {timeline.num_frames} frames, but the clip has {clip.num_frames} frames")
 
-def inference_vsr_two_frame_in(
-    inference: Callable,
-    clip: vs.VideoNode,
-    mapper: TMapper,
-    scale: float,
-    scdet: bool,
-    scdet_threshold: float,
-    device: torch.device,
-) -> vs.VideoNode:
-    """
-    VFI for two frame input models
-
-    f1, f2 -> f1?, f1t?, f2?
-
-    For the two frame input model, the inference function should accept a tensor with shape (b, 2, c, h, w)
-    And return a tensor with shape (b, c, h, w)
-
-    :param inference: The inference function
-    :param clip: vs.VideoNode
-    :param scale: The flow scale factor
-    :param mapper: The framerate mapper
-    :param scdet: Enable SSIM scene change detection
-    :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
-    :param device: The device
-    :return:
-    """
-
-    in_idx: int = 0
-    out_idx: int = 0
-    in_frames: Dict[int, torch.Tensor] = {}
-    out_frames: Dict[int, torch.Tensor] = {}
-    flag_end: bool = False
-    reuse: tuple[torch.Tensor, ...]
+    mapper = TMapper(src_fps, tar_fps)
 
     def to_input_tensor(x: vs.VideoFrame) -> torch.Tensor:
         return frame_to_tensor(x, device=device).unsqueeze(0).unsqueeze(0)
 
-    new_clip = clip.std.AssumeFPS(fpsnum=mapper.dst, fpsden=1)
-    less_num_frames = math.ceil(clip.num_frames * mapper.dst / mapper.src) - clip.num_frames
-    for _ in range(less_num_frames):
-        new_clip = new_clip.std.DuplicateFrames(clip.num_frames - 1)
-
-    def _inference(n: int, f: list[vs.VideoFrame]) -> vs.VideoFrame:
-        nonlocal in_idx, out_idx, in_frames, out_frames, flag_end, reuse
-        if n >= out_idx and not flag_end:
-            if in_idx not in in_frames.keys():
-                in_frames[in_idx] = to_input_tensor(clip.get_frame(in_idx))
-            I0 = in_frames[in_idx]
-
-            if in_idx + 1 >= clip.num_frames - 1:
-                flag_end = True
-                return tensor_to_frame(out_frames[list(out_frames.keys())[-1]], f[1].copy())
-
-            if in_idx + 1 not in in_frames.keys():
-                in_frames[in_idx + 1] = to_input_tensor(clip.get_frame(in_idx + 1))
-            I1 = in_frames[in_idx + 1]
-
-            ts = mapper.get_range_timestamps(in_idx, in_idx + 1, lclose=True, rclose=flag_end, normalize=True)
-
-            scene = check_scene(I0, I1, scdet, scdet_threshold)
-
-            for t in ts:
-                if scene:
-                    out = I0.squeeze(0)
-                else:
-                    if t == 0:
-                        out = I0.squeeze(0)
-                    elif t == 1:
-                        out = I1.squeeze(0)
-                    else:
-                        out = inference(torch.cat([I0, I1], dim=1), timestep=t, scale=scale)
-                out_frames[out_idx] = out
-                out_idx += 1
-
-            # clear input cache
-            if in_idx - 1 in in_frames.keys():
-                in_frames.pop(in_idx - 1)
-
-            in_idx += 1
-
-        # clear output cache
-        if n - 1 in out_frames.keys() and len(out_frames.keys()) > 2:
-            out_frames.pop(n - 1)
-
-        if n not in out_frames.keys():
-            return tensor_to_frame(out_frames[list(out_frames.keys())[-1]], f[1].copy())
-
-        return tensor_to_frame(out_frames[n], f[1].copy())
-
-    return new_clip.std.ModifyFrame([new_clip, new_clip], _inference)
-
-
-def inference_vsr_three_frame_in(
-    inference: Callable,
-    clip: vs.VideoNode,
-    mapper: TMapper,
-    scale: float,
-    scdet: bool,
-    scdet_threshold: float,
-    device: torch.device,
-) -> vs.VideoNode:
-    """
-    VFI for three frame input models
-
-    f1, f2, f3 -> f1?, f1t?, f2?, f2t?, f3?
-
-    For the three frame input model, the inference function should accept a tensor with shape (b, 3, c, h, w)
-    And return a tensor with shape (b, c, h, w)
-
-    :param inference: The inference function
-    :param clip: vs.VideoNode
-    :param scale: The flow scale factor
-    :param mapper: The framerate mapper
-    :param scdet: Enable SSIM scene change detection
-    :param scdet_threshold: SSIM scene change detection threshold (greater is sensitive)
-    :param device: The device
-    :return:
-    """
-
-    in_idx: int = 0
-    out_idx: int = 0
-    in_frames: Dict[int, torch.Tensor] = {}
-    out_frames: Dict[int, torch.Tensor] = {}
-    flag_end: bool = False
-    reuse: tuple[torch.Tensor, ...]
-
-    def calc_t(_mapper: TMapper, _idx: float, _flag_end: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-        ts = _mapper.get_range_timestamps(_idx - 0.5, _idx + 0.5, lclose=True, rclose=_flag_end, normalize=False)
-        timestamp = np.asarray(ts, dtype=float) - _idx
-        vfi_timestamp = np.round(timestamp, 4)
-
-        minus_t = vfi_timestamp[vfi_timestamp < 0]
-        zero_t = vfi_timestamp[vfi_timestamp == 0]
-        plus_t = vfi_timestamp[vfi_timestamp > 0]
-        return minus_t, zero_t, plus_t
-
-    def to_input_tensor(x: vs.VideoFrame) -> torch.Tensor:
-        return frame_to_tensor(x, device=device).unsqueeze(0).unsqueeze(0)
+    prefetcher = FramePrefetcher(
+        clip, to_input_tensor, depth=prefetch, cache_size=in_frame_count + lookahead + prefetch + core.num_threads
+    )
+
+    scheduler = VFIScheduler(
+        inference=inference,
+        fetch=prefetcher.get,
+        num_frames=clip.num_frames,
+        mapper=mapper,
+        in_frame_count=in_frame_count,
+        scale=scale,
+        scdet=scdet,
+        scdet_threshold=scdet_threshold,
+        lookahead=lookahead,
+        in_capacity=in_frame_count + lookahead + core.num_threads,
+        scene_index=scene_index,
+        timeline=timeline,
+    )
 
     new_clip = clip.std.AssumeFPS(fpsnum=mapper.dst, fpsden=1)
-    less_num_frames = math.ceil(clip.num_frames * mapper.dst / mapper.src) - clip.num_frames
+    less_num_frames = scheduler.num_outputs - clip.num_frames
     for _ in range(less_num_frames):
         new_clip = new_clip.std.DuplicateFrames(clip.num_frames - 1)
 
     def _inference(n: int, f: list[vs.VideoFrame]) -> vs.VideoFrame:
-        nonlocal in_idx, out_idx, in_frames, out_frames, flag_end, reuse
-        if n >= out_idx and not flag_end:
-            if in_idx not in in_frames.keys():
-                in_frames[in_idx] = to_input_tensor(clip.get_frame(in_idx))
-            I0 = in_frames[in_idx]
-
-            if in_idx + 1 >= clip.num_frames - 1:
-                flag_end = True
-                return tensor_to_frame(out_frames[list(out_frames.keys())[-1]], f[1].copy())
-
-            if in_idx + 1 not in in_frames.keys():
-                in_frames[in_idx + 1] = to_input_tensor(clip.get_frame(in_idx + 1))
-            I1 = in_frames[in_idx + 1]
-
-            if in_idx + 2 >= clip.num_frames - 1:
-                flag_end = True
-            else:
-                if in_idx + 2 not in in_frames.keys():
-                    in_frames[in_idx + 2] = to_input_tensor(clip.get_frame(in_idx + 2))
-                I2 = in_frames[in_idx + 2]
-
-            mt, zt, pt = calc_t(mapper, in_idx, flag_end)
-            left_scene = check_scene(I0, I1, scdet, scdet_threshold)
-            if in_idx == 0:  # head
-                right_scene = left_scene
-                output, reuse = inference(torch.cat([I0, I0, I1], dim=1), mt, zt, pt, False, right_scene, scale, None)
-            elif flag_end:  # tail
-                output, _ = inference(torch.cat([I0, I1, I1], dim=1), mt, zt, pt, left_scene, False, scale, reuse)
-            else:
-                right_scene = check_scene(I1, I2, scdet, scdet_threshold)
-                output, reuse = inference(
-                    torch.cat([I0, I1, I2], dim=1), mt, zt, pt, left_scene, right_scene, scale, reuse
-                )
-
-            for i in range(output.shape[1]):
-                out_frames[out_idx] = output[0, i : i + 1]
-                out_idx += 1
-
-            # clear input cache
-            if in_idx - 1 in in_frames.keys():
-                in_frames.pop(in_idx - 1)
-
-            in_idx += 1
-
-        # clear output cache
-        if n - 1 in out_frames.keys() and len(out_frames.keys()) > 2:
-            out_frames.pop(n - 1)
-
-        if n not in out_frames.keys():
-            return tensor_to_frame(out_frames[list(out_frames.keys())[-1]], f[1].copy())
-
-        return tensor_to_frame(out_frames[n], f[1].copy())
+        fout = tensor_to_frame(scheduler.get(n), f[1].copy())
+        fout.props["ccvfi_prefetch_requests"] = prefetcher.requests
+        fout.props["ccvfi_prefetch_starved"] = prefetcher.starved
+        info = scheduler.get_info(n)
+        if info is not None:
+            fout.props["ccvfi_vfi_path"] = info["path"]
+            if info.get("motion") is not None:
+                fout.props["ccvfi_vfi_motion"] = info["motion"]
+        return fout
 
     return new_clip.std.ModifyFrame([new_clip, new_clip], _inference)
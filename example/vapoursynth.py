@@ -14,7 +14,6 @@ model: BaseModelInterface = AutoModel.from_pretrained(
     pretrained_model_name=ConfigType.RIFE_IFNet_v426_heavy,
 )
 
-core.num_threads = 1  # 目前必须设置为单线程
 clip = core.bs.VideoSource(source="./video/test.mp4")
 clip = core.resize.Bicubic(clip=clip, matrix_in_s="709", format=vs.RGBH)
 clip = model.inference_video(clip, scale=1.0, tar_fps=60, scdet=True, scdet_threshold=0.3)
@@ -29,7 +28,6 @@ clip.set_output()
 #     fp16=False
 # )
 
-# core.num_threads = 1  # 目前必须设置为单线程
 # clip = core.bs.VideoSource(source="./video/test.mp4")
 # clip = core.resize.Bicubic(clip=clip, matrix_in_s="709", format=vs.RGBS)
 # clip = model.inference_video(clip, scale=1.0, tar_fps=60, scdet=True, scdet_threshold=0.3)
@@ -50,7 +48,6 @@ clip.set_output()
 #     tile=None,
 # )
 #
-# core.num_threads = 1  # 设置为单线程
 # clip = core.bs.VideoSource(source="./video/ncop.mkv")
 # clip = core.resize.Bicubic(clip=clip, matrix_in_s="709", format=vs.RGBH)
 #
@@ -0,0 +1,71 @@
+import io
+from typing import Any, Iterator
+
+import numpy as np
+import pytest
+import torch
+
+from ccvfi.cli import Pipeline, build_parser, encode_cmd, parse_fps
+
+
+class _FakeProcess:
+    def __init__(self, stdout: Any = None, stdin: Any = None) -> None:
+        self.stdout = stdout
+        self.stdin = stdin
+
+
+class _FakeModel:
+    # repeat every frame twice
+    def inference_stream(self, frames: Iterator[torch.Tensor], **kwargs: Any) -> Iterator[torch.Tensor]:
+        for frame in frames:
+            yield frame
+            yield frame
+
+
+class _Sink(io.BytesIO):
+    def close(self) -> None:
+        self.value = self.getvalue()
+        super().close()
+
+
+def test_parse_fps() -> None:
+    assert parse_fps("24") == 24.0
+    assert parse_fps("24000/1001") == pytest.approx(23.976, abs=1e-3)
+
+
+def test_parser() -> None:
+    args = build_parser().parse_args(["in.mp4", "out.mkv", "--tar-fps", "60000/1001", "--no-scdet"])
+    assert args.tar_fps == pytest.approx(59.94, abs=1e-3)
+    assert not args.scdet
+    assert args.src_fps is None
+    assert args.buckets is None
+
+    args = build_parser().parse_args(["in.mp4", "out.mkv", "--buckets", "1088x1920", "576x1024"])
+    assert args.buckets == [(1088, 1920), (576, 1024)]
+
+    cmd = encode_cmd("ffmpeg", "in.mp4", "out.mkv", 64, 32, 60.0, ["-c:v", "libx264"])
+    assert cmd[cmd.index("-s") + 1] == "64x32"
+    assert cmd[-3:] == ["-c:v", "libx264", "out.mkv"]
+
+
+def test_pipeline() -> None:
+    width, height, num_frames = 4, 2, 5
+    frames = [np.full((height, width, 3), idx * 10, dtype=np.uint8) for idx in range(num_frames)]
+    sink = _Sink()
+
+    pipeline = Pipeline(
+        model=_FakeModel(),  # type: ignore
+        decoder=_FakeProcess(stdout=io.BytesIO(b"".join(f.tobytes() for f in frames))),  # type: ignore
+        encoder=_FakeProcess(stdin=sink),  # type: ignore
+        width=width,
+        height=height,
+        src_fps=24.0,
+        tar_fps=48.0,
+        queue_size=2,
+    )
+    pipeline.run(stats_interval=0.1, log=io.StringIO())
+
+    assert pipeline.frames_read == num_frames
+    assert pipeline.frames_written == num_frames * 2
+    out = np.frombuffer(sink.value, dtype=np.uint8).reshape(-1, height, width, 3)
+    assert [int(img[0, 0, 0]) for img in out] == [idx * 10 for idx in range(num_frames) for _ in range(2)]
@@ -1,6 +1,8 @@
 import cv2
+import torch
 
 from ccvfi import AutoConfig, AutoModel, BaseConfig, ConfigType
+from ccvfi.arch.arch_utils.softsplat_torch import softsplat
 from ccvfi.model import VFIBaseModel
 
 from .util import ASSETS_PATH, calculate_image_similarity, get_device, load_eval_images, load_images
@@ -22,3 +24,43 @@ class Test_DRBA:
             for i in range(len(out)):
                 cv2.imwrite(str(ASSETS_PATH / f"test_{k}_{i}_out.jpg"), out[i])
                 assert calculate_image_similarity(eval_imgs[i], out[i])
+
+    def test_tiled(self) -> None:
+        img0, img1, img2 = load_images()
+        eval_imgs = load_eval_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.DRBA_IFNet)
+        model: VFIBaseModel = AutoModel.from_config(
+            config=cfg, fp16=False, device=get_device(), tile=256, tile_overlap=64
+        )
+        tiled = model.inference_image_list(img_list=[img0, img1, img2])
+
+        model.tile = None
+        ref = model.inference_image_list(img_list=[img0, img1, img2])
+
+        for i in range(len(tiled)):
+            assert calculate_image_similarity(ref[i], tiled[i], similarity=0.95)
+            assert calculate_image_similarity(eval_imgs[i], tiled[i])
+
+    def test_int8(self) -> None:
+        img0, img1, img2 = load_images()
+        eval_imgs = load_eval_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.DRBA_IFNet)
+        model: VFIBaseModel = AutoModel.from_config(config=cfg, fp16=False, device=torch.device("cpu"))
+        model.quantize_int8([img0, img1, img2])
+
+        out = model.inference_image_list(img_list=[img0, img1, img2])
+        for i in range(len(out)):
+            assert calculate_image_similarity(eval_imgs[i], out[i])
+
+    def test_batched_softsplat(self) -> None:
+        # the ratio maps of all the timesteps of one side are splatted in one call
+        drm = torch.rand((1, 1, 32, 48))
+        flow = torch.randn((1, 2, 32, 48)) * 4
+        ts = [0.2, 0.4, 0.6, 0.8]
+
+        batched = softsplat(drm.repeat(len(ts), 1, 1, 1), torch.cat([flow * t for t in ts], 0), None, "avg")
+        for i, t in enumerate(ts):
+            single = softsplat(drm, flow * t, None, "avg")
+            assert torch.allclose(batched[i : i + 1], single, atol=1e-5)
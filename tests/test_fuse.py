@@ -0,0 +1,55 @@
+import copy
+from typing import cast
+
+import pytest
+import torch
+import torch.nn as nn
+
+from ccvfi.arch import DRBA, IFNet
+from ccvfi.arch.arch_utils.fuse import FoldedResConv, ShuffleConvTranspose2d, optimize_for_inference
+
+
+def _randomize(model: nn.Module) -> nn.Module:
+    torch.manual_seed(0)
+    for name, p in model.named_parameters():
+        # small weights keep the random flows in a sane range, random beta and biases exercise the folding
+        p.data.copy_(torch.randn_like(p) * (0.5 if name.endswith("beta") else 0.02))
+    return model.eval()
+
+
+def test_shuffle_conv_transpose() -> None:
+    torch.manual_seed(0)
+    for r, (k, s, p) in [(2, (4, 2, 1)), (2, (3, 1, 1)), (3, (4, 2, 1))]:
+        seq = nn.Sequential(nn.ConvTranspose2d(8, 5 * r * r, k, s, p), nn.PixelShuffle(r)).eval()
+        x = torch.randn(2, 8, 7, 9)
+        fused = ShuffleConvTranspose2d(seq[0], r)
+        assert torch.allclose(fused(x), seq(x), atol=1e-5)
+
+
+def test_optimize_for_inference() -> None:
+    model = _randomize(IFNet())
+    fused = optimize_for_inference(copy.deepcopy(model))
+
+    assert isinstance(fused.block0.convblock[0], FoldedResConv)
+    assert isinstance(fused.block0.lastconv, ShuffleConvTranspose2d)
+    # idempotent
+    optimize_for_inference(fused)
+
+    x = torch.rand(2, 6, 64, 128)
+    timestep = torch.tensor([0.25, 0.75]).view(2, 1, 1, 1).expand(-1, 1, 64, 128)
+    with torch.inference_mode():
+        for scale_list in [[16, 8, 4, 2, 1], [8, 4, 2, 1, 0.5]]:
+            assert torch.allclose(fused(x, timestep, scale_list), model(x, timestep, scale_list), atol=1e-4)
+
+
+@pytest.mark.parametrize("scale", [1.0, 0.5])
+def test_optimize_drba_blocks(scale: float) -> None:
+    # in float64, the fp32 reordering noise of the folded convs (~1e-3 through the five levels) hides nothing
+    model = cast(DRBA, _randomize(DRBA()).double())
+    fused = optimize_for_inference(copy.deepcopy(model))
+
+    x = torch.rand(1, 6, 128, 128, dtype=torch.float64)
+    with torch.inference_mode():
+        ref, _ = model.inference(x, 0.5, [16 / scale, 8 / scale, 4 / scale, 2 / scale, 1 / scale])
+        out, _ = fused.inference(x, 0.5, [16 / scale, 8 / scale, 4 / scale, 2 / scale, 1 / scale])
+    assert torch.allclose(out, ref, atol=1e-4)
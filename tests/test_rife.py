@@ -1,11 +1,28 @@
+from pathlib import Path
+from typing import cast
+
 import cv2
+import numpy as np
+import pytest
+import torch
+from torchvision import transforms
 
 from ccvfi import AutoConfig, AutoModel, BaseConfig, ConfigType
-from ccvfi.model import VFIBaseModel
+from ccvfi.arch import IFNet
+from ccvfi.arch.arch_utils.tile import tiled_encode
+from ccvfi.model import RIFEModel, VFIBaseModel
+from ccvfi.model.vfi_base_model import REFINE_PRESETS
+from ccvfi.util import aot
+from ccvfi.util.pool import MODEL_POOL, WEIGHT_POOL
 
 from .util import ASSETS_PATH, calculate_image_similarity, get_device, load_eval_image, load_images
 
 
+def _to_tensor(img: np.ndarray, device: torch.device) -> torch.Tensor:
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return transforms.ToTensor()(img).unsqueeze(0).to(device)
+
+
 class Test_RIFE:
     def test_official(self) -> None:
         img0, img1, _ = load_images()
@@ -23,3 +40,240 @@ class Test_RIFE:
             for i in range(len(out)):
                 cv2.imwrite(str(ASSETS_PATH / f"test_{k}_{i}_out.jpg"), out[i])
                 assert calculate_image_similarity(eval_img, out[i])
+
+    def test_batch(self) -> None:
+        img0, img1, _ = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+
+        inp = torch.stack([_to_tensor(img0, get_device()), _to_tensor(img1, get_device())], dim=1)
+
+        single = [model.inference(inp, timestep=t, scale=1.0) for t in [0.25, 0.5, 0.75]]
+        batched = model.inference(inp.repeat(3, 1, 1, 1, 1), timestep=[0.25, 0.5, 0.75], scale=1.0)
+
+        assert batched.shape[0] == 3
+        for i in range(3):
+            assert torch.allclose(single[i], batched[i : i + 1], atol=1e-3)
+
+    def test_frame_cache(self) -> None:
+        img0, img1, img2 = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+
+        i0, i1, i2 = (_to_tensor(img, get_device()) for img in [img0, img1, img2])
+
+        for pair, keys in [((i0, i1), (0, 1)), ((i1, i2), (1, 2))]:
+            inp = torch.stack(pair, dim=1)
+            ref = model.inference(inp, timestep=0.5, scale=1.0)
+            out = model.inference(inp, timestep=[0.5], scale=1.0, frame_keys=[keys])
+            assert torch.allclose(ref, out, atol=1e-3)
+
+        # frame 1 is shared by the two pairs
+        assert len(model.frame_cache) == 3
+
+    def test_tiled(self) -> None:
+        img0, img1, _ = load_images()
+        eval_img = load_eval_image()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+
+        ref = model.inference_image_list(img_list=[img0, img1])[0]
+
+        # the tiled Head encoder is exact
+        x = _to_tensor(img0, get_device())
+        ifnet = cast(IFNet, model.model)
+        assert torch.allclose(ifnet.encode(x), tiled_encode(ifnet.encode, x, 256), atol=1e-4)
+
+        for tile, max_memory in [(256, None), (None, 64)]:
+            model.tile, model.max_memory = tile, max_memory
+            out = model.inference_image_list(img_list=[img0, img1])[0]
+            assert calculate_image_similarity(ref, out, similarity=0.95)
+            assert calculate_image_similarity(eval_img, out)
+
+    def test_motion_threshold(self) -> None:
+        img0, img1, _ = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device(), motion_threshold=0.5)
+
+        i0, i1 = _to_tensor(img0, get_device()), _to_tensor(img1, get_device())
+        windows = [torch.stack([i0, i1], dim=1), torch.stack([i0, i0], dim=1), torch.stack([i0, i1], dim=1)]
+        outputs, _, infos = model.inference_windows(
+            windows, [[0.0], [0.0], [-0.5, 0.0]], [[False], [False], [True]], [[0, 1], [0, 0], [0, 1]], scale=1.0
+        )
+
+        # the test pair moves, the identical frames are copied, the scene change repeats I0
+        assert infos[0][0]["path"] == "model" and infos[0][0]["motion"] > 0.5
+        assert infos[1][0]["path"] == "copy"
+        assert torch.equal(outputs[1][0], i0)
+        assert [info["path"] for info in infos[2]] == ["scene", "scene"]
+
+        ref = model.inference(windows[0], timestep=0.5, scale=1.0)
+        assert torch.allclose(outputs[0][0], ref, atol=1e-3)
+
+        # everything is static below a huge threshold
+        model.motion_threshold = 1e6
+        outputs, _, infos = model.inference_windows([windows[0]], [[0.0]], [[False]], [[0, 1]], scale=1.0)
+        assert infos[0][0]["path"] == "blend"
+        assert torch.allclose(outputs[0][0], (i0 + i1) / 2, atol=1e-5)
+
+    def test_refine(self) -> None:
+        img0, img1, _ = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+        ref = model.inference_image_list(img_list=[img0, img1])[0]
+
+        for preset in ["balanced", "fast"]:
+            model = AutoModel.from_config(config=cfg, fp16=False, device=get_device(), refine=preset)
+            assert model.refine_scales == REFINE_PRESETS[preset]
+            out = model.inference_image_list(img_list=[img0, img1])[0]
+            assert calculate_image_similarity(ref, out, similarity=0.9)
+
+        # a huge tolerance stops after the first refinement block
+        model.refine_scales, model.flow_tol = REFINE_PRESETS["quality"], 1e6
+        early = model.inference_image_list(img_list=[img0, img1])[0]
+        model.refine_scales, model.flow_tol = (16, 8), None
+        assert np.array_equal(early, model.inference_image_list(img_list=[img0, img1])[0])
+
+        with pytest.raises(ValueError):
+            AutoModel.from_config(config=cfg, fp16=False, device=get_device(), refine="unknown")
+
+    def test_channels_last(self) -> None:
+        img0, img1, _ = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+        nhwc: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device(), channels_last=True)
+        assert cast(IFNet, nhwc.model).block0.conv0[0][0].weight.is_contiguous(memory_format=torch.channels_last)
+
+        inp = torch.stack([_to_tensor(img0, get_device()), _to_tensor(img1, get_device())], dim=1)
+        ref = model.inference(inp, timestep=[0.5], scale=1.0)
+        out = nhwc.inference(inp, timestep=[0.5], scale=1.0)
+        assert out.is_contiguous()
+        assert torch.allclose(out, ref, atol=1e-3)
+
+    def test_int8(self) -> None:
+        img0, img1, img2 = load_images()
+        eval_img = load_eval_image()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=torch.device("cpu"))
+        model.quantize_int8([img0, img1, img2])
+        assert model.int8
+        assert isinstance(cast(IFNet, model.model).block0.convblock, torch.nn.Identity)
+
+        out = model.inference_image_list(img_list=[img0, img1])[1]
+        assert calculate_image_similarity(eval_img, out)
+
+        with pytest.raises(ValueError):
+            model.quantize_int8([img0, img1])
+
+    def test_onnxruntime(self) -> None:
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+        img0, img1, _ = load_images()
+        eval_img = load_eval_image()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=torch.device("cpu"))
+        ort: RIFEModel = AutoModel.from_config(config=cfg, fp16=True, backend="onnxruntime")
+        assert ort.device is not None and ort.device.type == "cpu" and not ort.fp16
+
+        out = ort.inference_image_list(img_list=[img0, img1])[0]
+        assert calculate_image_similarity(eval_img, out)
+
+        # dynamic batch, height and width, several timesteps
+        inp = torch.stack([_to_tensor(img0, ort.device), _to_tensor(img1, ort.device)], dim=1)
+        for size in [(256, 448), (320, 320)]:
+            x = torch.nn.functional.interpolate(inp[0], size=size, mode="bilinear").unsqueeze(0).repeat(2, 1, 1, 1, 1)
+            ref = model.inference(x, timestep=[0.25, 0.75], scale=1.0)
+            res = ort.inference(x, timestep=[0.25, 0.75], scale=1.0)
+            assert res.shape == ref.shape
+            assert torch.allclose(res, ref, atol=1e-3)
+        assert len(ort.sessions) == 1
+
+        with pytest.raises(ValueError):
+            AutoModel.from_config(config=cfg, backend="onnxruntime", tile=256)
+
+    def test_aoti(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        inductor = pytest.importorskip("torch._inductor")
+        if not hasattr(inductor, "aoti_compile_and_package"):
+            pytest.skip("AOTInductor packages are not supported by this torch")
+        img0, img1, _ = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=torch.device("cpu"))
+        compiled: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=torch.device("cpu"), backend="aoti")
+        compiled.model_dir = str(tmp_path)
+
+        (path,) = compiled.compile_aot([(256, 448)])
+        assert path.exists() and path.parent == tmp_path / "aot"
+
+        assert model.device is not None
+        inp = torch.stack([_to_tensor(img0, model.device), _to_tensor(img1, model.device)], dim=1)
+        x = torch.nn.functional.interpolate(inp[0], size=(256, 448), mode="bilinear").unsqueeze(0).repeat(2, 1, 1, 1, 1)
+        ref = model.inference(x, timestep=[0.25, 0.75], scale=1.0)
+
+        # a new process loads the artifact instead of compiling
+        monkeypatch.setattr(aot, "compile_ifnet", lambda *args, **kwargs: pytest.fail("compiled again"))
+        loaded: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=torch.device("cpu"), backend="aoti")
+        loaded.model_dir = str(tmp_path)
+        out = loaded.inference(x, timestep=[0.25, 0.75], scale=1.0)
+        assert loaded.compiled[((16, 8, 4, 2, 1), (256, 448))] is not None
+        assert torch.allclose(out, ref, atol=1e-3)
+
+    def test_buckets(self) -> None:
+        img0, img1, _ = load_images()
+
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        model: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+        bucketed: RIFEModel = AutoModel.from_config(
+            config=cfg, fp16=False, device=get_device(), align_mode="replicate", buckets=[(1152, 1920)]
+        )
+        assert bucketed.get_input_size(img0.shape[0], img0.shape[1], 1.0) == (1152, 1920)
+
+        inp = torch.stack([_to_tensor(img0, get_device()), _to_tensor(img1, get_device())], dim=1)
+        ref = model.inference(inp, timestep=0.5, scale=1.0)
+        out = bucketed.inference(inp, timestep=0.5, scale=1.0)
+        assert out.shape == ref.shape
+        assert calculate_image_similarity(load_eval_image(), bucketed.inference_image_list([img0, img1])[0])
+
+        # the warmup runs without compile too, nothing is recorded
+        bucketed.warmup(resolutions=[(256, 448)], batch_sizes=(1, 2))
+        assert bucketed.compile_events == []
+
+    def test_pool(self) -> None:
+        cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.RIFE_IFNet_v426_heavy)
+        a: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+        # the instances of the previous tests may not be collected yet
+        key = a.pool_key
+        n = MODEL_POOL.refcount(key)
+        weight_key = (a.get_weight_key(), str(a.device))
+        w = WEIGHT_POOL.refcount(weight_key)
+        b: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device())
+        private: RIFEModel = AutoModel.from_config(config=cfg, fp16=False, device=get_device(), pool=False)
+        assert a.model is b.model
+        assert private.model is not a.model and private.pool_key is None
+        assert MODEL_POOL.refcount(key) == n + 1
+        # the weights are held as long as the models, shared or not
+        assert WEIGHT_POOL.refcount(weight_key) == w + 2
+
+        # same weights, another arch: the state dict is read once
+        drba_cfg: BaseConfig = AutoConfig.from_pretrained(ConfigType.DRBA_IFNet)
+        drba: VFIBaseModel = AutoModel.from_config(config=drba_cfg, fp16=False, device=get_device())
+        assert drba.get_weight_key() == a.get_weight_key()
+        assert WEIGHT_POOL.refcount(weight_key) == w + 3
+
+        # modified in place on a private copy
+        a.optimize_for_inference()
+        assert a.model is not b.model and a.pool_key is None
+        assert MODEL_POOL.refcount(key) == n
+        assert WEIGHT_POOL.refcount(weight_key) == w + 2
+
+        b.release()
+        assert MODEL_POOL.refcount(key) == n - 1
+        assert WEIGHT_POOL.refcount(weight_key) == w + 1
@@ -0,0 +1,145 @@
+from pathlib import Path
+from typing import Any, List, Tuple
+
+import numpy as np
+import pytest
+import torch
+
+from ccvfi.scdet import (
+    SCDET_REGISTRY,
+    SceneIndex,
+    Timeline,
+    analyze_frames,
+    detect_held_frames,
+    index as scdet_index,
+    retime_cadence,
+)
+from ccvfi.util.misc import TMapper
+from ccvfi.util.scheduler import VFIScheduler
+
+from .util import load_images
+
+
+@pytest.mark.parametrize("name", ["ssim", "histogram", "luma"])
+def test_detector(name: str) -> None:
+    img0, img1, _ = load_images()
+    detector = SCDET_REGISTRY.get(name)()
+
+    def _thumb(img: np.ndarray) -> torch.Tensor:
+        return detector.thumbnail(torch.from_numpy(img).permute(2, 0, 1).float() / 255.0)
+
+    t0, t1 = _thumb(img0), _thumb(img1)
+    noise = detector.thumbnail(torch.rand(3, 540, 960) * 0.1)
+
+    scores = detector.score(torch.cat([t0, t0, t0]), torch.cat([t0, t1, noise]))
+    assert scores.shape == (3,)
+    assert scores[0].item() == pytest.approx(1.0, abs=1e-4)
+    assert detector.is_cut(scores).tolist() == [False, False, True]
+
+
+def test_scene_index(tmp_path: Path) -> None:
+    img0, img1, _ = load_images()
+    black = np.zeros_like(img0)
+    index = analyze_frames([img0, img1, black, black], detector="luma")
+
+    assert index.num_frames == 4
+    assert index.detector == "luma"
+    assert index.cuts.tolist() == [1]
+    assert index.is_cut(1) and not index.is_cut(0)
+    assert len(index.with_threshold(0.0).cuts) == 0
+
+    path = tmp_path / "test.mp4.scdet.json"
+    assert SceneIndex.sidecar_path(tmp_path / "test.mp4") == path
+    index.save(path)
+    loaded = SceneIndex.load(path)
+    assert loaded.cuts.tolist() == [1]
+    assert np.allclose(loaded.scores, index.scores, atol=1e-4)
+
+
+class _FakeCapture:
+    # a capture of num_frames frames, whose seek lands on the frame before the requested one after the frame 0
+    def __init__(self, num_frames: int, exact: bool) -> None:
+        self.num_frames = num_frames
+        self.exact = exact
+        self.pos = 0
+
+    def set(self, prop: int, value: float) -> bool:
+        self.pos = int(value) if self.exact or value == 0 else int(value) - 1
+        return True
+
+    def get(self, prop: int) -> float:
+        return float(self.pos)
+
+    def read(self) -> Tuple[bool, Any]:
+        if self.pos >= self.num_frames:
+            return False, None
+        self.pos += 1
+        return True, np.full((32, 32, 3), self.pos, dtype=np.uint8)
+
+    def release(self) -> None:
+        pass
+
+
+def test_analyze_chunk(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(scdet_index.cv2, "VideoCapture", lambda path: _FakeCapture(10, exact=True))
+    assert len(scdet_index._analyze_chunk("test.mp4", 4, 9, "luma", None)) == 5
+
+    # a short read, e.g. an inexact frame count, does not shift the following cuts
+    with pytest.raises(ValueError):
+        scdet_index._analyze_chunk("test.mp4", 4, 12, "luma", None)
+
+    # neither does an inexact seek
+    monkeypatch.setattr(scdet_index.cv2, "VideoCapture", lambda path: _FakeCapture(10, exact=False))
+    assert len(scdet_index._analyze_chunk("test.mp4", 0, 5, "luma", None)) == 5
+    with pytest.raises(ValueError):
+        scdet_index._analyze_chunk("test.mp4", 4, 9, "luma", None)
+
+
+def test_scheduler_scene_index() -> None:
+    scenes: List[Any] = []
+
+    def _inference(windows: Any, timestamps: Any, _scenes: Any, *args: Any) -> Any:
+        scenes.extend(_scenes)
+        return [[w[:, 0] for _ in ts] for w, ts in zip(windows, timestamps)], None
+
+    scheduler = VFIScheduler(
+        inference=_inference,
+        fetch=lambda idx: torch.full((1, 1, 3, 8, 8), float(idx)),
+        num_frames=4,
+        mapper=TMapper(1.0, 2.0),
+        in_frame_count=2,
+        scene_index=SceneIndex([1.0, 0.0, 1.0], detector="ssim", threshold=0.3),
+    )
+    for n in range(scheduler.num_outputs):
+        scheduler.get(n)
+
+    assert scenes == [[False], [True], [False]]
+
+
+def test_retime_cadence() -> None:
+    # 3:2 pulldown, retimed evenly
+    assert retime_cadence([0, 3, 5, 8, 10]) == pytest.approx([0, 2.5, 5, 7.5, 10])
+    # on twos, already even
+    assert retime_cadence([0, 2, 4, 6]) == pytest.approx([0, 2, 4, 6])
+    # irregular holds are kept
+    assert retime_cadence([0, 1, 3, 4, 7]) == pytest.approx([0, 1, 3, 4, 7])
+
+
+def test_timeline() -> None:
+    # 3:2
+    timeline = Timeline.from_held([False, True, True, False, True] * 2 + [False, True])
+    assert timeline.frames == [0, 3, 5, 8, 10]
+    assert timeline.times == pytest.approx([0, 2.5, 5, 7.5, 10])
+    assert timeline.num_frames == 12
+    assert timeline.virtual_index(4) == 1
+
+    for u in [-0.5, 0.0, 0.3, 1.0, 2.7, 4.0, 4.5]:
+        assert timeline.to_virtual(timeline.to_time(u)) == pytest.approx(u)
+
+    with pytest.raises(ValueError):
+        Timeline([1, 2], num_frames=3)
+
+
+def test_detect_held_frames() -> None:
+    img0, img1, img2 = load_images()
+    assert detect_held_frames([img0, img0, img1, img1, img1, img2]) == [False, True, False, True, True, False]
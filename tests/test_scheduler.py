@@ -0,0 +1,205 @@
+import math
+import random
+from typing import Any, Hashable, List, Optional, Tuple
+
+import numpy as np
+import pytest
+import torch
+
+from ccvfi.scdet import Timeline
+from ccvfi.util.misc import TMapper
+from ccvfi.util.scheduler import RingBuffer, VFIScheduler
+from ccvfi.util.stream import inference_stream
+
+
+def _fetch(idx: int) -> torch.Tensor:
+    # the value of a source frame is its index
+    return torch.full((1, 1, 1, 2, 2), float(idx))
+
+
+def _linear_inference(
+    windows: List[torch.Tensor],
+    timestamps: List[List[float]],
+    scenes: List[List[bool]],
+    frame_keys: List[List[Hashable]],
+    scale: float,
+    reuse: Optional[Any] = None,
+) -> Tuple[List[List[torch.Tensor]], Any]:
+    # the output is the time of the frame, center of the window + timestamp, clamped to the frames of the window
+    # like a model given the duplicated last frame of the tail window (e.g. [10, 11, 11])
+    outputs = []
+    for imgs, ts in zip(windows, timestamps):
+        n = imgs.shape[1]
+        center = (imgs[0, (n - 1) // 2] + imgs[0, n // 2]) / 2
+        lo, hi = imgs.min().item(), imgs.max().item()
+        outputs.append([(center + t).clamp(lo, hi) for t in ts])
+    return outputs, None
+
+
+def test_ring_buffer() -> None:
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+    ring = RingBuffer(2)
+    ring.put(0, "a")
+    ring.put(1, "b")
+    assert ring.get(0) == "a"
+    ring.put(2, "c")
+    assert ring.get(0) is None
+    assert ring.get(2) == "c"
+    ring.clear()
+    assert ring.get(1) is None
+
+
+@pytest.mark.parametrize("in_frame_count", [2, 3, 4])
+@pytest.mark.parametrize("src, dst", [(24.0, 60.0), (23.976, 119.88), (30.0, 31.0)])
+def test_scheduler(in_frame_count: int, src: float, dst: float) -> None:
+    num_frames = 12
+    mapper = TMapper(src, dst)
+    scheduler = VFIScheduler(
+        inference=_linear_inference,
+        fetch=_fetch,
+        num_frames=num_frames,
+        mapper=mapper,
+        in_frame_count=in_frame_count,
+        scdet=False,
+        lookahead=1,
+    )
+
+    assert scheduler.num_outputs == math.ceil(num_frames * dst / src)
+
+    sequential = [scheduler.get(n).flatten()[0].item() for n in range(scheduler.num_outputs)]
+    for n, value in enumerate(sequential):
+        assert value == pytest.approx(min(n * src / dst, num_frames - 1), abs=1e-4)
+
+    # random access gives the same frames
+    order = list(range(scheduler.num_outputs))
+    random.shuffle(order)
+    for n in order:
+        assert scheduler.get(n).flatten()[0].item() == pytest.approx(sequential[n])
+
+
+def test_scheduler_reuse() -> None:
+    calls: List[Any] = []
+
+    def _inference(*args: Any) -> Tuple[List[List[torch.Tensor]], Any]:
+        calls.append(args[-1])
+        outputs, _ = _linear_inference(*args)
+        return outputs, len(calls)
+
+    scheduler = VFIScheduler(
+        inference=_inference, fetch=_fetch, num_frames=6, mapper=TMapper(1.0, 2.0), in_frame_count=3, scdet=False
+    )
+    for n in range(scheduler.num_outputs):
+        scheduler.get(n)
+    # every window but the first one gets the reusable output of the previous window
+    assert calls == [None, 1, 2, 3, 4, 5]
+
+    with pytest.raises(ValueError):
+        VFIScheduler(inference=_inference, fetch=_fetch, num_frames=2, mapper=TMapper(1.0, 2.0), in_frame_count=3)
+
+
+@pytest.mark.parametrize("in_frame_count", [2, 3])
+@pytest.mark.parametrize("lookahead", [0, 2])
+def test_inference_stream(in_frame_count: int, lookahead: int) -> None:
+    num_frames = 10
+
+    # a generator, the length of the stream is unknown until its end
+    frames = (torch.full((3, 2, 2), float(idx)) for idx in range(num_frames))
+    outputs = list(
+        inference_stream(
+            inference=_linear_inference,
+            frames=frames,
+            src_fps=24.0,
+            tar_fps=60.0,
+            device=torch.device("cpu"),
+            in_frame_count=in_frame_count,
+            scdet=False,
+            lookahead=lookahead,
+        )
+    )
+
+    assert len(outputs) == math.ceil(num_frames * 60.0 / 24.0)
+    for n, out in enumerate(outputs):
+        assert isinstance(out, torch.Tensor)
+        assert out.shape == (3, 2, 2)
+        assert out.flatten()[0].item() == pytest.approx(min(n * 24.0 / 60.0, num_frames - 1), abs=1e-4)
+
+    # numpy frames in, numpy frames out
+    imgs = [np.full((2, 2, 3), idx, dtype=np.uint8) for idx in range(num_frames)]
+    outputs = list(
+        inference_stream(
+            inference=_linear_inference,
+            frames=imgs,
+            src_fps=24.0,
+            tar_fps=48.0,
+            device=torch.device("cpu"),
+            in_frame_count=in_frame_count,
+            scdet=False,
+        )
+    )
+    assert len(outputs) == num_frames * 2
+    assert all(isinstance(out, np.ndarray) and out.shape == (2, 2, 3) for out in outputs)
+
+
+def test_scheduler_timeline() -> None:
+    calls: List[int] = []
+
+    def _inference(windows: List[torch.Tensor], timestamps: List[List[float]], *args: Any) -> Any:
+        calls.append(len(windows))
+        # interpolate the values (the source frame indices) of the two frames of the window
+        outputs = [[w[0, 0] + (t + 0.5) * (w[0, 1] - w[0, 0]) for t in ts] for w, ts in zip(windows, timestamps)]
+        return outputs, None
+
+    # animated on twos, the frames 1, 3, 5, 7 hold the previous frame
+    timeline = Timeline.from_held([False, True] * 4)
+    scheduler = VFIScheduler(
+        inference=_inference,
+        fetch=_fetch,
+        num_frames=8,
+        mapper=TMapper(1.0, 2.0),
+        in_frame_count=2,
+        scdet=False,
+        timeline=timeline,
+    )
+
+    assert scheduler.num_outputs == 16
+    for n in range(scheduler.num_outputs):
+        assert scheduler.get(n).flatten()[0].item() == pytest.approx(min(n / 2, 6), abs=1e-4)
+
+    # 3 pairs of distinct frames instead of 7 pairs of frames
+    assert sum(calls) == 3
+
+
+def test_scheduler_info() -> None:
+    def _inference(*args: Any) -> Any:
+        outputs, _ = _linear_inference(*args)
+        return outputs, None, [[{"path": "model", "t": t} for t in ts] for ts in args[1]]
+
+    frames = [torch.full((3, 2, 2), float(idx)) for idx in range(4)]
+    outputs = list(
+        inference_stream(
+            inference=_inference,
+            frames=frames,
+            src_fps=1.0,
+            tar_fps=2.0,
+            device=torch.device("cpu"),
+            scdet=False,
+            with_info=True,
+        )
+    )
+
+    assert len(outputs) == 8
+    for n, (_, info) in enumerate(outputs[:6]):
+        assert info is not None
+        assert info["path"] == "model"
+        assert info["t"] == pytest.approx((n % 2) * 0.5 - 0.5)
+    # behind the last step, the last source frame is repeated
+    assert outputs[-1][1] == {"path": "source"}
+
+    # an inference function without metadata
+    scheduler = VFIScheduler(
+        inference=_linear_inference, fetch=_fetch, num_frames=4, mapper=TMapper(1.0, 2.0), in_frame_count=2
+    )
+    scheduler.get(1)
+    assert scheduler.get_info(1) is None
@@ -0,0 +1,133 @@
+from typing import Optional
+
+import pytest
+import torch
+
+from ccvfi.arch.arch_utils import softsplat_torch
+from ccvfi.arch.arch_utils.softsplat_torch import softsplat
+
+
+def legacy_splat(tenIn: torch.Tensor, tenFlow: torch.Tensor) -> torch.Tensor:
+    """
+    The previous engine of softsplat_torch, four masked index_add_ passes, kept as the parity reference
+    """
+    N, C, H, W = tenIn.size()
+    device = tenIn.device
+    tenOut = torch.zeros_like(tenIn)
+
+    gridY, gridX = torch.meshgrid(
+        torch.arange(H, device=device, dtype=tenIn.dtype),
+        torch.arange(W, device=device, dtype=tenIn.dtype),
+        indexing="ij",
+    )
+    gridY = gridY.unsqueeze(0).unsqueeze(0).expand(N, 1, H, W)
+    gridX = gridX.unsqueeze(0).unsqueeze(0).expand(N, 1, H, W)
+    batch_indices = torch.arange(N, device=device).view(N, 1, 1).expand(N, H, W).reshape(-1)
+
+    fltX_flat = (gridX + tenFlow[:, 0:1, :, :]).reshape(-1)
+    fltY_flat = (gridY + tenFlow[:, 1:2, :, :]).reshape(-1)
+    tenIn_flat = tenIn.permute(0, 2, 3, 1).reshape(-1, C)
+
+    finite_mask = torch.isfinite(fltX_flat) & torch.isfinite(fltY_flat)
+    if not finite_mask.any():
+        return tenOut
+
+    fltX_flat = fltX_flat[finite_mask]
+    fltY_flat = fltY_flat[finite_mask]
+    tenIn_flat = tenIn_flat[finite_mask]
+    batch_indices = batch_indices[finite_mask]
+
+    intNW_X = torch.floor(fltX_flat).to(dtype=torch.int32)
+    intNW_Y = torch.floor(fltY_flat).to(dtype=torch.int32)
+    intSE_X = intNW_X + 1
+    intSE_Y = intNW_Y + 1
+
+    fltNW = (intSE_X - fltX_flat) * (intSE_Y - fltY_flat)
+    fltNE = (fltX_flat - intNW_X) * (intSE_Y - fltY_flat)
+    fltSW = (intSE_X - fltX_flat) * (fltY_flat - intNW_Y)
+    fltSE = (fltX_flat - intNW_X) * (fltY_flat - intNW_Y)
+
+    tenOut_flat = tenOut.permute(0, 2, 3, 1).reshape(-1, C)
+    positions = [
+        (intNW_X, intNW_Y, fltNW),
+        (intSE_X, intNW_Y, fltNE),
+        (intNW_X, intSE_Y, fltSW),
+        (intSE_X, intSE_Y, fltSE),
+    ]
+    for intX, intY, weight in positions:
+        valid_mask = (intX >= 0) & (intX < W) & (intY >= 0) & (intY < H)
+        if not valid_mask.any():
+            continue
+        idx_NHW = batch_indices[valid_mask] * H * W + intY[valid_mask] * W + intX[valid_mask]
+        tenOut_flat.index_add_(0, idx_NHW, tenIn_flat[valid_mask] * weight[valid_mask].unsqueeze(1))
+
+    return tenOut_flat.view(N, H, W, C).permute(0, 3, 1, 2)
+
+
+def legacy_softsplat(
+    tenIn: torch.Tensor, tenFlow: torch.Tensor, tenMetric: Optional[torch.Tensor], strMode: str
+) -> torch.Tensor:
+    if strMode == "avg":
+        tenIn = torch.cat([tenIn, tenIn.new_ones([tenIn.shape[0], 1, tenIn.shape[2], tenIn.shape[3]])], 1)
+    elif strMode == "linear":
+        assert tenMetric is not None
+        tenIn = torch.cat([tenIn * tenMetric, tenMetric], 1)
+    elif strMode == "soft":
+        assert tenMetric is not None
+        tenIn = torch.cat([tenIn * tenMetric.exp(), tenMetric.exp()], 1)
+    tenOut = legacy_splat(tenIn, tenFlow)
+    if strMode != "sum":
+        tenOut = tenOut[:, :-1] / (tenOut[:, -1:] + 0.0000001)
+    return tenOut
+
+
+@pytest.mark.parametrize("mode", ["sum", "avg", "linear", "soft"])
+@pytest.mark.parametrize("n, c", [(1, 1), (3, 2), (2, 3)])
+def test_softsplat_parity(mode: str, n: int, c: int) -> None:
+    torch.manual_seed(0)
+    tenIn = torch.rand((n, c, 24, 40))
+    # large enough for some pixels to leave the frame
+    tenFlow = torch.randn((n, 2, 24, 40)) * 6
+    tenFlow[0, 0, 0, :4] = float("nan")
+    tenFlow[-1, 1, 5, 5] = float("inf")
+    tenMetric = torch.rand((n, 1, 24, 40)) if mode in ["linear", "soft"] else None
+
+    out = softsplat(tenIn, tenFlow, tenMetric, mode)
+    ref = legacy_softsplat(tenIn, tenFlow, tenMetric, mode)
+    assert out.shape == ref.shape
+    assert torch.allclose(out, ref, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", ["sum", "avg", "linear", "soft"])
+def test_softsplat_non_finite_outside(mode: str) -> None:
+    # the pixels leaving the frame have an infinite input and metric (e.g. exp overflowing in fp16), the pixel (0, 0)
+    # where their invalid corners are scattered is left untouched
+    tenIn = torch.rand((1, 2, 8, 8))
+    tenFlow = torch.zeros((1, 2, 8, 8))
+    tenFlow[:, 0, :, 4:] = 100.0
+    tenIn[:, :, :, 4:] = float("inf")
+    tenMetric = torch.rand((1, 1, 8, 8)) if mode in ["linear", "soft"] else None
+    if tenMetric is not None:
+        tenMetric[:, :, :, 4:] = float("inf")
+
+    out = softsplat(tenIn, tenFlow, tenMetric, mode)
+    ref = legacy_softsplat(tenIn, tenFlow, tenMetric, mode)
+    assert torch.isfinite(out).all()
+    assert torch.allclose(out, ref, atol=1e-5)
+
+
+def test_softsplat_cache() -> None:
+    softsplat_torch.grid_cache.clear()
+    for n in [1, 2, 3]:
+        for size in range(10):
+            softsplat(torch.rand((n, 1, 8, 8 + size)), torch.zeros((n, 2, 8, 8 + size)), None, "avg")
+    # bounded, and keyed by the batch size
+    assert len(softsplat_torch.grid_cache) == softsplat_torch.grid_cache.maxsize
+
+    # an integer flow moves the frame exactly
+    tenIn = torch.rand((2, 3, 8, 8))
+    tenFlow = torch.zeros((2, 2, 8, 8))
+    tenFlow[:, 0] = 1
+    out = softsplat(tenIn, tenFlow, None, "sum")
+    assert torch.allclose(out[:, :, :, 1:], tenIn[:, :, :, :-1])
+    assert torch.all(out[:, :, :, 0] == 0)
@@ -1,20 +1,35 @@
+import os
+import threading
+import time
+from pathlib import Path
+
 import cv2
 import pytest
 import torch
 from torchvision import transforms
 
+from ccvfi.type import ArchType, BaseConfig, ModelType
+from ccvfi.util.aot import get_artifact_path
+from ccvfi.util.cache import LRUCache
 from ccvfi.util.color import rgb_to_yuv, yuv_to_rgb
 from ccvfi.util.device import DEFAULT_DEVICE
 from ccvfi.util.misc import (
     TMapper,
     check_scene,
+    check_scene_batch,
     create_window_3d,
     de_resize,
     distance_calculator,
     gaussian,
+    get_align_size,
+    get_bucket_size,
+    get_scene_thumbnail,
+    pad_to,
     resize,
     ssim_matlab,
+    ssim_matlab_batch,
 )
+from ccvfi.util.pool import ModelPool
 
 from .util import calculate_image_similarity, load_images
 
@@ -23,6 +38,29 @@ def test_device() -> None:
     print(DEFAULT_DEVICE)
 
 
+def test_lru_cache() -> None:
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=0)
+
+    cache = LRUCache(maxsize=2)
+    cache.put(0, "a")
+    cache.put(1, "b")
+    assert cache.get(0) == "a"  # 1 is now the least recently used
+    cache.put(2, "c")
+    assert 1 not in cache
+    assert len(cache) == 2
+    assert cache.get(1, "x") == "x"
+
+    cache.maxsize = 1
+    assert len(cache) == 1
+    assert cache.get(2) == "c"
+
+    assert cache.pop(2) == "c"
+    cache.put(3, "d")
+    cache.clear()
+    assert len(cache) == 0
+
+
 def test_color() -> None:
     with pytest.raises(TypeError):
         rgb_to_yuv(1)
@@ -66,6 +104,48 @@ def test_de_resize() -> None:
     assert de_resized_img.shape[3] == ori_w
 
 
+@pytest.mark.parametrize("mode", ["resize", "reflect", "replicate"])
+@pytest.mark.parametrize("scale", [0.5, 1.0, 2.0])
+def test_align_mode(mode: str, scale: float) -> None:
+    # same size as the previous loop
+    for h, w in [(540, 960), (1080, 1920), (720, 1280), (37, 5)]:
+        _h, _w = h, w
+        while _h * scale % 64 != 0:
+            _h += 1
+        while _w * scale % 64 != 0:
+            _w += 1
+        assert get_align_size(h, w, scale) == (_h, _w)
+
+    img = torch.rand(1, 3, 540, 960)
+    aligned = resize(img, scale, mode)
+    assert aligned.shape[2:] == get_align_size(540, 960, scale)
+    restored = de_resize(aligned, 540, 960, mode)
+    assert restored.shape == img.shape
+    if mode != "resize":
+        # padding and cropping is lossless
+        assert torch.equal(restored, img)
+
+    # an aligned frame is not touched
+    img = torch.rand(1, 3, 256, 512)
+    assert resize(img, scale, mode) is img
+    assert de_resize(img, 256, 512, mode) is img
+
+
+def test_shape_buckets() -> None:
+    buckets = [(1088, 1920), (576, 1024), (768, 1024)]
+    assert get_bucket_size(512, 960, buckets) == (576, 1024)
+    assert get_bucket_size(640, 1024, buckets) == (768, 1024)
+    assert get_bucket_size(1088, 1920, buckets) == (1088, 1920)
+    # too large for every bucket
+    assert get_bucket_size(2176, 3840, buckets) == (2176, 3840)
+
+    img = torch.rand(1, 3, 512, 960)
+    padded = pad_to(img, 576, 1024)
+    assert padded.shape[2:] == (576, 1024)
+    assert torch.equal(padded[:, :, :512, :960], img)
+    assert pad_to(img, 512, 960) is img
+
+
 def test_distance_calculator() -> None:
     x = torch.tensor([[[[1.0, 2.0], [3.0, 4.0]]]])  # 创建一个 4D 张量
     distance = distance_calculator(x)
@@ -80,6 +160,18 @@ def test_TMapper() -> None:
     assert all(0.0 <= t <= 1.0 for t in timestamps)
 
 
+@pytest.mark.parametrize("src, dst", [(24.0, 60.0), (23.976, 120.0), (30.0, 31.0), (25.0, 25.0)])
+def test_TMapper_get_pair_timestamp(src: float, dst: float) -> None:
+    mapper = TMapper(src=src, dst=dst)
+    n = 0
+    for i in range(50):
+        for t in mapper.get_range_timestamps(i, i + 1, lclose=True, rclose=False, normalize=True):
+            pair, timestep = mapper.get_pair_timestamp(n)
+            assert pair == i
+            assert timestep == pytest.approx(t)
+            n += 1
+
+
 def test_gaussian() -> None:
     window_size = 5
     sigma = 1.5
@@ -103,6 +195,26 @@ def test_ssim_matlab() -> None:
     assert 0.0 <= ssim_value.item() <= 1.0
 
 
+def test_ssim_matlab_batch() -> None:
+    img1 = torch.rand(4, 3, 32, 32)
+    img2 = torch.rand(4, 3, 32, 32)
+    ssim_values = ssim_matlab_batch(img1, img2)
+    assert ssim_values.shape == (4,)
+    for i in range(4):
+        assert ssim_values[i].item() == pytest.approx(ssim_matlab(img1[i : i + 1], img2[i : i + 1]).item(), abs=1e-5)
+
+
+def test_check_scene_batch() -> None:
+    x = torch.rand(1, 1, 3, 64, 64)
+    thumb = get_scene_thumbnail(x)
+    assert thumb.shape == (1, 3, 32, 32)
+
+    other = get_scene_thumbnail(torch.rand(1, 1, 3, 64, 64))
+    result = check_scene_batch(torch.cat([thumb, thumb]), torch.cat([thumb, other]), scdet_threshold=0.3)
+    assert result.tolist() == [False, True]
+    assert result[1].item() == check_scene(x, torch.rand(1, 1, 3, 64, 64), enable_scdet=True, scdet_threshold=0.3)
+
+
 class Test_Check_Scene:
     def test_5d(self) -> None:
         x1 = torch.randn(1, 1, 3, 64, 64)
@@ -129,3 +241,99 @@ class Test_Check_Scene:
 
         result = check_scene(x1, x2, enable_scdet=True, scdet_threshold=0.5)
         assert isinstance(result, bool)
+
+
+def test_model_pool() -> None:
+    pool = ModelPool(max_unused=1)
+    loads = []
+
+    def factory() -> object:
+        loads.append(1)
+        return object()
+
+    a, token = pool.acquire("a", factory)
+    assert pool.acquire("a", factory) == (a, token)
+    assert len(loads) == 1 and pool.refcount("a") == 2
+
+    pool.release("a", token)
+    pool.release("a", token)
+    # the last released entry is kept
+    assert "a" in pool and pool.refcount("a") == 0
+    assert pool.acquire("a", factory) == (a, token) and len(loads) == 1
+    pool.release("a", token)
+
+    # a second unused entry evicts the first one
+    _, token = pool.acquire("b", factory)
+    pool.release("b", token)
+    assert "a" not in pool and "b" in pool
+    assert pool.evict() == 1 and len(pool) == 0
+
+    # an evicted entry is recreated, its holders keep the old one
+    c, old = pool.acquire("c", factory)
+    assert pool.evict("c") == 1
+    new, token = pool.acquire("c", factory)
+    assert new is not c and token != old
+    # releasing the evicted entry does not release the new one
+    pool.release("c", old)
+    assert pool.refcount("c") == 1
+    pool.release("c", token)
+    assert pool.refcount("c") == 0
+
+    # even if the factory returns the same object again
+    pool = ModelPool(max_unused=0)
+    _, old = pool.acquire("d", lambda: a)
+    pool.evict("d")
+    _, token = pool.acquire("d", lambda: a)
+    pool.release("d", old)
+    assert "d" in pool and pool.refcount("d") == 1
+
+    with pytest.raises(ValueError):
+        ModelPool(max_unused=-1)
+
+
+def test_model_pool_concurrent() -> None:
+    pool = ModelPool()
+    loads = []
+    started = threading.Event()
+
+    def slow() -> object:
+        loads.append(1)
+        started.set()
+        time.sleep(0.1)
+        return object()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(pool.acquire("a", slow))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    # the other keys are acquired while the factory of "a" runs
+    started.wait()
+    assert pool.acquire("b", object) is not None
+    for t in threads:
+        t.join()
+    assert len(loads) == 1 and len({id(r) for r, _ in results}) == 1 and pool.refcount("a") == 4
+
+    # a failed factory leaves nothing behind, the next acquire creates the entry
+    def fail() -> object:
+        raise RuntimeError("load failed")
+
+    with pytest.raises(RuntimeError):
+        pool.acquire("c", fail)
+    assert "c" not in pool
+    assert pool.acquire("c", object) is not None and pool.refcount("c") == 1
+
+
+def test_artifact_path(tmp_path: Path) -> None:
+    weights = tmp_path / "weights.pth"
+    weights.write_bytes(b"0")
+    cfg = BaseConfig(name="weights.pth", path=weights, arch=ArchType.IFNET, model=ModelType.RIFE)
+    path = get_artifact_path(cfg, ("cpu",))
+    assert path.parent == tmp_path / "aot" and get_artifact_path(cfg, ("cpu",)) == path
+    assert get_artifact_path(cfg, ("cuda",)) != path
+
+    # other weights under the same name get a new artifact
+    weights.write_bytes(b"01")
+    os.utime(weights, ns=(0, 0))
+    assert get_artifact_path(cfg, ("cpu",)) != path
+    hashed = BaseConfig(name="weights.pth", path=weights, hash="0" * 64, arch=ArchType.IFNET, model=ModelType.RIFE)
+    assert get_artifact_path(hashed, ("cpu",)) != get_artifact_path(cfg, ("cpu",))
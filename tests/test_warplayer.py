@@ -0,0 +1,57 @@
+import copy
+
+import pytest
+import torch
+
+from ccvfi.arch.arch_utils.warplayer import is_compiling, warp, warp_group
+from ccvfi.util.cache import LRUCache
+
+
+def legacy_warp(tenInput: torch.Tensor, tenFlow: torch.Tensor) -> torch.Tensor:
+    # the previous warp, a grid rebuilt from linspace and a flow normalised with torch.cat
+    n, _, h, w = tenFlow.shape
+    tenHorizontal = torch.linspace(-1.0, 1.0, w).view(1, 1, 1, w).expand(n, -1, h, -1)
+    tenVertical = torch.linspace(-1.0, 1.0, h).view(1, 1, h, 1).expand(n, -1, -1, w)
+    grid = torch.cat([tenHorizontal, tenVertical], 1)
+    tenFlow = torch.cat([tenFlow[:, 0:1] / ((w - 1.0) / 2.0), tenFlow[:, 1:2] / ((h - 1.0) / 2.0)], 1)
+    g = (grid + tenFlow).permute(0, 2, 3, 1)
+    return torch.nn.functional.grid_sample(tenInput, g, mode="bilinear", padding_mode="border", align_corners=True)
+
+
+def test_warp() -> None:
+    cache = LRUCache(maxsize=2)
+    img = torch.rand((2, 3, 24, 40))
+    feat = torch.rand((2, 8, 24, 40))
+    flow = torch.randn((2, 4, 24, 40)) * 3
+
+    assert torch.allclose(warp(img, flow[:, :2], cache), legacy_warp(img, flow[:, :2]), atol=1e-5)
+
+    # one grid_sample for the frames and the features of both sides
+    (wi0, wf0), (wi1, wf1) = warp_group([([img, feat], flow[:, :2]), ([img, feat], flow[:, 2:4])], cache)
+    assert torch.allclose(wi0, legacy_warp(img, flow[:, :2]), atol=1e-5)
+    assert torch.allclose(wf0, legacy_warp(feat, flow[:, :2]), atol=1e-5)
+    assert torch.allclose(wi1, legacy_warp(img, flow[:, 2:4]), atol=1e-5)
+    assert torch.allclose(wf1, legacy_warp(feat, flow[:, 2:4]), atol=1e-5)
+
+    # the groups with different channels are warped one by one
+    (a,), (b,) = warp_group([([img], flow[:, :2]), ([feat], flow[:, 2:4])], cache)
+    assert torch.allclose(b, legacy_warp(feat, flow[:, 2:4]), atol=1e-5)
+
+    # bounded, one grid per size and dtype
+    for size in range(8, 12):
+        warp(torch.rand((1, 1, size, size)), torch.zeros((1, 2, size, size)), cache)
+    assert len(cache) == 2
+
+    # a module owning the cache can be deep-copied, without the cached grids
+    copied = copy.deepcopy(cache)
+    assert copied.maxsize == 2 and len(copied) == 0
+
+
+def test_warp_without_compiler(monkeypatch: pytest.MonkeyPatch) -> None:
+    # the torch versions without torch.compiler.is_compiling, or without dynamo (1.13), warp too
+    monkeypatch.delattr(torch.compiler, "is_compiling")
+    monkeypatch.delattr(torch._dynamo, "is_compiling")
+    assert not is_compiling()
+    img = torch.rand((1, 3, 24, 40))
+    flow = torch.randn((1, 2, 24, 40))
+    assert torch.allclose(warp(img, flow), legacy_warp(img, flow), atol=1e-5)